@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# compare the mmap reverse line reader against the previous chunked implementation
+
+import sys
+from io import DEFAULT_BUFFER_SIZE
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from pacroller.utils import back_readline, back_readline_bytes
+
+def legacy_back_readline(fp):
+    pos = fp.seek(0, 2)
+    if pos == 0:
+        return
+    previous = b''
+    while pos > 0:
+        next = max(pos - DEFAULT_BUFFER_SIZE, 0)
+        fp.seek(next)
+        got = fp.read(pos - next)
+        got = got + previous
+        blines = got.split(b'\n')
+        while len(blines) > 1:
+            yield blines.pop(-1).decode('utf-8')
+        previous = blines[0]
+        pos = next
+    yield blines.pop(-1).decode('utf-8')
+
+def timed(func, path: Path, limit: int = None) -> float:
+    start = perf_counter()
+    with open(path, 'rb') as f:
+        for n, _ in enumerate(func(f)):
+            if limit is not None and n >= limit:
+                break
+    return perf_counter() - start
+
+def main() -> None:
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    line = b'[2024-03-01T12:00:05+0000] [ALPM] upgraded linux (6.7.6.arch1-1 -> 6.7.7.arch1-1)\n'
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'pacman.log'
+        with open(path, 'wb') as f:
+            chunk = line * (1024 * 1024 // len(line))
+            for _ in range(size_mb):
+                f.write(chunk)
+        for name, data in (('empty', b''), ('trailing newline', b'a\nb\n'), ('no trailing newline', b'a\nb'), ('newline', b'\n')):
+            (p := Path(tmp) / 'case').write_bytes(data)
+            with open(p, 'rb') as f1, open(p, 'rb') as f2:
+                assert list(back_readline(f1)) == list(legacy_back_readline(f2)), name
+        for limit in (None, 1000):
+            legacy = min(timed(legacy_back_readline, path, limit) for _ in range(3))
+            current = min(timed(back_readline, path, limit) for _ in range(3))
+            raw = min(timed(back_readline_bytes, path, limit) for _ in range(3))
+            what = 'all lines' if limit is None else f'last {limit} lines'
+            print(f"{size_mb}MB {what}: legacy {legacy*1000:.1f}ms, mmap {current*1000:.1f}ms ({legacy/current:.1f}x), "
+                  f"mmap undecoded {raw*1000:.1f}ms ({legacy/raw:.1f}x)")
+
+if __name__ == '__main__':
+    main()
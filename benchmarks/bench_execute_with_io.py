@@ -0,0 +1,30 @@
+#!/usr/bin/python
+# feed execute_with_io a pty with lots of output and report wall time, cpu time and peak rss
+
+import sys
+from resource import getrusage, RUSAGE_SELF
+from time import perf_counter
+from pacroller.utils import execute_with_io
+
+WRITER = '''
+import sys
+line = b"==> dkms install --no-depmod zfs/2.2.2 -k 6.7.0-arch3-1 \\x1b[1mCC\\x1b[0m some/module/file.o\\n"
+chunk = line * (1024 * 1024 // len(line))
+for _ in range({size_mb}):
+    sys.stdout.buffer.write(chunk)
+sys.stdout.buffer.flush()
+'''
+
+def main() -> None:
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    before = getrusage(RUSAGE_SELF)
+    start = perf_counter()
+    output = execute_with_io([sys.executable, '-c', WRITER.format(size_mb=size_mb)])
+    wall = perf_counter() - start
+    after = getrusage(RUSAGE_SELF)
+    lines = sum(1 for _ in output)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    print(f"{size_mb}MB, {lines} lines: wall {wall:.2f}s, cpu {cpu:.2f}s, peak rss {after.ru_maxrss / 1024:.0f}MB")
+
+if __name__ == '__main__':
+    main()
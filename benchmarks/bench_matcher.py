@@ -0,0 +1,61 @@
+#!/usr/bin/python
+# compare the compiled rule matcher against trying every known output regex in turn
+
+import random
+from re import match
+from timeit import timeit
+from pacroller.known_output import KNOWN_HOOK_OUTPUT, KNOWN_PACKAGE_OUTPUT
+from pacroller.matcher import hook_matcher, package_matcher
+
+LINES = 10000
+
+def legacy_hook(hook_name: str, msg: str):
+    for r in (*(KNOWN_HOOK_OUTPUT.get('', [])), *(KNOWN_HOOK_OUTPUT.get(hook_name, []))):
+        if match(r, msg):
+            return r
+    return None
+
+def legacy_package(pkg: str, action: str, msg: str):
+    for r in (*(KNOWN_PACKAGE_OUTPUT.get('', [])), *(KNOWN_PACKAGE_OUTPUT.get(pkg, []))):
+        if isinstance(r, dict):
+            if action in r.get('action') and match(r.get('regex'), msg):
+                return r
+        elif match(r, msg):
+            return r
+    return None
+
+def synthetic_lines(seed: int = 0):
+    rnd = random.Random(seed)
+    samples = [
+        ('hook', '90-mkinitcpio-install.hook', '==> Building image from preset: /etc/mkinitcpio.d/linux.preset: \'default\''),
+        ('hook', '90-mkinitcpio-install.hook', '  -> -k /boot/vmlinuz-linux -c /etc/mkinitcpio.conf -g /boot/initramfs-linux.img'),
+        ('hook', '90-mkinitcpio-install.hook', '==> WARNING: Possibly missing firmware for module: qla2xxx'),
+        ('hook', '90-mkinitcpio-install.hook', '  -> Running build hook: [autodetect]'),
+        ('hook', '70-dkms-install.hook', '==> dkms install --no-depmod zfs/2.2.2 -k 6.7.0-arch3-1'),
+        ('hook', '70-dkms-install.hook', '==> depmod 6.7.0-arch3-1'),
+        ('hook', '20-systemd-sysusers.hook', 'Creating group \'foo\' with GID 970.'),
+        ('hook', '90-mkinitcpio-install.hook', 'something nobody expected'),
+        ('package', 'archlinux-keyring', 'gpg: next trustdb check due at 2024-10-10'),
+        ('package', 'archlinux-keyring', 'gpg: depth: 0  valid:   1  signed:  28  trust: 0-, 0q, 0n, 0m, 0f, 1u'),
+        ('package', 'archlinux-keyring', '==> Appending keys from archlinux.gpg...'),
+        ('package', 'archlinux-keyring', '  -> Disabled 3 keys.'),
+        ('package', 'glibc', '  en_US.UTF-8... done'),
+        ('package', 'grub', '   to install it to the MBR or UEFI. Due to potential configuration'),
+        ('package', 'nvidia-utils', 'unknown package chatter'),
+    ]
+    return [rnd.choice(samples) for _ in range(LINES)]
+
+def main() -> None:
+    lines = synthetic_lines()
+    def run_legacy():
+        return [legacy_hook(n, m) if k == 'hook' else legacy_package(n, 'upgrade', m) for k, n, m in lines]
+    def run_matcher():
+        return [hook_matcher(n).match(m) if k == 'hook' else package_matcher(n, 'upgrade').match(m) for k, n, m in lines]
+    assert run_legacy() == run_matcher()
+    number = 10
+    legacy = timeit(run_legacy, number=number) / number
+    compiled = timeit(run_matcher, number=number) / number
+    print(f"{LINES} scriptlet lines: legacy {legacy*1000:.2f}ms, matcher {compiled*1000:.2f}ms, {legacy/compiled:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# race database downloads across local stand-in mirrors with injected delays and failures
+
+import asyncio
+import gzip
+import sys
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from os import urandom
+from time import perf_counter, sleep, time
+from pacroller.mirrors import MirrorSync, MirrorStats, MirrorSyncError
+
+REPOS = ('core', 'extra', 'multilib')
+# name: (delay before answering, bytes per second, behaviour)
+MIRRORS = {
+    'slow': (0.8, 2 * 1024**2, 'ok'),
+    'broken': (0.05, None, 'error'),
+    'corrupt': (0.05, None, 'corrupt'),
+    'stale': (0.02, None, 'stale'),
+    'badsig': (0.02, None, 'badsig'),
+    'fast': (0.1, 50 * 1024**2, 'ok'),
+    'medium': (0.3, 10 * 1024**2, 'ok'),
+}
+
+def make_handler(delay: float, rate: float, behaviour: str, state: dict):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_) -> None:
+            pass
+        def do_GET(self) -> None:
+            sleep(delay)
+            # a stale mirror stopped syncing after the first round
+            mtime, dbs = (state['first'], state['first_dbs']) if behaviour == 'stale' else (state['mtime'], state['dbs'])
+            name = self.path.rsplit('/', 1)[-1]
+            repo = name.split('.', 1)[0]
+            if behaviour == 'error' or repo not in dbs:
+                self.send_error(500 if behaviour == 'error' else 404)
+                return
+            if name.endswith('.sig'):
+                body = b'bad' if behaviour == 'badsig' else b'sig:' + dbs[repo][:16]
+            else:
+                body = b'not a database' * 1000 if behaviour == 'corrupt' else dbs[repo]
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+            self.end_headers()
+            step = max(int(rate / 20), 1) if rate else len(body)
+            try:
+                for i in range(0, len(body), step):
+                    self.wfile.write(body[i:i+step])
+                    if rate:
+                        sleep(step / rate)
+            except (BrokenPipeError, ConnectionResetError):
+                # lost the race and got cancelled
+                pass
+    return Handler
+
+async def verify(sig: Path, db: Path) -> bool:
+    return sig.read_bytes() == b'sig:' + db.read_bytes()[:16]
+
+def main() -> None:
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    state = {'mtime': time() - 86400 * 7, 'dbs': dict()}
+    servers = list()
+    with TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for name, (delay, rate, behaviour) in MIRRORS.items():
+            server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(delay, rate, behaviour, state))
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            servers.append((name, server))
+        mirrorlist = '\n'.join(f"Server = http://127.0.0.1:{s.server_port}/$repo/os/$arch" for _, s in servers)
+        (tmp / 'mirrorlist').write_text(mirrorlist)
+        conf = [f"[options]\nDBPath = {tmp / 'db'}\nArchitecture = x86_64\nSigLevel = Required DatabaseRequired"]
+        conf.extend(f"[{repo}]\nInclude = {tmp / 'mirrorlist'}" for repo in REPOS)
+        (tmp / 'pacman.conf').write_text('\n'.join(conf))
+        names = {f"http://127.0.0.1:{s.server_port}/$repo/os/$arch": name for name, s in servers}
+        for race in (1, 3):
+            total = 0
+            for db in (tmp / 'db' / 'sync').glob('*'):
+                db.unlink()
+            stats = MirrorStats(tmp / f'mirrors-{race}.json')
+            for n in range(rounds):
+                # every round the repositories have moved on
+                state['mtime'] += 3600
+                state['dbs'] = dbs = {repo: gzip.compress(urandom(1024**2)) for repo in REPOS}
+                state.setdefault('first', state['mtime'])
+                state.setdefault('first_dbs', dbs)
+                engine = MirrorSync(str(tmp / 'pacman.conf'), race=race, timeout=10, stats=stats,
+                                    verify=verify, lock=str(tmp / 'db.lck'))
+                start = perf_counter()
+                try:
+                    updated = asyncio.run(engine.sync())
+                except MirrorSyncError as e:
+                    print(f"race {race} round {n}: failed {e}")
+                    continue
+                elapsed = perf_counter() - start
+                ranking = [names[s] for s in stats.rank(list(names), len(dbs['core']))]
+                total += elapsed
+                print(f"race {race} round {n}: {elapsed:.2f}s, updated {sum(updated.values())}/{len(updated)}, "
+                      f"ranking {' > '.join(ranking)}")
+                for repo in REPOS:
+                    assert (tmp / 'db' / 'sync' / f"{repo}.db").read_bytes() == dbs[repo] or n == 0
+            print(f"race {race}: {total:.2f}s in total")
+        for _, server in servers:
+            server.shutdown()
+
+if __name__ == '__main__':
+    main()
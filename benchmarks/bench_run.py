@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# pacroller run end to end against the stand-in pacman and systemctl in fake/, wall time, cpu time and peak rss
+# the paths pacroller uses are fixed, this replaces /etc/pacroller/config.json for the duration and appends to
+# /var/log/pacman.log, so it belongs in a throwaway container
+# e.g. bench_run.py -n 10 -s packages=200 -s extra_output=8000000 -s chunk_size=512
+
+import argparse
+import compileall
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Dict, List
+import pacroller
+from pacroller.config import CONFIG_DIR, CONFIG_FILE, LIB_DIR, PREFETCH_FILE
+
+FAKE_DIR = Path(__file__).resolve().parent / 'fake'
+# nothing that waits on the network or on a person
+CONFIG = {
+    'retry_backoff': 0,
+    'news-check': False,
+    'fast_path': False,
+    'sync_mirrors': 0,
+    'custom_sync': False,
+    'need_restart': False,
+    'clear_pkg_cache': False,
+}
+PHASE_METRIC = 'pacroller_phase_duration_seconds{phase="'
+
+def parse_value(text: str) -> object:
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def parse_settings(settings: List[str]) -> Dict[str, object]:
+    ''' key=value, the value is json if it parses as such '''
+    ret = dict()
+    for setting in settings:
+        key, _, value = setting.partition('=')
+        ret[key] = parse_value(value)
+    return ret
+
+def phases(metrics_file: Path) -> Dict[str, float]:
+    ret = dict()
+    if not metrics_file.exists():
+        return ret
+    for line in metrics_file.read_text().split('\n'):
+        if line.startswith(PHASE_METRIC):
+            name, _, value = line[len(PHASE_METRIC):].partition('"} ')
+            ret[name] = float(value)
+    return ret
+
+def run(argv: List[str], env: Dict[str, str], quiet: bool) -> dict:
+    ''' exit code, wall seconds, cpu seconds of pacroller and everything it waited for, peak rss in MiB '''
+    out = subprocess.DEVNULL if quiet else None
+    start = perf_counter()
+    p = subprocess.Popen(argv, env=env, stdin=subprocess.DEVNULL, stdout=out, stderr=out)
+    _, status, usage = os.wait4(p.pid, 0)
+    wall = perf_counter() - start
+    p.returncode = os.waitstatus_to_exitcode(status)
+    return {'exit': p.returncode, 'wall': wall, 'cpu': usage.ru_utime + usage.ru_stime, 'rss': usage.ru_maxrss / 1024}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='time pacroller run against a stand-in pacman')
+    parser.add_argument('-n', '--rounds', type=int, default=5)
+    parser.add_argument('-s', '--scenario', action='append', default=list(), metavar='KEY=VALUE',
+                        help='scenario setting, see DEFAULTS in fake/scenario.py')
+    parser.add_argument('-f', '--scenario-file', type=Path, help='scenario settings as json, -s goes on top')
+    parser.add_argument('-c', '--config', action='append', default=list(), metavar='KEY=VALUE',
+                        help='pacroller config.json setting on top of the benchmark defaults')
+    parser.add_argument('-o', '--output', type=Path, help='write the results as json')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show what pacroller prints')
+    parser.add_argument('--force', action='store_true', help='run on what looks like a real arch system')
+    args = parser.parse_args()
+    if os.getuid() != 0:
+        exit('pacroller run needs root')
+    if Path('/var/lib/pacman/local').exists() and not args.force:
+        exit('this looks like a real arch system, pacroller would be pointed at a fake pacman, use --force if you mean it')
+    try:
+        import pyalpm
+    except ImportError:
+        pass
+    else:
+        print('warning: pyalpm is installed, pacroller plans the upgrade from the real databases', file=sys.stderr)
+    compileall.compile_dir(Path(pacroller.__file__).parent, quiet=1)
+    from bench_suite import version
+
+    config_file = CONFIG_DIR / CONFIG_FILE
+    backup = config_file.read_bytes() if config_file.exists() else None
+    results: List[dict] = list()
+    with TemporaryDirectory() as tmpdir:
+        tmp = Path(tmpdir)
+        scenario = json.loads(args.scenario_file.read_text()) if args.scenario_file else dict()
+        scenario.update(parse_settings(args.scenario))
+        scenario_file = tmp / 'scenario.json'
+        scenario_file.write_text(json.dumps(scenario))
+        metrics_file = tmp / 'pacroller.prom'
+        config = {**CONFIG, 'metrics_file': str(metrics_file), **parse_settings(args.config)}
+        env = {**os.environ, 'PATH': f"{FAKE_DIR}:{os.environ.get('PATH', '')}", 'PACROLLER_FAKE_SCENARIO': str(scenario_file)}
+        pacroller_cmd = [sys.executable, '-m', 'pacroller.main']
+        try:
+            CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+            config_file.write_text(json.dumps(config))
+            for n in range(args.rounds):
+                # an error recorded by the round before would refuse the run, a prefetch would skip the sync
+                subprocess.run([*pacroller_cmd, 'reset'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                (LIB_DIR / PREFETCH_FILE).unlink(missing_ok=True)
+                scenario_file.with_suffix('.state').unlink(missing_ok=True)
+                metrics_file.unlink(missing_ok=True)
+                result = run([*pacroller_cmd, 'run', '-i', 'off'], env, quiet=not args.verbose)
+                result['phases'] = phases(metrics_file)
+                results.append(result)
+                print(f"round {n + 1}: exit {result['exit']}, wall {result['wall']:.3f}s, cpu {result['cpu']:.3f}s, "
+                      f"peak rss {result['rss']:.1f}MiB")
+        finally:
+            if backup is None:
+                config_file.unlink(missing_ok=True)
+            else:
+                config_file.write_bytes(backup)
+    for key, unit in (('wall', 's'), ('cpu', 's'), ('rss', 'MiB')):
+        values = [r[key] for r in results]
+        print(f"{key:<5} median {statistics.median(values):.3f}{unit} min {min(values):.3f}{unit} max {max(values):.3f}{unit}")
+    for name in dict.fromkeys(name for r in results for name in r['phases']):
+        print(f"  {name:<14} median {statistics.median(r['phases'].get(name, 0.0) for r in results):.3f}s")
+    if failed := [r['exit'] for r in results if r['exit']]:
+        print(f"{len(failed)} of {len(results)} runs failed with exit codes {sorted(set(failed))}")
+    if args.output:
+        args.output.write_text(json.dumps({
+            'version': version(),
+            'date': datetime.now().astimezone().isoformat(),
+            'python': sys.version.split()[0],
+            'rounds': args.rounds,
+            'scenario': scenario,
+            'config': config,
+            'results': results,
+        }, indent=2))
+
+if __name__ == '__main__':
+    main()
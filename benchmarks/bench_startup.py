@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# wall clock of the read-only commands against a bare interpreter, and what their imports cost
+
+import compileall
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+import pacroller
+
+ROUNDS = 15
+# milliseconds on top of starting the interpreter, it was about 200 when every command imported asyncio and ran localectl
+BUDGET = {
+    ('--help',): 100,
+    ('status',): 100,
+    ('status', '-v', '-m', '5'): 100,
+}
+TOP_IMPORTS = 12
+# modules the read-only commands must not import, known_output runs known_output_override.py
+FORBIDDEN = ('pacroller.known_output', 'pacroller.matcher', 'asyncio')
+
+def wall(argv) -> float:
+    samples = list()
+    for _ in range(ROUNDS):
+        t = perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append((perf_counter() - t) * 1000)
+    return statistics.median(samples)
+
+def import_times(args) -> list:
+    ''' (cumulative us, module) of every import, the most expensive first '''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'pacroller.main', *args],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = list()
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times.append((int(cumulative), name.rstrip()))
+    return sorted(times, reverse=True)
+
+def main() -> None:
+    # an installed package comes with its bytecode, stale caches would be compiled on every start
+    compileall.compile_dir(Path(pacroller.__file__).parent, quiet=1)
+    base = wall([sys.executable, '-c', 'pass'])
+    print(f"interpreter: {base:.1f}ms")
+    over = False
+    for args, budget in BUDGET.items():
+        spent = wall([sys.executable, '-m', 'pacroller.main', *args]) - base
+        over |= spent > budget
+        print(f"{' '.join(args)}: +{spent:.1f}ms (budget {budget}ms){' OVER BUDGET' if spent > budget else ''}")
+    times = import_times(['status'])
+    print('most expensive imports of status:')
+    for cumulative, name in times[:TOP_IMPORTS]:
+        print(f"  {cumulative / 1000:6.1f}ms {name}")
+    if imported := sorted({name.strip() for _, name in times} & set(FORBIDDEN)):
+        print(f"status imports {', '.join(imported)}")
+        over = True
+    if over:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# time the parsing hot paths on synthetic input of growing size, results go to json for comparing versions
+# e.g. bench_suite.py --sizes 1M,64M,1G -o new.json --compare old.json
+
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Dict, List
+from pacroller.analyze import _parse_transaction
+from pacroller.checker import LogParser, _log_parser, _stdout_parser, checkReport
+from pacroller.db import StatusDB
+from pacroller.logindex import TransactionIndex
+from pacroller.stats import collect, read_records
+from pacroller.utils import back_readline
+from synthetic import Profile, parse_size, stdout_lines, write_log
+
+# inputs read into a list of lines first, several times their size in memory
+IN_MEMORY_LIMIT = '256M'
+# a status entry with a report of a few dozen packages
+DB_ENTRY_SIZE = 4096
+SHOW_TRANSACTIONS = 10
+# differences below this are noise, however large the ratio
+MIN_DIFFERENCE = 0.005
+
+def timed(func: Callable[[], object], rounds: int) -> float:
+    ''' the fastest of rounds, the others mostly measure the machine being busy '''
+    best = None
+    for _ in range(rounds):
+        start = perf_counter()
+        func()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=Path(__file__).parent, text=True,
+                              capture_output=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def fill_db(db: StatusDB, entries: int, log_file: Path) -> None:
+    ''' reports parsed from the synthetic log, over and over '''
+    index = TransactionIndex(log_file, index_file=log_file.with_name('index.json'))
+    index.update()
+    reports = [_parse_transaction(index.log_file, *index.span(n))[1].to_dict() for n in range(min(len(index), 50))]
+    db._conn.execute('BEGIN')
+    for n in range(entries):
+        db.write(None, reports[n % len(reports)])
+    db._conn.execute('COMMIT')
+
+def cases(tmp: Path, size: int, profile: Profile, in_memory: int) -> Dict[str, Callable[[], object]]:
+    ''' name: callable, the input is prepared before anything is timed '''
+    log_file = tmp / f"pacman-{size}.log"
+    if not log_file.exists():
+        write_log(log_file, size, profile)
+    ret: Dict[str, Callable[[], object]] = dict()
+    def back_readline_all() -> int:
+        with open(log_file, 'rb') as f:
+            return sum(1 for _ in back_readline(f))
+    ret['back_readline'] = back_readline_all
+    def analyze_stats() -> None:
+        collect(str(log_file))
+    ret['analyze_stats'] = analyze_stats
+    def analyze_show() -> None:
+        index = TransactionIndex(log_file, index_file=tmp / 'show-index.json')
+        index.update()
+        for n in range(len(index) - 1, max(len(index) - 1 - SHOW_TRANSACTIONS, -1), -1):
+            _parse_transaction(index.log_file, *index.span(n))[1].summary(verbose=True, show_package=True)
+        (tmp / 'show-index.json').unlink()
+    ret['analyze_show'] = analyze_show
+    db = StatusDB(tmp / f"status-{size}.sqlite", legacy=tmp / 'db')
+    fill_db(db, max(1, size // DB_ENTRY_SIZE), log_file)
+    ret['read_db_latest'] = lambda: list(db.entries(limit=1, reports_only=True))
+    ret['read_db_all'] = lambda: sum(1 for _ in db.entries())
+    if size <= in_memory:
+        log = log_file.read_text().split('\n')
+        ret['log_parser'] = lambda: _log_parser(log, checkReport())
+        stdout = stdout_lines(size, profile)
+        ret['stdout_parser'] = lambda: _stdout_parser(stdout, checkReport())
+        report = checkReport()
+        parser = LogParser(report)
+        for record in read_records(str(log_file)):
+            parser.feed(record)
+        parser.close()
+        ret['summary'] = lambda: report.summary(verbose=True, show_package=True)
+    return ret
+
+def compare(results: List[dict], baseline: dict, tolerance: float) -> bool:
+    ''' prints the change against baseline, false if anything got slower by more than tolerance '''
+    before = {(r['case'], r['size']): r['seconds'] for r in baseline['results'] if 'seconds' in r}
+    ok = True
+    print(f"compared to {baseline.get('version', 'unknown')}:")
+    for r in results:
+        if 'seconds' not in r or (old := before.get((r['case'], r['size']))) is None:
+            continue
+        ratio = r['seconds'] / old if old else 1.0
+        slower = ratio > 1 + tolerance and r['seconds'] - old > MIN_DIFFERENCE
+        ok = ok and not slower
+        print(f"  {r['case']:<16} {r['size'] / 1024**2:>6g}M {old:>9.3f}s -> {r['seconds']:>9.3f}s "
+              f"{ratio:>6.2f}x{' SLOWER' if slower else ''}")
+    return ok
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='benchmark the parsers on synthetic pacman.log and pacman output')
+    parser.add_argument('-s', '--sizes', default='1M,16M', help='comma separated input sizes, e.g. 1M,64M,1G')
+    parser.add_argument('-r', '--rounds', type=int, default=3)
+    parser.add_argument('-o', '--output', type=Path, help='write the results as json')
+    parser.add_argument('-c', '--compare', type=Path, help='results of an earlier run to compare against')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25, help='slowdown accepted by --compare')
+    parser.add_argument('-w', '--workdir', type=Path, help='keep the generated input here and reuse it')
+    parser.add_argument('--in-memory-limit', type=parse_size, default=IN_MEMORY_LIMIT,
+                        help='largest input for the cases that read it into memory')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    # the parsers log every line at debug level
+    logging.basicConfig(level=logging.WARNING)
+    profile = Profile(seed=args.seed)
+    results: List[dict] = list()
+    with TemporaryDirectory() as tmpdir:
+        tmp = args.workdir or Path(tmpdir)
+        tmp.mkdir(parents=True, exist_ok=True)
+        for size in map(parse_size, args.sizes.split(',')):
+            prepared = cases(tmp, size, profile, args.in_memory_limit)
+            for name in ('log_parser', 'stdout_parser', 'back_readline', 'read_db_latest', 'read_db_all', 'summary',
+                         'analyze_stats', 'analyze_show'):
+                if (func := prepared.get(name)) is None:
+                    results.append({'case': name, 'size': size, 'skipped': 'larger than --in-memory-limit'})
+                    print(f"{name:<16} {size / 1024**2:>6g}M skipped")
+                    continue
+                seconds = timed(func, args.rounds)
+                results.append({'case': name, 'size': size, 'seconds': seconds, 'mb_per_s': size / 1024**2 / seconds})
+                print(f"{name:<16} {size / 1024**2:>6g}M {seconds:>9.3f}s {size / 1024**2 / seconds:>9.1f}MB/s")
+            (tmp / f"status-{size}.sqlite").unlink()
+    output = {
+        'version': version(),
+        'date': datetime.now().astimezone().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'rounds': args.rounds,
+        'profile': profile.to_dict(),
+        'results': results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(output, indent=2))
+    if args.compare and not compare(results, json.loads(args.compare.read_text()), args.tolerance):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# what the stand-in pacman and systemctl do, read from the json file in PACROLLER_FAKE_SCENARIO
+
+import json
+import re
+import sys
+from datetime import datetime
+from os import environ
+from pathlib import Path
+from typing import List, Tuple
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from synthetic import Generator, Profile
+
+DEFAULTS = {
+    # a synthetic transaction, see synthetic.Profile, only output the checker knows unless asked for
+    'packages': 40,
+    'scriptlet_lines': 4,
+    'scriptlet_rate': 0.0,
+    'unmatched_rate': 0.0,
+    'seed': 0,
+    # a recorded session instead, pacman -Su output or the stdout.log of save_stdout, and pacman.log
+    'replay_stdout': None,
+    'replay_log': None,
+    # bytes of compiler noise a hook prints on top, only to stdout like a dkms build does
+    'extra_output': 0,
+    # stdout is written in pieces of chunk_size bytes with chunk_delay seconds in between
+    'chunk_size': 4096,
+    'chunk_delay': 0.0,
+    # seconds spent in each phase
+    'sync_delay': 0.0,
+    'download_delay': 0.0,
+    'install_delay': 0.0,
+    'hooks_delay': 0.0,
+    # asked before proceeding, e.g. ":: Replace foo with extra/bar? [Y/n]"
+    'prompts': [],
+    # attempts that fail with the network errors pacroller retries
+    'sync_failures': 0,
+    'upgrade_failures': 0,
+    # "sync" or "upgrade" fails for good
+    'fail': None,
+    'system_state': 'running',
+    'log_file': '/var/log/pacman.log',
+}
+SHOW_CURSOR = '\x1b[?25h'
+STDOUT_LOG_LINE = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} - (.*)$')
+LOG_TIME = re.compile(r'^\[[^\]]+\]')
+ACTION = re.compile(r'^\[[^\]]+\] \[ALPM\] (upgraded|installed|removed|downgraded|reinstalled|running) ')
+SCRIPTLET = re.compile(r'^\[[^\]]+\] \[ALPM-SCRIPTLET\] (.*)$')
+COUNTER = re.compile(r'^\(\d+/\d+\) ')
+
+def path() -> Path:
+    return Path(environ.get('PACROLLER_FAKE_SCENARIO', Path(__file__).with_name('scenario.json')))
+
+def load() -> dict:
+    scenario = dict(DEFAULTS)
+    if path().exists():
+        scenario.update(json.loads(path().read_text()))
+    return scenario
+
+def bump(counter: str) -> int:
+    ''' how many times counter was bumped before, kept next to the scenario between invocations '''
+    state_file = path().with_suffix('.state')
+    state = json.loads(state_file.read_text()) if state_file.exists() else dict()
+    seen = state.get(counter, 0)
+    state[counter] = seen + 1
+    state_file.write_text(json.dumps(state))
+    return seen
+
+def _replay_stdout(text: str) -> List[str]:
+    ''' the last pacman -Su in a stdout.log, anything else is taken as it is '''
+    lines = text.split('\n')
+    if not any(STDOUT_LOG_LINE.match(line) for line in lines[:10]):
+        return lines
+    ret: List[str] = list()
+    for line in lines:
+        if not (_m := STDOUT_LOG_LINE.match(line)):
+            continue
+        if _m.group(1).startswith("running ['pacman', '-Su'"):
+            ret = list()
+        elif _m.group(1).startswith('STDOUT: '):
+            ret.append(_m.group(1).removeprefix('STDOUT: '))
+    return ret
+
+def _replay_log(text: str) -> List[str]:
+    ''' the last transaction in a pacman.log '''
+    lines = text.rstrip('\n').split('\n')
+    for n in range(len(lines) - 1, -1, -1):
+        if lines[n].endswith("[PACMAN] starting full system upgrade") or lines[n].endswith('[ALPM] transaction started'):
+            return lines[n:]
+    return lines
+
+def session(scenario: dict) -> Tuple[List[str], List[str], List[Tuple[str, str, str, str]]]:
+    ''' (pacman -Su output, pacman.log lines, (action, name, old, new) of every change) '''
+    if scenario['replay_stdout'] or scenario['replay_log']:
+        stdout = _replay_stdout(Path(scenario['replay_stdout']).read_text()) if scenario['replay_stdout'] else list()
+        log = _replay_log(Path(scenario['replay_log']).read_text()) if scenario['replay_log'] else list()
+        changes = list()
+        for line in log:
+            if _m := re.match(r'^\[[^\]]+\] \[ALPM\] upgraded (\S+) \((\S+) -> (\S+)\)$', line):
+                changes.append(('upgraded', *_m.groups()))
+            elif _m := re.match(r'^\[[^\]]+\] \[ALPM\] installed (\S+) \((\S+)\)$', line):
+                changes.append(('installed', _m.group(1), '', _m.group(2)))
+        return stdout, log, changes
+    profile = Profile(packages=scenario['packages'], scriptlet_lines=scenario['scriptlet_lines'],
+                      scriptlet_rate=scenario['scriptlet_rate'], unmatched_rate=scenario['unmatched_rate'],
+                      seed=scenario['seed'])
+    generator = Generator(profile, start=datetime.now().astimezone())
+    log, stdout = generator.transaction()
+    return stdout, log, generator.changes
+
+def steps(stdout: List[str], log: List[str], mirror: bool) -> List[Tuple[List[str], List[str]]]:
+    '''
+        (stdout lines, pacman.log lines) written together, a package or hook starts a step,
+        mirror prints the scriptlet output of the log too, a recorded stdout already has it
+    '''
+    groups: List[List[str]] = [list()]
+    for line in stdout:
+        if COUNTER.match(line):
+            groups.append(list())
+        groups[-1].append(line)
+    ret = [(groups.pop(0), list())]
+    for line in log:
+        if ACTION.match(line) and groups:
+            ret.append((groups.pop(0), list()))
+        ret[-1][1].append(line)
+        if mirror and (_m := SCRIPTLET.match(line)):
+            ret[-1][0].append(_m.group(1))
+    ret.extend((group, list()) for group in groups)
+    return ret
+
+def now_stamped(line: str) -> str:
+    return LOG_TIME.sub(f"[{datetime.now().astimezone().strftime('%Y-%m-%dT%H:%M:%S%z')}]", line, count=1)
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# realistic pacman.log and pacman -Su output with a configurable mix of packages, hooks and scriptlet chatter
+
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# output the known output rules accept, unmatched lines are made up on the fly
+HOOK_OUTPUT = {
+    '20-systemd-sysusers.hook': ["Creating group 'foo' with GID 970.", "Creating user 'foo' (n/a) with UID 970 and GID 970."],
+    '30-systemd-sysctl.hook': ['Not setting net/ipv4/conf/all/rp_filter (explicit setting exists).'],
+    '70-dkms-install.hook': ['==> dkms install --no-depmod zfs/2.2.2 -k 6.7.0-arch3-1', '==> depmod 6.7.0-arch3-1'],
+    '90-mkinitcpio-install.hook': [
+        "==> Building image from preset: /etc/mkinitcpio.d/linux.preset: 'default'",
+        '  -> -k /boot/vmlinuz-linux -c /etc/mkinitcpio.conf -g /boot/initramfs-linux.img',
+        '==> Starting build: 6.7.0-arch3-1',
+        '  -> Running build hook: [base]',
+        '  -> Running build hook: [udev]',
+        '  -> Running build hook: [autodetect]',
+        '==> WARNING: Possibly missing firmware for module: qla2xxx',
+        '==> Generating module dependencies',
+        '==> Creating zstd-compressed initcpio image: /boot/initramfs-linux.img',
+        '==> Initcpio image generation successful',
+    ],
+    '90-update-appstream-cache.hook': ['✔ Metadata cache was updated successfully.'],
+    '30-systemd-daemon-reload-system.hook': [],
+    '30-systemd-update.hook': [],
+    'texinfo-install.hook': [],
+}
+PACKAGE_OUTPUT = {
+    'archlinux-keyring': [
+        '==> Appending keys from archlinux.gpg...',
+        '==> Locally signing trusted keys in keyring...',
+        '  -> Locally signed 5 keys.',
+        '==> Importing owner trust values...',
+        'gpg: next trustdb check due at 2024-10-10',
+        '==> Updating trust database...',
+    ],
+    'glibc': ['Generating locales...', '  en_US.UTF-8... done', 'Generation complete.'],
+    'fontconfig': ['Rebuilding fontconfig cache...'],
+    'brltty': ['Please add your user to the brlapi group.'],
+}
+# chance of a package with known scriptlet output to be part of a transaction
+CHATTY_RATE = 0.3
+WORDS = ('lib', 'python', 'perl', 'qt6', 'gtk', 'rust', 'go', 'node', 'x11', 'mesa', 'kde', 'gnome', 'font', 'tools', 'utils')
+OPTDEPENDS = ('python-pyqt6: graphical frontend', 'bash-completion: completion for bash', 'git: fetching sources')
+
+class Profile:
+    '''
+        packages changed per transaction, the hooks that may run after it, how many lines a chatty scriptlet prints,
+        the share of packages without known output that still print something, of lines continued without
+        a timestamp and of lines no rule knows
+    '''
+    def __init__(self, packages: int = 40, hooks: Tuple[str, ...] = tuple(HOOK_OUTPUT), scriptlet_lines: int = 4,
+                 scriptlet_rate: float = 0.02, continuation_rate: float = 0.02, unmatched_rate: float = 0.05,
+                 seed: int = 0) -> None:
+        self.packages = packages
+        self.hooks = hooks
+        self.scriptlet_lines = scriptlet_lines
+        self.scriptlet_rate = scriptlet_rate
+        self.continuation_rate = continuation_rate
+        self.unmatched_rate = unmatched_rate
+        self.seed = seed
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+class Generator:
+    ''' transactions one after another, each call continues where the previous one ended '''
+    def __init__(self, profile: Profile = None, start: datetime = datetime(2020, 1, 1, tzinfo=timezone.utc)) -> None:
+        self.profile = profile or Profile()
+        self.rnd = random.Random(self.profile.seed)
+        self.now = start
+        self.transactions = 0
+        # (action, name, old version, new version) of the last transaction
+        self.changes: List[Tuple[str, str, str, str]] = list()
+        self._names = [f"{a}-{b}{i}" for i, (a, b) in enumerate((self.rnd.choice(WORDS), self.rnd.choice(WORDS))
+                                                                for _ in range(2000))]
+    def _tick(self, seconds: float) -> str:
+        self.now += timedelta(seconds=seconds)
+        return self.now.strftime('%Y-%m-%dT%H:%M:%S%z')
+    def _chatter(self, known: List[str]) -> str:
+        if not known or self.rnd.random() < self.profile.unmatched_rate:
+            return f"unexpected output {self.rnd.randrange(10**6)} from {self.rnd.choice(WORDS)}"
+        return self.rnd.choice(known)
+    def _scriptlet(self, log: List[str], known: List[str], lines: int) -> None:
+        for _ in range(lines):
+            log.append(f"[{self._tick(self.rnd.random())}] [ALPM-SCRIPTLET] {self._chatter(known)}")
+            if self.rnd.random() < self.profile.continuation_rate:
+                # a message with an embedded newline
+                log.append(f"  continued {self.rnd.choice(WORDS)}")
+    def pause(self) -> None:
+        ''' the time that passes until the next upgrade '''
+        self._tick(self.rnd.uniform(3600, 7 * 86400))
+    def transaction(self) -> Tuple[List[str], List[str]]:
+        ''' (pacman.log lines, pacman stdout lines) of one upgrade '''
+        p, rnd = self.profile, self.rnd
+        self.transactions += 1
+        self.changes = changes = list()
+        names = rnd.sample(self._names, min(p.packages, len(self._names)))
+        names.extend(name for name in PACKAGE_OUTPUT if rnd.random() < CHATTY_RATE)
+        for name in names:
+            action = 'upgraded' if name in PACKAGE_OUTPUT else rnd.choices(('upgraded', 'installed', 'removed'), (90, 7, 3))[0]
+            old, new = f"{rnd.randrange(1, 30)}.{rnd.randrange(10)}-1", f"{rnd.randrange(30, 60)}.{rnd.randrange(10)}-1"
+            changes.append((action, name, old, new))
+        log = [f"[{self._tick(0)}] [PACMAN] Running 'pacman -Su --noprogressbar --color never'",
+               f"[{self._tick(0)}] [PACMAN] starting full system upgrade",
+               f"[{self._tick(rnd.uniform(5, 60))}] [ALPM] transaction started"]
+        stdout = [':: Starting full system upgrade...', 'resolving dependencies...', 'looking for conflicting packages...', '',
+                  f"Packages ({len(changes)}) {' '.join(f'{name}-{new}' for _, name, _, new in changes)}", '',
+                  f"Total Download Size:   {rnd.uniform(1, 900):.2f} MiB", '',
+                  ':: Proceed with installation? [Y/n] ', f"(1/{len(changes)}) checking keys in keyring",
+                  ':: Processing package changes...']
+        for n, (action, name, old, new) in enumerate(changes, 1):
+            when = self._tick(rnd.uniform(0, 3))
+            if action == 'upgraded':
+                log.append(f"[{when}] [ALPM] upgraded {name} ({old} -> {new})")
+            elif action == 'installed':
+                log.append(f"[{when}] [ALPM] installed {name} ({new})")
+            else:
+                log.append(f"[{when}] [ALPM] removed {name} ({old})")
+            stdout.append(f"({n}/{len(changes)}) {action.removesuffix('ed').removesuffix('e')}ing {name}")
+            if name in PACKAGE_OUTPUT or rnd.random() < p.scriptlet_rate:
+                # whatever the packages without known output print is unmatched
+                self._scriptlet(log, PACKAGE_OUTPUT.get(name, []), rnd.randrange(1, p.scriptlet_lines + 1))
+            if action == 'installed' and rnd.random() < 0.3:
+                stdout.append(f"Optional dependencies for {name}")
+                stdout.extend(f"    {dep}" for dep in rnd.sample(OPTDEPENDS, rnd.randrange(1, len(OPTDEPENDS) + 1)))
+        log.append(f"[{self._tick(0)}] [ALPM] transaction completed")
+        stdout.append(':: Running post-transaction hooks...')
+        hooks = sorted(rnd.sample(p.hooks, rnd.randrange(1, len(p.hooks) + 1))) if p.hooks else []
+        for n, hook in enumerate(hooks, 1):
+            log.append(f"[{self._tick(rnd.uniform(0, 1))}] [ALPM] running '{hook}'...")
+            stdout.append(f"({n}/{len(hooks)}) {hook.removesuffix('.hook')}")
+            if known := HOOK_OUTPUT.get(hook):
+                self._scriptlet(log, known, rnd.randrange(1, p.scriptlet_lines * 3 + 1))
+        return log, stdout
+
+def write_log(path: Path, size: int, profile: Profile = None) -> int:
+    ''' a pacman.log of at least size bytes, returns the number of transactions in it '''
+    generator = Generator(profile)
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            generator.pause()
+            log, _ = generator.transaction()
+            text = '\n'.join(log) + '\n'
+            f.write(text)
+            written += len(text.encode('utf-8'))
+    return generator.transactions
+
+def stdout_lines(size: int, profile: Profile = None) -> List[str]:
+    ''' pacman output of upgrades one after another, about size bytes '''
+    generator = Generator(profile)
+    lines: List[str] = list()
+    written = 0
+    while written < size:
+        generator.pause()
+        _, stdout = generator.transaction()
+        lines.extend(stdout)
+        written += sum(len(line) + 1 for line in stdout)
+    return lines
+
+def parse_size(text: str) -> int:
+    units: Dict[str, int] = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='generate a synthetic pacman.log or pacman output')
+    parser.add_argument('kind', choices=['log', 'stdout'])
+    parser.add_argument('output', type=Path)
+    parser.add_argument('-s', '--size', type=parse_size, default='1M', help='e.g. 512K, 16M, 1G')
+    parser.add_argument('--packages', type=int, default=40)
+    parser.add_argument('--scriptlet-lines', type=int, default=4)
+    parser.add_argument('--scriptlet-rate', type=float, default=0.02)
+    parser.add_argument('--continuation-rate', type=float, default=0.02)
+    parser.add_argument('--unmatched-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    profile = Profile(packages=args.packages, scriptlet_lines=args.scriptlet_lines, scriptlet_rate=args.scriptlet_rate,
+                      continuation_rate=args.continuation_rate, unmatched_rate=args.unmatched_rate, seed=args.seed)
+    if args.kind == 'log':
+        print(f"{write_log(args.output, args.size, profile)} transactions written to {args.output}")
+    else:
+        args.output.write_text('\n'.join(stdout_lines(args.size, profile)))
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,16 @@
 
 from pacroller.config import PACMAN_LOG
 from pacroller.checker import _log_parser, checkReport
-from pacroller.utils import back_readline
+from pacroller.logindex import TransactionIndex, read_span
+from pacroller.stats import PERIODS, collect
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import repeat
+from typing import List, Tuple
+import json
 import logging
+import os
 import re
 
 class _colors:
@@ -20,77 +28,137 @@ class _nocolors:
 colors = _colors()
 nocolors = _nocolors()
 
+def _parse_time(text: str) -> float:
+    ''' iso 8601 date or datetime, local time if no timezone is given '''
+    return datetime.fromisoformat(text).timestamp()
+
+class Colorizer:
+    ''' summary highlighting, patterns are compiled once per color scheme '''
+    def __init__(self, c: _colors) -> None:
+        self.c = c
+        self._version = re.compile(r"(from|to) ([^ ]{1,})")
+        self._version_repl = f"\\1 {c.GREEN}\\2{c.ENDC}"
+        self._verbose_change = re.compile(r"(upgrade|install|remove) ([^ ]{1,})")
+        self._change = re.compile(r"(upgrade|install|remove): (.*)")
+        self._change_repl = f"{c.PINK}\\1{c.ENDC} {c.BLUE}\\2{c.ENDC}"
+        self._warn = re.compile(r"(says|pacnew)")
+        self._warn_repl = f"{c.ENDC}{c.BLUE}\\1{c.ENDC}{c.WARN}"
+    def colorize(self, summary: List[str], title: str, verbose: bool, no_package: bool) -> List[str]:
+        c = self.c
+        summary = [title, *summary[1:]]
+        in_section = ""
+        for i, line in enumerate(summary):
+            if i == 0:
+                continue
+            if line[0] != ' ':
+                summary[i] = f"{c.GREEN}{line}{c.ENDC}"
+                in_section = line.strip()
+            else:
+                if not no_package and in_section == "Package changes:":
+                    if verbose:
+                        summary[i] = self._version.sub(self._version_repl, summary[i])
+                        summary[i] = self._verbose_change.sub(self._change_repl, summary[i])
+                    else:
+                        summary[i] = self._change.sub(self._change_repl, summary[i])
+                if in_section == "Collected Warnings:":
+                    summary[i] = f"{c.WARN}{line}{c.ENDC}"
+                    summary[i] = self._warn.sub(self._warn_repl, summary[i])
+                elif in_section == "Collected Errors:":
+                    summary[i] = f"{c.ERROR}{line}{c.ENDC}"
+        return summary
+
+def _parse_transaction(log_file: str, start: int, end: int) -> Tuple[str, checkReport]:
+    ''' runs in the worker processes with --jobs '''
+    log = list()
+    for line in read_span(log_file, start, end):
+        if not line or line.split(' ', maxsplit=2)[1:2] == ["[PACMAN]"]:
+            continue
+        log.append(line)
+    logging.getLogger().debug(f"report input {log=}")
+    report = checkReport()
+    _log_parser(log, report)
+    return (log[0].split()[0].strip('[]') if log else '', report)
+
 def main() -> None:
     import argparse
     parser = argparse.ArgumentParser(description='Standalone Parsing Tool for pacman.log')
+    parser.add_argument('action', nargs='?', choices=['show', 'stats', 'rules'], default='show',
+                        help="show upgrades, history-wide statistics or how the known output rules fared in past runs",
+                        metavar="show / stats / rules")
     parser.add_argument('-l', '--log-file', type=str, default=PACMAN_LOG, help='pacman log location')
     parser.add_argument('-d', '--debug', action='store_true', help='enable debug mode')
     parser.add_argument('-v', '--verbose', action='store_true', help='show verbose report')
     parser.add_argument('-n', '--number', type=int, default=0, help='which upgrade to parse')
-    parser.add_argument('-m', '--max', type=int, default=1, help='max numbers of upgrade to parse')
+    parser.add_argument('-m', '--max', type=int, default=None, help='max numbers of upgrade to parse')
+    parser.add_argument('-s', '--since', type=_parse_time, default=None, help='parse upgrades started since this iso date/time')
+    parser.add_argument('-u', '--until', type=_parse_time, default=None, help='parse upgrades started until this iso date/time')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='parse upgrades in this many processes, 0 for all cpus')
     parser.add_argument('-p', '--no-package', action='store_true', help='do not show package changes')
     parser.add_argument('-c', '--no-color', action='store_true', help='do not show colors')
+    parser.add_argument('-b', '--by', choices=PERIODS.keys(), default='month', help='stats: roll up transactions by this period')
+    parser.add_argument('-t', '--top', type=int, default=10, help='stats, rules: number of entries in each ranking')
+    parser.add_argument('--json', action='store_true', help='stats, rules: print json instead of tables')
     args = parser.parse_args()
     args.number = args.number if args.number >= 0 else - args.number - 1
 
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
                         format='%(asctime)s - %(module)s - %(funcName)s - %(levelname)s - %(message)s')
-    logger = logging.getLogger()
-    with open(args.log_file, "rb") as f:
-        current_at = 0
-        logs = list()
-        log = list()
-        for line in back_readline(f):
-            if not line:
-                continue
-            (_, rsrc, msg) = line.split(' ', maxsplit=2)
-            logger.debug(f"{rsrc=} {msg=}")
-            if rsrc == "[PACMAN]":
-                continue
-            log.insert(0, line)
-            if rsrc == "[ALPM]" and msg == "transaction started":
-                current_at += 1
-                if current_at < args.number + args.max + 1:
-                    if current_at > args.number:
-                        logs.append(log)
-                        log = list()
-                    else:
-                        log.clear()
-                else:
-                    break
+    if args.action == 'rules':
+        from pacroller.matcher import RuleStats
+        stats = RuleStats()
+        print(json.dumps(stats.to_dict(args.top), indent=2) if args.json else stats.summary(args.top))
+        return
+    index = TransactionIndex(args.log_file)
+    index.update()
+    if args.action == 'stats':
+        if args.since is not None or args.until is not None:
+            if not (selected := index.between(args.since, args.until)):
+                return
+            if index.ordered:
+                stats = collect(index.log_file, index.span(selected[0])[0], index.span(selected[-1])[1])
+            else:
+                # the transactions in the period are not necessarily next to each other
+                stats = collect(index.log_file, spans=[index.span(n) for n in selected])
+        else:
+            stats = collect(index.log_file)
+        if args.json:
+            print(json.dumps(stats.to_dict(args.by, args.top), indent=2))
         else:
-            if log:
-                logs.append(log)
-        for seq, log in enumerate(logs):
-            logger.debug(f"report input {log=}")
-            report = checkReport()
-            _log_parser(log, report)
-            c = nocolors if args.no_color else colors
+            print(stats.summary(args.by, args.top))
+        return
+    if args.since is not None or args.until is not None:
+        selected = index.between(args.since, args.until)[::-1][args.number:]
+        if args.max is not None and args.max > 0:
+            selected = selected[:args.max]
+        labels = [n - len(index) for n in selected]
+        spans = [index.span(n) for n in selected]
+    else:
+        limit = 1 if args.max is None else args.max
+        selected = range(len(index) - 1 - args.number, -1, -1)[:limit]
+        labels = [-args.number - 1 - seq for seq in range(len(selected))]
+        spans = [index.span(n) for n in selected]
+        # what comes before the first transaction, the whole log without one, is shown as an upgrade of its own
+        if len(selected) < limit and (head := index.offsets[0] if len(index) else index.end):
+            labels.append(-args.number - 1 - len(selected))
+            spans.append((0, head))
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    colorizer = Colorizer(nocolors if args.no_color else colors)
+    starts, ends = [start for start, _ in spans], [end for _, end in spans]
+    with ProcessPoolExecutor(jobs) if jobs > 1 and len(selected) > 1 else nullcontext() as executor:
+        if executor:
+            results = executor.map(_parse_transaction, repeat(index.log_file), starts, ends,
+                                   chunksize=max(1, len(selected) // (jobs * 8)))
+        else:
+            results = map(_parse_transaction, repeat(index.log_file), starts, ends)
+        c = colorizer.c
+        for n, (started_at, report) in zip(labels, results):
+            if not started_at:
+                # nothing but [PACMAN] lines
+                continue
             summary = report.summary(show_package=not args.no_package, verbose=args.verbose).split('\n')
-            in_section = ""
-            for i, line in enumerate(summary):
-                if i == 0:
-                    summary[i] = (f"{c.TITLE}=> Showing upgrade {c.PINK}{-args.number-1-seq}{c.ENDC}"
-                                  f" started at{c.ENDC} {c.PINK}{log[0].split()[0].strip('[]')}{c.ENDC}")
-                else:
-                    if line[0] != ' ':
-                        summary[i] = f"{c.GREEN}{line}{c.ENDC}"
-                        in_section = line.strip()
-                    else:
-                        if not args.no_package and in_section == "Package changes:":
-                            if args.verbose:
-                                summary[i] = re.sub(f"(from|to) ([^ ]{{1,}})", f"\\1 {c.GREEN}\\2{c.ENDC}", summary[i])
-                            for keyword in {"upgrade", "install", "remove"}:
-                                if args.verbose:
-                                    summary[i] = re.sub(f"({keyword}) ([^ ]{{1,}})", f"{c.PINK}\\1{c.ENDC} {c.BLUE}\\2{c.ENDC}", summary[i])
-                                else:
-                                    summary[i] = re.sub(f"({keyword}): (.*)", f"{c.PINK}\\1{c.ENDC} {c.BLUE}\\2{c.ENDC}", summary[i])
-                        if in_section == "Collected Warnings:":
-                            summary[i] = f"{c.WARN}{line}{c.ENDC}"
-                            summary[i] = re.sub(f"(says|pacnew)", f"{c.ENDC}{c.BLUE}\\1{c.ENDC}{c.WARN}", summary[i])
-                        elif in_section == "Collected Errors:":
-                            summary[i] = f"{c.ERROR}{line}{c.ENDC}"
-            print("\n".join(summary))
+            title = (f"{c.TITLE}=> Showing upgrade {c.PINK}{n}{c.ENDC}"
+                     f" started at{c.ENDC} {c.PINK}{started_at}{c.ENDC}")
+            print("\n".join(colorizer.colorize(summary, title, args.verbose, args.no_package)))
 
 if __name__ == '__main__':
     main()
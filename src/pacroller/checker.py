@@ -1,15 +1,15 @@
 import logging
-from typing import List, Tuple, Dict
+from typing import List, Tuple, Dict, Iterable, Iterator, Union, Callable
 from pathlib import Path
-from re import compile, Pattern, match
-from pacroller.utils import pacman_time_to_timestamp
-from pacroller.known_output import KNOWN_HOOK_OUTPUT, KNOWN_PACKAGE_OUTPUT
+from re import compile, Pattern, Match, DOTALL
+from pacroller.utils import pacman_time_to_timestamp, LogTail
 from pacroller.config import IGNORED_PACNEW
+from pacroller.timings import summary as timings_summary
 from time import ctime, time
 
 logger = logging.getLogger()
 
-REGEX = {
+_REGEX_SOURCE = {
     's_process_pkg_changes': r':: Processing package changes\.\.\.',
     's_post-transaction': r':: Running post-transaction hooks\.\.\.$',
     's_optdepend': r'(?i)(?:new )?optional dependencies for (.+)$',
@@ -24,19 +24,43 @@ REGEX = {
     'l_remove': r'removed (.+) \((.+)\)',
     'l_pacnew': r'warning: (.+) installed as (.+\.pacnew)',
 }
-for k, v in REGEX.items():
-    REGEX[k] = compile(v)
-REGEX: Dict[str, Pattern] # get through lint
+class _Patterns(dict):
+    ''' compiled on first use, reading old reports back does not need any of them '''
+    def __missing__(self, key: str) -> Pattern:
+        self[key] = pattern = compile(_REGEX_SOURCE[key])
+        return pattern
+REGEX: Dict[str, Pattern] = _Patterns()
+# candidate REGEX keys for an ALPM message, by its first word
+ALPM_DISPATCH = {
+    'running': ('l_running_hook',),
+    'transaction': ('l_transaction_start', 'l_transaction_complete'),
+    'upgraded': ('l_upgrade',),
+    'installed': ('l_install',),
+    'downgraded': ('l_downgrade',),
+    'reinstalled': ('l_reinstall',),
+    'removed': ('l_remove',),
+    'warning:': ('l_pacnew',),
+}
+SCRIPTLET_ACTIONS = {
+    'l_upgrade': 'upgrade',
+    'l_install': 'install',
+    'l_remove': 'remove',
+    'l_downgrade': 'downgrade',
+    'l_reinstall': 'reinstall',
+}
+LOG_LINE = compile(r'\[(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(?:[+-]\d{2}:?\d{2}|Z))\] \[([^ ]*)\] (.*)', DOTALL)
 
 class checkReport:
     def __init__(self, info: List[str] = None, warn: List[str] = None,
                  crit: List[str] = None, changes: List[Tuple[str]] = None,
-                 date: int = int(time())) -> None:
+                 date: int = int(time()), timings: dict = None) -> None:
         self._info = info or list()
         self._warn = warn or list()
         self._crit = crit or list()
         self._changes = changes or list()
         self._date = date
+        # {'phases': {name: seconds}, 'counters': {name: value}, 'hooks': {name: seconds}, 'scriptlets': {pkg: seconds}}
+        self.timings = timings or dict()
     @property
     def failed(self, extra_safe: bool = False) -> bool:
         if extra_safe:
@@ -47,7 +71,8 @@ class checkReport:
                 return True
         return False
     def to_dict(self) -> dict:
-        return {'info': self._info, 'warn': self._warn, 'crit': self._crit, 'changes': self._changes, 'date': self._date}
+        return {'info': self._info, 'warn': self._warn, 'crit': self._crit, 'changes': self._changes, 'date': self._date,
+                'timings': self.timings}
     def summary(self, verbose=True, show_package=False, indent=2) -> str:
         ret = [f"Pacroller Report at {ctime(self._date)}",]
         if self._crit:
@@ -95,6 +120,9 @@ class checkReport:
             if pkg_ret:
                 ret.append("Package changes:")
                 ret.extend([" " * indent + i for i in pkg_ret])
+        if verbose and self.timings:
+            ret.append("Timings:")
+            ret.extend(timings_summary(self.timings, indent))
         if len(ret) == 1:
             ret.append('nothing to show')
         return "\n".join(ret)
@@ -110,8 +138,13 @@ class checkReport:
     def change(self, name: str, old: str, new: str) -> None:
         logger.debug(f'report change {name=} {old=} {new=}')
         self._changes.append((name, old, new))
+    def cost(self, kind: str, name: str, seconds: float) -> None:
+        ''' kind is hooks or scriptlets, a hook run more than once adds up '''
+        logger.debug(f'report cost {kind=} {name=} {seconds=}')
+        costs = self.timings.setdefault(kind, dict())
+        costs[name] = costs.get(name, 0) + seconds
 
-def log_checker(stdout: List[str], log: List[str], debug=False) -> checkReport:
+def log_checker(stdout: Iterable[str], log: List[str], debug=False) -> checkReport:
     if debug:
         Path('/tmp/pacroller-stdout.log').write_text('\n'.join(stdout))
         Path('/tmp/pacroller-pacman.log').write_text('\n'.join(log))
@@ -120,161 +153,300 @@ def log_checker(stdout: List[str], log: List[str], debug=False) -> checkReport:
     _log_parser(log, report)
     return report
 
-def _stdout_parser(stdout: List[str], report: checkReport) -> None:
-    ln = 0
-    in_package_change = False
-    while ln < len(stdout):
-        line = stdout[ln]
+class StdoutParser:
+    ''' consumes pacman stdout line by line '''
+    def __init__(self, report: checkReport) -> None:
+        self._report = report
+        self._in_package_change = False
+        self._done = False
+        self._optdepend: Tuple[str, List[str]] = None
+    def feed(self, line: str) -> None:
+        if self._done:
+            return
+        if self._optdepend:
+            if _m := REGEX['s_optdepend_list'].match(line):
+                logger.debug(f'optdepend found {line=}')
+                self._optdepend[1].append(_m.groups()[0])
+                return
+            logger.debug(f'optdepend end {line=}')
+            self._end_optdepend()
         if REGEX['s_process_pkg_changes'].match(line):
-            in_package_change = True
-            ln += 1
-            continue
+            self._in_package_change = True
+            return
         elif REGEX['s_post-transaction'].match(line):
-            in_package_change = False
+            self._in_package_change = False
             # we don't care anything below this
             logger.debug(f'break {line=}')
-            break
-        if in_package_change:
+            self._done = True
+            return
+        if self._in_package_change:
             if _m := REGEX['s_optdepend'].match(line):
                 logger.debug(f'optdepend start {line=}')
-                pkg = _m.groups()[0]
-                optdeps = list()
-                while True:
-                    ln += 1
-                    line = stdout[ln]
-                    if _m := REGEX['s_optdepend_list'].match(line):
-                        logger.debug(f'optdepend found {line=}')
-                        optdeps.append(_m.groups()[0])
-                    else:
-                        logger.debug(f'optdepend end {line=}')
-                        ln -= 1
-                        break
-                report.info(f'new optional dependencies for {pkg}: {", ".join(optdeps)}')
+                self._optdepend = (_m.groups()[0], list())
             else:
                 logger.debug(f'stdout {line=} is unknown')
         else:
             logger.debug(f'skip {line=}')
-        ln += 1
+    def _end_optdepend(self) -> None:
+        pkg, optdeps = self._optdepend
+        self._optdepend = None
+        self._report.info(f'new optional dependencies for {pkg}: {", ".join(optdeps)}')
+    def close(self) -> None:
+        if self._optdepend:
+            self._end_optdepend()
+        self._done = True
 
-def _split_log_line(line: str) -> Tuple[int, str, str]:
-    (time, source, msg) = line.split(' ', maxsplit=2)
-    time: int = pacman_time_to_timestamp(time.strip('[]'))
-    source = source.strip('[]')
-    return (time, source, msg)
-def _log_parser(log: List[str], report: checkReport) -> None:
-    # preprocess
-    if log[-1] == '':
-        log = log[:-1]
-    nlog = list()
+def _stdout_parser(stdout: Iterable[str], report: checkReport) -> None:
+    parser = StdoutParser(report)
+    for line in stdout:
+        parser.feed(line)
+    parser.close()
+
+class LogRecord:
+    ''' a pacman.log entry, continuation lines already merged into message '''
+    __slots__ = ('offset', 'source', 'message', '_time', '_timestamp')
+    def __init__(self, offset: int, time: str, source: str, message: str) -> None:
+        self.offset = offset
+        self.source = source
+        self.message = message
+        self._time = time
+        self._timestamp = None
+    @property
+    def timestamp(self) -> int:
+        if self._timestamp is None:
+            self._timestamp = pacman_time_to_timestamp(self._time)
+        return self._timestamp
+    @property
+    def line(self) -> str:
+        ''' the entry as pacman.log has it, continuation lines joined '''
+        return f"[{self._time}] [{self.source}] {self.message}"
+    def __repr__(self) -> str:
+        return f"LogRecord({self.offset}, {self._time!r}, {self.source!r}, {self.message!r})"
+
+class LogTokenizer:
+    '''
+        turns pacman.log lines into LogRecord in a single pass,
+        a record is handed out once the next record starts or on flush
+    '''
+    def __init__(self, offset: int = 0) -> None:
+        self._offset = offset
+        self._pending: LogRecord = None
+    def feed(self, line: str) -> Union[LogRecord, None]:
+        offset = self._offset
+        self._offset += 1
+        if _m := LOG_LINE.match(line):
+            record, self._pending = self._pending, LogRecord(offset, *_m.groups())
+            return record
+        logger.debug(f"preprocess logs: should not be on a new line, {line=}")
+        assert self._pending
+        self._pending.message = f"{self._pending.message} {line}"
+        return None
+    def flush(self) -> Union[LogRecord, None]:
+        record, self._pending = self._pending, None
+        return record
+
+def tokenize_log(log: Iterable[str], offset: int = 0) -> Iterator[LogRecord]:
+    tokenizer = LogTokenizer(offset)
     for line in log:
+        if (record := tokenizer.feed(line)) is not None:
+            yield record
+    if (record := tokenizer.flush()) is not None:
+        yield record
+
+def _classify_alpm(msg: str) -> Tuple[Union[str, None], Union[Match, None]]:
+    ''' pick the REGEX candidates by the first word of an ALPM message '''
+    for key in ALPM_DISPATCH.get(msg.split(' ', 1)[0], ()):
+        if _m := REGEX[key].match(msg):
+            return (key, _m)
+    return (None, None)
+
+class LogParser:
+    '''
+        consumes LogRecord one by one, hook and scriptlet output is matched as it arrives
+        on_unmatched is called with ('hook' or 'package', name, message) for unknown output
+    '''
+    def __init__(self, report: checkReport, on_unmatched: Callable[[str, str, str], None] = None) -> None:
+        self._report = report
+        self._on_unmatched = on_unmatched
+        self._ln = -1
+        self._in_transaction = 0
+        self._prev: LogRecord = None
+        # ('hook', hook_name, matcher) or ('package', pkg, action, matcher)
+        self._block: tuple = None
+        # the record a block was started by and its last one
+        self._block_first: LogRecord = None
+        self._block_last: LogRecord = None
+    def feed(self, record: LogRecord) -> None:
+        self._ln += 1
         try:
-            _split_log_line(line)
-            nlog.append(line)
-        except Exception:
-            logger.debug(f"preprocess logs: should not be on a new line, {line=}")
-            assert nlog
-            nlog[-1] = f"{nlog[-1]} {line}"
-    log = nlog
-    ln = 0
-    in_transaction = 0
-    while ln < len(log):
-        line = log[ln]
-        (_, source, msg) = _split_log_line(line)
+            self._feed(record)
+        finally:
+            self._prev = record
+    def _feed(self, record: LogRecord) -> None:
+        report = self._report
+        ln = self._ln
+        source, msg = record.source, record.message
+        if self._block:
+            if source == 'ALPM-SCRIPTLET':
+                self._block_last = record
+                if self._block[0] == 'hook':
+                    _, hook_name, matcher = self._block
+                    if (r := matcher.match(msg)) is not None:
+                        logger.debug(f'hook output match {hook_name=} {msg=} {r=}')
+                    else:
+                        report.warn(f'hook {hook_name} says {msg}')
+                        if self._on_unmatched:
+                            self._on_unmatched('hook', hook_name, msg)
+                else:
+                    _, pkg, action, matcher = self._block
+                    if (r := matcher.match(msg)) is not None:
+                        logger.debug(f'.install output match {pkg=} {action=} {msg=} {r=}')
+                    else:
+                        report.warn(f'package {pkg} says {msg}')
+                        if self._on_unmatched:
+                            self._on_unmatched('package', pkg, msg)
+                return
+            logger.debug(f'{self._block[0]} end {self._block[1]} {msg=}')
+            self._end_block(record)
         if source == 'PACMAN':
             pass # nothing concerning here
         elif source == 'ALPM':
-            if _m := REGEX['l_upgrade'].match(msg):
+            kind, _m = _classify_alpm(msg)
+            if kind == 'l_upgrade':
                 report.change(*(_m.groups()))
-            elif _m := REGEX['l_install'].match(msg):
+            elif kind == 'l_install':
                 name, new = _m.groups()
                 report.change(name, None, new)
-            elif _m := REGEX['l_remove'].match(msg):
+            elif kind == 'l_remove':
                 name, old = _m.groups()
                 report.change(name, old, None)
-            elif _m := REGEX['l_downgrade'].match(msg):
+            elif kind == 'l_downgrade':
                 name, old, new = _m.groups()
                 report.warn(f"downgrade {name} from {old} to {new}")
-            elif _m := REGEX['l_reinstall'].match(msg):
+            elif kind == 'l_reinstall':
                 name, new = _m.groups()
                 report.warn(f"reinstall {name} {new}")
-            elif REGEX['l_transaction_start'].match(msg):
+            elif kind == 'l_transaction_start':
                 logger.debug('transaction_start')
-                if in_transaction == 0:
-                    in_transaction = 1
+                if self._in_transaction == 0:
+                    self._in_transaction = 1
                 else:
                     report.crit(f'{ln=} duplicate transaction_start')
-            elif REGEX['l_transaction_complete'].match(msg):
+            elif kind == 'l_transaction_complete':
                 logger.debug('transaction_complete')
-                if in_transaction == 1:
-                    in_transaction = 2
+                if self._in_transaction == 1:
+                    self._in_transaction = 2
                 else:
-                    report.crit(f'{ln=} transaction_complete while {in_transaction=}')
-            elif _m := REGEX['l_pacnew'].match(msg):
+                    report.crit(f'{ln=} transaction_complete while in_transaction={self._in_transaction}')
+            elif kind == 'l_pacnew':
                 orig, _ = _m.groups()
                 if orig in IGNORED_PACNEW:
                     logger.debug(f'pacnew ignored for {orig}')
                 else:
                     report.warn(f'please merge pacnew for {orig}')
-            elif _m := REGEX['l_running_hook'].match(msg):
+            elif kind == 'l_running_hook':
                 hook_name = _m.groups()[0]
                 logger.debug(f'hook start {hook_name=}')
-                while True:
-                    ln += 1
-                    if ln >= len(log):
-                        logger.debug(f'hook end {hook_name=} {msg=}')
-                        ln -= 1
-                        break
-                    line = log[ln]
-                    (_, source, msg) = _split_log_line(line)
-                    if source == 'ALPM-SCRIPTLET':
-                        for r in (*(KNOWN_HOOK_OUTPUT.get('', [])), *(KNOWN_HOOK_OUTPUT.get(hook_name, []))):
-                            if match(r, msg):
-                                logger.debug(f'hook output match {hook_name=} {msg=} {r=}')
-                                break
-                        else:
-                            report.warn(f'hook {hook_name} says {msg}')
-                    else:
-                        logger.debug(f'hook end {hook_name=} {msg=}')
-                        ln -= 1
-                        break
+                # the rules come with known_output and the override, only needed once there is output to check
+                from pacroller.matcher import hook_matcher
+                self._block = ('hook', hook_name, hook_matcher(hook_name))
+                self._block_first = self._block_last = record
             else:
                 report.crit(f'[NOM-ALPM] {msg}')
         elif source == 'ALPM-SCRIPTLET':
-            (_sourcem1, _, _pmsg) = _split_log_line(log[ln-1])
-            for action in {'upgrade', 'install', 'remove', 'downgrade', 'reinstall'}:
-                if _m := REGEX[f"l_{action}"].match(_pmsg):
-                    pkg, *_ = _m.groups()
-                    break
-            else:
+            _pmsg = self._prev.message if self._prev else ''
+            kind, _m = _classify_alpm(_pmsg)
+            if (action := SCRIPTLET_ACTIONS.get(kind)) is None:
                 report.crit(f'[NOM-SCRIPTLET] {msg} {_pmsg}')
-                ln += 1
-                action = 'unknown'
-                continue
+                return
+            pkg = _m.groups()[0]
             logger.debug(f'.install start {pkg=} {action=}')
-            while True:
-                line = log[ln]
-                (_, source, msg) = _split_log_line(line)
-                if source == 'ALPM-SCRIPTLET':
-                    for r in (*(KNOWN_PACKAGE_OUTPUT.get('', [])), *(KNOWN_PACKAGE_OUTPUT.get(pkg, []))):
-                        if isinstance(r, dict):
-                            if action in r.get('action'):
-                                if match(r.get('regex'), msg):
-                                    logger.debug(f'.install output match {pkg=} {action=} {msg=} {r=}')
-                                    break
-                        else:
-                            if match(r, msg):
-                                logger.debug(f'.install output match {pkg=} {msg=} {r=}')
-                                break
-                    else:
-                        report.warn(f'package {pkg} says {msg}')
-                else:
-                    logger.debug(f'.install end {pkg=} {msg=}')
-                    ln -= 1
-                    break
-                ln += 1
+            from pacroller.matcher import package_matcher
+            self._block = ('package', pkg, action, package_matcher(pkg, action))
+            # the scriptlet starts right after pacman logged the change it belongs to
+            self._block_first = self._prev
+            self._feed(record)
         else:
+            line = record.line
             report.crit(f'{line=} has unknown source')
-        ln += 1
+    def _end_block(self, following: LogRecord = None) -> None:
+        '''
+            a hook lasts until the next hook starts, a scriptlet or the last hook until its last line of output,
+            whatever follows them may be another package being unpacked or another pacman run
+        '''
+        kind, name = self._block[0], self._block[1]
+        first, last = self._block_first, self._block_last
+        if kind == 'hook' and following is not None and following.source == 'ALPM' and \
+           _classify_alpm(following.message)[0] == 'l_running_hook':
+            last = following
+        self._block = self._block_first = self._block_last = None
+        try:
+            seconds = last.timestamp - first.timestamp
+        except ValueError:
+            # a timestamp pacman did not write
+            return
+        self._report.cost('hooks' if kind == 'hook' else 'scriptlets', name, max(seconds, 0))
+    def close(self) -> None:
+        ''' ends the block still open at the end of the log '''
+        if self._block:
+            self._end_block()
+
+def _log_parser(log: List[str], report: checkReport) -> None:
+    if log and log[-1] == '':
+        log = log[:-1]
+    parser = LogParser(report)
+    for record in tokenize_log(log):
+        parser.feed(record)
+    parser.close()
+
+class StreamChecker:
+    '''
+        checks pacman stdout and the pacman.log tail while pacman is running,
+        the report is complete once finish returns
+    '''
+    def __init__(self, log_file: str, log_anchor: int, on_crit: Callable[[str], None] = None) -> None:
+        self.report = checkReport()
+        self.error: Exception = None
+        self._stdout = StdoutParser(self.report)
+        self._log = LogParser(self.report)
+        self._tokenizer = LogTokenizer()
+        self._tail = LogTail(log_file, log_anchor)
+        self._on_crit = on_crit
+        self._crit_seen = 0
+    def _guarded(self, func: Callable, *args) -> None:
+        if self.error:
+            return
+        try:
+            func(*args)
+        except Exception as e:
+            logger.exception('streaming checker has crashed')
+            self.error = e
+            return
+        if self._on_crit and len(self.report._crit) > self._crit_seen:
+            for text in self.report._crit[self._crit_seen:]:
+                self._on_crit(text)
+            self._crit_seen = len(self.report._crit)
+    def _feed_log(self, lines: List[str]) -> None:
+        for line in lines:
+            if (record := self._tokenizer.feed(line)) is not None:
+                self._log.feed(record)
+    def feed_stdout(self, line: str) -> None:
+        self._guarded(self._stdout.feed, line)
+    def poll_log(self) -> None:
+        self._guarded(lambda: self._feed_log(self._tail.read_lines()))
+    def finish(self) -> checkReport:
+        def _finish() -> None:
+            self._stdout.close()
+            self._feed_log(self._tail.read_lines(final=True))
+            if (record := self._tokenizer.flush()) is not None:
+                self._log.feed(record)
+            self._log.close()
+        self._guarded(_finish)
+        self.close()
+        return self.report
+    def close(self) -> None:
+        ''' lets go of pacman.log without checking the rest, finish does it too '''
+        self._tail.close()
 
 def sync_err_is_net(output: str) -> bool:
     ''' check if a sync failure is caused by network '''
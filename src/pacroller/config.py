@@ -1,9 +1,11 @@
 import json
+import re
 from pathlib import Path
 import importlib.util
 from base64 import b64decode
 import sys
-from typing import Any
+from functools import cache
+from typing import Any, Callable, Dict
 
 CONFIG_DIR = Path('/etc/pacroller')
 CONFIG_FILE = 'config.json'
@@ -12,39 +14,34 @@ CONFIG_FILE_TG = 'telegram.json'
 F_KNOWN_OUTPUT_OVERRIDE = 'known_output_override.py'
 LIB_DIR = Path('/var/lib/pacroller')
 DB_FILE = 'db'
+STATUS_DB_FILE = 'status.sqlite'
 NEWS_FILE = 'news'
+INDEX_FILE = 'log_index'
+PREFETCH_FILE = 'prefetch'
+MIRRORS_FILE = 'mirrors.json'
+FASTPATH_FILE = 'fastpath.json'
+RULES_FILE = 'rules.json'
+OUTBOX_DIR = 'outbox'
 DEF_HTTP_HDRS = {'User-Agent': 'Mozilla/5.0 (compatible; Pacroller/0.1; +https://github.com/isjerryxiao/pacroller)'}
 LOG_DIR = Path('/var/log/pacroller')
 PACMAN_CONFIG = '/etc/pacman.conf'
 PACMAN_LOG = '/var/log/pacman.log'
 PACMAN_PKG_DIR = '/var/cache/pacman/pkg'
 PACMAN_DB_LCK = '/var/lib/pacman/db.lck'
-assert LIB_DIR.is_dir()
 
-if (cfg := (CONFIG_DIR / CONFIG_FILE)).exists():
-    _config: dict = json.loads(cfg.read_text())
-else:
-    _config = dict()
+# everything below is read and checked the first time one of its names is imported
 
-if (smtp_cfg := (CONFIG_DIR / CONFIG_FILE_SMTP)).exists():
+@cache
+def _read_json(name: str) -> dict:
+    if not (cfg := (CONFIG_DIR / name)).exists():
+        return dict()
     try:
-        _smtp_cfg_text = smtp_cfg.read_text()
+        text = cfg.read_text()
     except PermissionError:
-        _smtp_config = dict()
-    else:
-        _smtp_config: dict = json.loads(_smtp_cfg_text)
-else:
-    _smtp_config = dict()
-
-if (tg_cfg := (CONFIG_DIR / CONFIG_FILE_TG)).exists():
-    try:
-        _tg_cfg_text = tg_cfg.read_text()
-    except PermissionError:
-        _tg_config = dict()
-    else:
-        _tg_config: dict = json.loads(_tg_cfg_text)
-else:
-    _tg_config = dict()
+        if name == CONFIG_FILE:
+            raise
+        return dict()
+    return json.loads(text)
 
 def _import_module(fpath: Path) -> Any:
     spec = importlib.util.spec_from_file_location(str(fpath).removesuffix('.py').replace('/', '.'), fpath)
@@ -54,64 +51,117 @@ def _import_module(fpath: Path) -> Any:
     spec.loader.exec_module(mod)
     sys.dont_write_bytecode = _wbc
     return mod
-if (_komf := (CONFIG_DIR / F_KNOWN_OUTPUT_OVERRIDE)).exists():
-    _kom = _import_module(_komf.resolve())
-    KNOWN_OUTPUT_OVERRIDE = (_kom.KNOWN_HOOK_OUTPUT, _kom.KNOWN_PACKAGE_OUTPUT)
-else:
-    KNOWN_OUTPUT_OVERRIDE = (dict(), dict())
-
-TIMEOUT = int(_config.get('timeout', 300))
-UPGRADE_TIMEOUT = int(_config.get('upgrade_timeout', 3600))
-NETWORK_RETRY = int(_config.get('network_retry', 5))
-assert TIMEOUT > 0 and UPGRADE_TIMEOUT > 0 and NETWORK_RETRY > 0
-
-CUSTOM_SYNC = bool(_config.get('custom_sync', False))
-SYNC_SH = CONFIG_DIR / str(_config.get('sync_shell', "sync.sh"))
-if CUSTOM_SYNC:
-    assert SYNC_SH.exists()
-
-EXTRA_SAFE = bool(_config.get('extra_safe', False))
-SHELL = str(_config.get('shell', '/bin/bash'))
-SAVE_STDOUT = bool(_config.get('save_stdout', True))
-
-HOLD = _config.get('hold', dict())
-for (k, v)  in HOLD.items():
-    assert isinstance(k, str) and isinstance(v, str)
-
-IGNORED_PACNEW = _config.get('ignored_pacnew', list())
-for i in IGNORED_PACNEW:
-    assert isinstance(i, str)
-
-NEEDRESTART = bool(_config.get('need_restart', False))
-NEEDRESTART_CMD = _config.get('need_restart_cmd', ["needrestart", "-r", "a", "-m", "a", "-l"])
-for i in NEEDRESTART_CMD:
-    assert isinstance(i, str)
-
-SYSTEMD = bool(_config.get('systemd-check', True))
-NEWS = bool(_config.get('news-check', True))
-PACMAN_SCC = bool(_config.get('clear_pkg_cache', False))
-
-SMTP_ENABLED = bool(_smtp_config.get('enabled', False))
-SMTP_SSL = bool(_smtp_config.get('ssl', True))
-SMTP_HOST = _smtp_config.get('host', "")
-SMTP_PORT = int(_smtp_config.get('port', 0))
-SMTP_FROM = _smtp_config.get('from', "")
-SMTP_TO = _smtp_config.get('to', "")
-SMTP_AUTH = dict(_smtp_config.get('auth', {}))
-if SMTP_ENABLED:
-    assert SMTP_HOST
-    assert SMTP_FROM
-    assert SMTP_TO
-    assert 0 <= SMTP_PORT <= 65536
-    if SMTP_AUTH:
-        assert SMTP_AUTH['username']
-        if _smtp_auth_b64 := SMTP_AUTH.get('password_base64', ''):
-            SMTP_AUTH['password'] = b64decode(_smtp_auth_b64).decode('utf-8')
-            SMTP_AUTH.pop('password_base64')
-        assert SMTP_AUTH['password']
-        SMTP_AUTH = {k:v for k, v in SMTP_AUTH.items() if k in {'username', 'password'}}
-
-TG_ENABLED = bool(_tg_config.get('enabled', False))
-TG_BOT_TOKEN = _tg_config.get('bot_token', "")
-TG_API_HOST = _tg_config.get('api_host', 'api.telegram.org')
-TG_RECIPIENT = _tg_config.get('recipient', "")
+
+def _known_output() -> Dict[str, Any]:
+    if (_komf := (CONFIG_DIR / F_KNOWN_OUTPUT_OVERRIDE)).exists():
+        _kom = _import_module(_komf.resolve())
+        KNOWN_OUTPUT_OVERRIDE = (_kom.KNOWN_HOOK_OUTPUT, _kom.KNOWN_PACKAGE_OUTPUT)
+    else:
+        KNOWN_OUTPUT_OVERRIDE = (dict(), dict())
+    return locals()
+
+def _main() -> Dict[str, Any]:
+    _config = _read_json(CONFIG_FILE)
+    TIMEOUT = int(_config.get('timeout', 300))
+    UPGRADE_TIMEOUT = int(_config.get('upgrade_timeout', 3600))
+    NETWORK_RETRY = int(_config.get('network_retry', 5))
+    assert TIMEOUT > 0 and UPGRADE_TIMEOUT > 0 and NETWORK_RETRY > 0
+    RETRY_BACKOFF = float(_config.get('retry_backoff', 10))
+    assert RETRY_BACKOFF >= 0
+    NOTIFY_DEADLINE = float(_config.get('notification_deadline', 120))
+    assert NOTIFY_DEADLINE > 0
+    NOTIFY_OUTBOX = bool(_config.get('notification_outbox', False))
+
+    CUSTOM_SYNC = bool(_config.get('custom_sync', False))
+    SYNC_SH = CONFIG_DIR / str(_config.get('sync_shell', "sync.sh"))
+    if CUSTOM_SYNC:
+        assert SYNC_SH.exists()
+
+    SYNC_MIRRORS = int(_config.get('sync_mirrors', 0))
+    assert SYNC_MIRRORS >= 0
+    FAST_PATH = bool(_config.get('fast_path', False))
+
+    EXTRA_SAFE = bool(_config.get('extra_safe', False))
+    SHELL = str(_config.get('shell', '/bin/bash'))
+    SAVE_STDOUT = bool(_config.get('save_stdout', True))
+
+    HOLD = _config.get('hold', dict())
+    for (k, v)  in HOLD.items():
+        assert isinstance(k, str) and isinstance(v, str)
+    HOLD = {k: re.compile(v) for (k, v) in HOLD.items()}
+
+    QUESTION_KINDS = ('install_ignorepkg', 'replace', 'conflict', 'corrupted', 'remove_pkgs', 'select_provider', 'import_key')
+    QUESTION_POLICY = _config.get('question_policy', dict())
+    for (k, v) in QUESTION_POLICY.items():
+        assert k in QUESTION_KINDS and v in ('yes', 'no', 'fail')
+
+    IGNORED_PACNEW = _config.get('ignored_pacnew', list())
+    for i in IGNORED_PACNEW:
+        assert isinstance(i, str)
+
+    NEEDRESTART = bool(_config.get('need_restart', False))
+    NEEDRESTART_CMD = _config.get('need_restart_cmd', ["needrestart", "-r", "a", "-m", "a", "-l"])
+    for i in NEEDRESTART_CMD:
+        assert isinstance(i, str)
+
+    PREFETCH_RETRY = int(_config.get('prefetch_retry', NETWORK_RETRY))
+    PREFETCH_MAX_AGE = float(_config.get('prefetch_max_age', 24))
+    assert PREFETCH_RETRY > 0 and PREFETCH_MAX_AGE > 0
+
+    SYSTEMD = bool(_config.get('systemd-check', True))
+    NEWS = bool(_config.get('news-check', True))
+    PACMAN_SCC = bool(_config.get('clear_pkg_cache', False))
+    DB_RETENTION_DAYS = int(_config.get('db_retention_days', 0))
+    assert DB_RETENTION_DAYS >= 0
+    METRICS_FILE = str(_config.get('metrics_file', ''))
+    METRICS_FILE = Path(METRICS_FILE) if METRICS_FILE else None
+    if METRICS_FILE:
+        assert METRICS_FILE.is_absolute() and METRICS_FILE.suffix == '.prom'
+    return locals()
+
+def _smtp() -> Dict[str, Any]:
+    _smtp_config = _read_json(CONFIG_FILE_SMTP)
+    SMTP_ENABLED = bool(_smtp_config.get('enabled', False))
+    SMTP_SSL = bool(_smtp_config.get('ssl', True))
+    SMTP_HOST = _smtp_config.get('host', "")
+    SMTP_PORT = int(_smtp_config.get('port', 0))
+    SMTP_FROM = _smtp_config.get('from', "")
+    SMTP_TO = _smtp_config.get('to', "")
+    SMTP_AUTH = dict(_smtp_config.get('auth', {}))
+    if SMTP_ENABLED:
+        assert SMTP_HOST
+        assert SMTP_FROM
+        assert SMTP_TO
+        assert 0 <= SMTP_PORT <= 65536
+        if SMTP_AUTH:
+            assert SMTP_AUTH['username']
+            if _smtp_auth_b64 := SMTP_AUTH.get('password_base64', ''):
+                SMTP_AUTH['password'] = b64decode(_smtp_auth_b64).decode('utf-8')
+                SMTP_AUTH.pop('password_base64')
+            assert SMTP_AUTH['password']
+            SMTP_AUTH = {k:v for k, v in SMTP_AUTH.items() if k in {'username', 'password'}}
+    return locals()
+
+def _tg() -> Dict[str, Any]:
+    _tg_config = _read_json(CONFIG_FILE_TG)
+    TG_ENABLED = bool(_tg_config.get('enabled', False))
+    TG_BOT_TOKEN = _tg_config.get('bot_token', "")
+    TG_API_HOST = _tg_config.get('api_host', 'api.telegram.org')
+    TG_RECIPIENT = _tg_config.get('recipient', "")
+    return locals()
+
+_LAZY: Dict[str, Callable[[], Dict[str, Any]]] = dict()
+for _loader, _names in ((_known_output, ('KNOWN_OUTPUT_OVERRIDE',)),
+                        (_main, tuple(_main.__code__.co_varnames)),
+                        (_smtp, tuple(_smtp.__code__.co_varnames)),
+                        (_tg, tuple(_tg.__code__.co_varnames))):
+    for _name in _names:
+        if _name.isupper():
+            _LAZY[_name] = _loader
+
+def __getattr__(name: str) -> Any:
+    if (loader := _LAZY.get(name)) is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    values = {k: v for k, v in loader().items() if k.isupper()}
+    globals().update(values)
+    return values[name]
@@ -0,0 +1,167 @@
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from time import time
+from typing import Iterator, Union
+from pacroller.config import LIB_DIR, DB_FILE, STATUS_DB_FILE
+from pacroller.utils import back_readline_bytes
+
+logger = logging.getLogger()
+
+SCHEMA_VERSION = 3
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date INTEGER,
+    error TEXT,
+    has_report INTEGER NOT NULL,
+    info TEXT,
+    warn TEXT,
+    crit TEXT,
+    changes TEXT,
+    timings TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_date ON entries (date);
+CREATE INDEX IF NOT EXISTS entries_report ON entries (id) WHERE has_report;
+'''
+REPORT_COLUMNS = ('info', 'warn', 'crit', 'changes')
+# compact only rewrites the file once this share of it is free pages
+VACUUM_FREE_SHARE = 0.25
+
+class StatusDB:
+    '''
+        status history in sqlite, newest entries first,
+        the json-lines file of earlier versions is imported on first use
+    '''
+    def __init__(self, path: Path = LIB_DIR / STATUS_DB_FILE, legacy: Path = LIB_DIR / DB_FILE) -> None:
+        self.path = path
+        self.legacy = legacy
+        self._conn: sqlite3.Connection = None
+        self._timings_column = 'timings'
+        try:
+            self._conn = self._connect()
+        except sqlite3.OperationalError as e:
+            # not allowed to create or migrate, e.g. status as a normal user
+            try:
+                self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+                self._conn.execute('SELECT 1 FROM entries LIMIT 1')
+                if self._conn.execute('PRAGMA user_version').fetchone()[0] < 2:
+                    # not migrated yet, nobody timed those reports
+                    self._timings_column = 'NULL'
+            except sqlite3.OperationalError:
+                logger.debug(f'unable to open {path}: {e}, reading {legacy} instead')
+                self._conn = None
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        migrated = False
+        if version < SCHEMA_VERSION:
+            with conn:
+                conn.execute('BEGIN')
+                if version == 1:
+                    conn.execute('ALTER TABLE entries ADD COLUMN timings TEXT')
+                if version in (1, 2):
+                    # nothing ever queried them
+                    conn.execute('DROP INDEX IF EXISTS entries_error')
+                    conn.execute('ALTER TABLE entries DROP COLUMN failed')
+                for statement in filter(str.strip, SCHEMA.split(';')):
+                    conn.execute(statement)
+                if version == 0:
+                    migrated = self._migrate(conn)
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            if migrated:
+                self.legacy.rename(self.legacy.with_name(f"{self.legacy.name}.migrated"))
+        return conn
+    def _migrate(self, conn: sqlite3.Connection) -> bool:
+        '''
+            error-only lines of the legacy file carry no date, the last line was written when the file
+            was last modified, the others are left undated rather than given a neighbour's
+        '''
+        if not self.legacy.exists():
+            return False
+        mtime = self.legacy.stat().st_mtime
+        with open(self.legacy, 'r') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        for n, entry in enumerate(entries, 1):
+            report = entry.get('report')
+            date = (report or entry).get('date')
+            if date is None and n == len(entries):
+                date = mtime
+            self._insert(conn, entry.get('error'), report, date)
+        logger.info(f'migrated {len(entries)} entries from {self.legacy} to {self.path}')
+        return True
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, error: Union[str, None], report: Union[dict, None], date: Union[int, None]) -> None:
+        conn.execute(
+            'INSERT INTO entries (date, error, has_report, info, warn, crit, changes, timings) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (None if date is None else int(date), error, report is not None,
+             *(json.dumps(report.get(k, [])) if report is not None else None for k in REPORT_COLUMNS),
+             json.dumps(report['timings']) if report and report.get('timings') else None)
+        )
+    def write(self, error: Union[str, None], report: Union[dict, None]) -> None:
+        if self._conn is None:
+            raise sqlite3.OperationalError(f'{self.path} could not be opened for writing')
+        self._insert(self._conn, error, report, report.get('date') if report else time())
+    def _legacy_entries(self) -> Iterator[dict]:
+        if not self.legacy.exists():
+            return
+        with open(self.legacy, 'rb') as db:
+            for line in back_readline_bytes(db):
+                if line:
+                    yield json.loads(line)
+    def entries(self, limit: int = None, reports_only: bool = False) -> Iterator[dict]:
+        ''' {'error': ..., 'report': ...} dicts, newest first '''
+        if self._conn is None:
+            count = 0
+            for entry in self._legacy_entries():
+                if reports_only and not entry.get('report'):
+                    continue
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield entry
+            return
+        query = f"SELECT error, has_report, date, {self._timings_column}, {', '.join(REPORT_COLUMNS)} FROM entries"
+        if reports_only:
+            query += ' WHERE has_report'
+        query += ' ORDER BY id DESC'
+        params = ()
+        if limit is not None:
+            query += ' LIMIT ?'
+            params = (limit,)
+        for error, has_report, date, timings, *columns in self._conn.execute(query, params):
+            report = None
+            if has_report:
+                report = {k: json.loads(v) for k, v in zip(REPORT_COLUMNS, columns)}
+                report['date'] = date
+                report['timings'] = json.loads(timings) if timings else dict()
+            yield {'error': error, 'report': report}
+    def last_error(self) -> Union[str, None]:
+        if self._conn is None:
+            for entry in self._legacy_entries():
+                return entry.get('error')
+            return None
+        row = self._conn.execute('SELECT error FROM entries ORDER BY id DESC LIMIT 1').fetchone()
+        return row[0] if row else None
+    def compact(self, retention_days: int) -> None:
+        '''
+            drop entries older than retention_days, the latest entry is always kept,
+            an undated entry goes once a dated one after it does
+        '''
+        if retention_days <= 0:
+            return
+        deadline = time() - retention_days * 86400
+        expired = self._conn.execute('SELECT MAX(id) FROM entries WHERE date < ?', (deadline,)).fetchone()[0] or 0
+        deleted = self._conn.execute(
+            'DELETE FROM entries WHERE (date < ? OR date IS NULL AND id < ?) AND id != (SELECT MAX(id) FROM entries)',
+            (deadline, expired)
+        ).rowcount
+        if deleted:
+            logger.debug(f'removed {deleted} entries older than {retention_days} days from {self.path}')
+            free, pages = (self._conn.execute(f'PRAGMA {pragma}').fetchone()[0] for pragma in ('freelist_count', 'page_count'))
+            # sqlite reuses free pages for new entries, rewriting the whole file every run is not worth it
+            if free > pages * VACUUM_FREE_SHARE:
+                logger.debug(f'{free} of {pages} pages of {self.path} are free, vacuuming')
+                self._conn.execute('VACUUM')
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from os import uname
+from pathlib import Path
+from time import time
+from typing import Dict, Union
+from pacroller.config import LIB_DIR, FASTPATH_FILE, PACMAN_CONFIG
+from pacroller.mirrors import MirrorStats, Repo, fetch_url, parse_pacman_conf
+
+logger = logging.getLogger()
+
+VALIDATORS = ('last-modified', 'etag', 'content-length')
+
+class FastPath:
+    '''
+        validators of every sync database from the last run that had nothing to do,
+        a run that finds the local databases untouched and gets 304 for all of them can stop right away
+    '''
+    def __init__(self, path: Path = LIB_DIR / FASTPATH_FILE, config: str = PACMAN_CONFIG, timeout: float = 10) -> None:
+        self.path = path
+        self.timeout = timeout
+        try:
+            self.options, self.repos = parse_pacman_conf(config)
+        except OSError as e:
+            logger.warning(f'fast path disabled, unable to read {config}: {e}')
+            self.options, self.repos = dict(), list()
+        arch = self.options.get('Architecture', 'auto').split()[0]
+        self.arch = uname().machine if arch == 'auto' else arch
+        self.dbpath = Path(self.options.get('DBPath', '/var/lib/pacman/'))
+        self.fingerprint: Union[dict, None] = None
+        self.taken = 0
+        self.runs = 0
+        self.since = time()
+        try:
+            state = json.loads(path.read_text())
+            self.fingerprint, self.taken, self.runs, self.since = \
+                state['fingerprint'], state['taken'], state['runs'], state['since']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'ignoring unreadable fast path state {path}: {e}')
+    def save(self) -> None:
+        try:
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps({'fingerprint': self.fingerprint, 'taken': self.taken,
+                                       'runs': self.runs, 'since': self.since}))
+            tmp.replace(self.path)
+        except OSError as e:
+            logger.warning(f'unable to save fast path state to {self.path}: {e}')
+    def _local(self) -> Dict[str, list]:
+        ''' what a sync or a transaction would touch, [mtime, size] '''
+        ret = dict()
+        for name, path in [('local', self.dbpath / 'local'),
+                           *((repo.name, self.dbpath / 'sync' / f"{repo.name}.db") for repo in self.repos)]:
+            st = path.stat()
+            ret[name] = [st.st_mtime_ns, st.st_size]
+        return ret
+    async def _head(self, repo: Repo, server: str, validators: Dict[str, str] = None) -> Dict[str, str]:
+        url = f"{server.replace('$repo', repo.name).replace('$arch', self.arch).rstrip('/')}/{repo.name}.db"
+        headers = dict()
+        if validators and (etag := validators.get('etag')):
+            headers['If-None-Match'] = etag
+        if validators and (modified := validators.get('last-modified')):
+            headers['If-Modified-Since'] = modified
+        result = await fetch_url(url, None, headers, method='HEAD')
+        return {'server': server, 'status': result.status,
+                **{k: result.headers[k] for k in VALIDATORS if k in result.headers}}
+    async def record(self) -> None:
+        ''' right after a sync that had nothing to do, never fatal '''
+        try:
+            if not self.repos:
+                raise ValueError('no repositories')
+            stats = MirrorStats()
+            async with asyncio.timeout(self.timeout):
+                upstream = await asyncio.gather(*(self._head(repo, stats.rank(repo.servers)[0]) for repo in self.repos))
+            local = self._local()
+            for repo, now in zip(self.repos, upstream):
+                if now['status'] != 200:
+                    raise ValueError(f"{repo.name}: http {now['status']} from {now['server']}")
+                # the mirror moved on between our sync and now, the fingerprint would hide that
+                if (modified := now.get('last-modified')) and \
+                   parsedate_to_datetime(modified).timestamp() > local[repo.name][0] / 1e9 + 1:
+                    raise ValueError(f"{repo.name}: {now['server']} is newer than the local database")
+            self.fingerprint = {'local': local, 'upstream': dict(zip((r.name for r in self.repos), upstream))}
+            logger.debug(f'fast path fingerprint {self.fingerprint}')
+        except Exception as e:
+            logger.debug(f'unable to record fast path fingerprint: {e!r}')
+            self.fingerprint = None
+        self.save()
+    async def unchanged(self) -> bool:
+        ''' counts the run, true if nothing changed locally or upstream since the fingerprint was taken '''
+        self.runs += 1
+        try:
+            if self.fingerprint is None or not self.repos:
+                return False
+            if self._local() != self.fingerprint['local']:
+                logger.debug('fast path: local databases changed')
+                return False
+            upstream = self.fingerprint['upstream']
+            if set(r.name for r in self.repos) != set(upstream):
+                logger.debug('fast path: repositories changed')
+                return False
+            async with asyncio.timeout(self.timeout):
+                answers = await asyncio.gather(*(self._head(repo, upstream[repo.name]['server'], upstream[repo.name])
+                                                 for repo in self.repos))
+            for repo, now in zip(self.repos, answers):
+                before = upstream[repo.name]
+                if now['status'] == 304:
+                    continue
+                if now['status'] != 200 or any(now.get(k) != before.get(k) for k in VALIDATORS):
+                    logger.debug(f'fast path: {repo.name} changed upstream {before=} {now=}')
+                    return False
+            self.taken += 1
+            return True
+        except Exception as e:
+            logger.debug(f'fast path not taken: {e!r}')
+            return False
+        finally:
+            self.save()
+    def summary(self) -> str:
+        return f"fast path taken {self.taken} of {self.runs} runs since {datetime.fromtimestamp(self.since).strftime('%c')}"
@@ -0,0 +1,127 @@
+import json
+import logging
+from bisect import bisect_left, bisect_right
+from hashlib import sha1
+from io import DEFAULT_BUFFER_SIZE
+from os import fstat
+from pathlib import Path
+from typing import List, Sequence, Tuple
+from pacroller.config import LIB_DIR, INDEX_FILE
+from pacroller.utils import pacman_time_to_timestamp
+
+logger = logging.getLogger()
+
+TRANSACTION_START = b'] [ALPM] transaction started\n'
+HEAD_SIZE = 4096
+INDEX_VERSION = 1
+
+class TransactionIndex:
+    '''
+        byte offsets and timestamps of every "transaction started" in a pacman.log,
+        persisted in LIB_DIR and extended incrementally from the last indexed offset,
+        the clock may have gone back between transactions, bisection is only used while it did not
+    '''
+    def __init__(self, log_file: str, index_file: Path = LIB_DIR / INDEX_FILE) -> None:
+        self.log_file = str(Path(log_file).resolve())
+        self.index_file = index_file
+        self.offsets: List[int] = list()
+        self.times: List[float] = list()
+        self.end = 0
+        self.ordered = True
+        self._dev = self._ino = None
+        self._head = ''
+        self._head_size = 0
+    def __len__(self) -> int:
+        return len(self.offsets)
+    def _load(self) -> None:
+        try:
+            entry = json.loads(self.index_file.read_text()).get(self.log_file)
+        except (OSError, ValueError):
+            return
+        if not entry or entry.get('version') != INDEX_VERSION:
+            return
+        self.offsets, self.times, self.end = entry['offsets'], entry['times'], entry['end']
+        self._dev, self._ino = entry['dev'], entry['ino']
+        self._head, self._head_size = entry['head'], entry['head_size']
+    def _save(self) -> None:
+        try:
+            try:
+                entries = json.loads(self.index_file.read_text())
+            except (OSError, ValueError):
+                entries = dict()
+            entries[self.log_file] = {
+                'version': INDEX_VERSION, 'dev': self._dev, 'ino': self._ino,
+                'head': self._head, 'head_size': self._head_size,
+                'end': self.end, 'offsets': self.offsets, 'times': self.times,
+            }
+            tmp = self.index_file.with_name(f"{self.index_file.name}.tmp")
+            tmp.write_text(json.dumps(entries))
+            tmp.replace(self.index_file)
+        except OSError as e:
+            logger.debug(f'unable to save transaction index to {self.index_file}: {e}')
+    def _reset(self) -> None:
+        self.offsets, self.times, self.end = list(), list(), 0
+    def update(self) -> None:
+        self._load()
+        changed = False
+        with open(self.log_file, 'rb') as f:
+            st = fstat(f.fileno())
+            head = f.read(HEAD_SIZE)
+            if (st.st_dev, st.st_ino) != (self._dev, self._ino) or st.st_size < self.end or \
+               sha1(head[:self._head_size]).hexdigest() != self._head:
+                if self.end:
+                    logger.debug(f'{self.log_file} was rotated or truncated, rebuilding index')
+                self._reset()
+                self._dev, self._ino = st.st_dev, st.st_ino
+                changed = True
+            if len(head) > self._head_size:
+                self._head_size = len(head)
+                self._head = sha1(head).hexdigest()
+                changed = True
+            if st.st_size > self.end:
+                changed = self._scan(f) or changed
+        if changed:
+            self._save()
+        self.ordered = all(a <= b for a, b in zip(self.times, self.times[1:]))
+    def _scan(self, f) -> bool:
+        f.seek(self.end)
+        base = self.end
+        buf = b''
+        while chunk := f.read(DEFAULT_BUFFER_SIZE * 128):
+            buf += chunk
+            if (last_nl := buf.rfind(b'\n')) < 0:
+                continue
+            pos = 0
+            while (hit := buf.find(TRANSACTION_START, pos, last_nl + 1)) >= 0:
+                start = buf.rfind(b'\n', 0, hit) + 1
+                self.offsets.append(base + start)
+                self.times.append(self._timestamp(buf[start+1:buf.find(b']', start)]))
+                pos = hit + len(TRANSACTION_START)
+            base += last_nl + 1
+            buf = buf[last_nl+1:]
+        moved = base != self.end
+        self.end = base
+        return moved
+    def _timestamp(self, stime: bytes) -> float:
+        try:
+            return pacman_time_to_timestamp(stime.decode('utf-8'))
+        except ValueError:
+            # keep the list sorted for bisection
+            return self.times[-1] if self.times else 0
+    def span(self, i: int) -> Tuple[int, int]:
+        ''' byte range of transaction i, up to the next transaction '''
+        return (self.offsets[i], self.offsets[i+1] if i + 1 < len(self.offsets) else self.end)
+    def between(self, since: float = None, until: float = None) -> Sequence[int]:
+        ''' indexes of transactions started within [since, until], in log order '''
+        if not self.ordered:
+            return [i for i, t in enumerate(self.times) if (since is None or t >= since) and (until is None or t <= until)]
+        lo = bisect_left(self.times, since) if since is not None else 0
+        hi = bisect_right(self.times, until) if until is not None else len(self.times)
+        return range(lo, hi)
+    def read(self, i: int) -> List[str]:
+        return read_span(self.log_file, *self.span(i))
+
+def read_span(log_file: str, start: int, end: int) -> List[str]:
+    with open(log_file, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start).decode('utf-8', errors='replace').split('\n')
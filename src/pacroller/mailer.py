@@ -1,82 +1,225 @@
+import asyncio
 import json
 import smtplib
+import http.client
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
-from typing import List
+from random import uniform
+from time import monotonic
+from typing import Dict, Iterable, List, Union
+from urllib.parse import urlsplit
 import logging
-import urllib.request, urllib.parse
 from platform import node
-from pacroller.config import NETWORK_RETRY, SMTP_ENABLED, SMTP_SSL, SMTP_HOST, SMTP_PORT, SMTP_FROM, SMTP_TO, SMTP_AUTH, TG_ENABLED, TG_BOT_TOKEN, TG_API_HOST, TG_RECIPIENT, DEF_HTTP_HDRS
+from pacroller.config import (NETWORK_RETRY, NOTIFY_DEADLINE, SMTP_ENABLED, SMTP_SSL, SMTP_HOST, SMTP_PORT, SMTP_FROM,
+                              SMTP_TO, SMTP_AUTH, TG_ENABLED, TG_BOT_TOKEN, TG_API_HOST, TG_RECIPIENT, DEF_HTTP_HDRS)
 
 logger = logging.getLogger()
 hostname = node() or "unknown-host"
 
+# a single connection attempt or request
+REQUEST_TIMEOUT = 20
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+# outcome of a delivery to one recipient
+SENT, REFUSED, FAILED = 'sent', 'refused', 'failed'
 
-def send_email(text: str, subject: str, mailto: List[str]) -> bool:
-    for _ in range(NETWORK_RETRY):
+class DeliveryRefused(Exception):
+    ''' the other side said no, trying again will not help '''
+    pass
+
+class SmtpChannel:
+    '''
+        connections pooled for the lifetime of the sender so recipients are sent to side by side,
+        each gets a separate envelope so one refused address does not hold the others back
+    '''
+    name = 'smtp'
+    def __init__(self, host: str = SMTP_HOST, port: int = SMTP_PORT, ssl: bool = SMTP_SSL, sender: str = SMTP_FROM,
+                 recipients: List[str] = None, auth: Dict[str, str] = SMTP_AUTH) -> None:
+        self.host, self.port, self.ssl = host, port, ssl
+        self.sender = sender
+        self.recipients = recipients if recipients is not None else SMTP_TO.split()
+        self.auth = auth
+        self._idle: List[smtplib.SMTP] = list()
+        self._lock = threading.Lock()
+    def _connect(self) -> smtplib.SMTP:
+        with self._lock:
+            server = self._idle.pop() if self._idle else None
+        if server is not None:
+            try:
+                server.noop()
+                return server
+            except (smtplib.SMTPException, OSError):
+                # idle connections get dropped by the server, that is no reason to give up an attempt
+                server.close()
+        smtp_cls = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        server = smtp_cls(self.host, self.port, timeout=REQUEST_TIMEOUT)
         try:
-            smtp_cls = smtplib.SMTP_SSL if SMTP_SSL else smtplib.SMTP
-            server = smtp_cls(SMTP_HOST, SMTP_PORT)
-            if SMTP_AUTH:
-                server.login(SMTP_AUTH["username"], SMTP_AUTH["password"])
-            msg = EmailMessage()
-            msg.set_content(f"from pacroller running on {hostname=}:\n\n{text}")
-            msg['Subject'] = subject
-            msg['From'] = SMTP_FROM
-            msg['To'] = ', '.join(mailto)
-            server.send_message(msg)
-            server.quit()
+            if self.auth:
+                server.login(self.auth["username"], self.auth["password"])
         except Exception:
-            logger.exception("error while send_email")
-        else:
-            logger.debug(f"smtp sent {text=}")
-            break
-    else:
-        logger.error(f"unable to send email after {NETWORK_RETRY} attempts {text=}")
-        return False
-    return True
-
-
-def send_tg_message(text: str, subject: str, mailto: List[str]) -> bool:
-    for _ in range(NETWORK_RETRY):
-        all_succeeded = True
+            server.close()
+            raise
+        return server
+    def _release(self, server: smtplib.SMTP) -> None:
+        with self._lock:
+            self._idle.append(server)
+    def _send(self, recipient: str, subject: str, text: str) -> None:
+        msg = EmailMessage()
+        msg.set_content(f"from pacroller running on {hostname=}:\n\n{text}")
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = ', '.join(self.recipients)
+        server = self._connect()
         try:
-            for recipient in mailto:
-                url = f'https://{TG_API_HOST}/bot{TG_BOT_TOKEN}/sendMessage'
-                headers = {'Content-Type': 'application/json'}
-                data = json.dumps({"chat_id": recipient, "text": f"<b>{subject}</b>\n\n<code>{text[:4000]}</code>", "parse_mode": "HTML"})
-                req = urllib.request.Request(url, data=data.encode('utf-8'), headers={**DEF_HTTP_HDRS, **headers})
-                resp = urllib.request.urlopen(req).read().decode('utf-8')
-                content = json.loads(resp)
-                if not content.get("ok"):
-                    all_succeeded = False
-                    logger.error(f"unable to send telegram message to {recipient}: {content.get('description')}")
+            server.send_message(msg, to_addrs=[recipient])
+        except smtplib.SMTPRecipientsRefused as e:
+            # smtplib resets the envelope, the connection is still good
+            self._release(server)
+            raise DeliveryRefused(str(e.recipients))
         except Exception:
-            logger.exception("error while send_tg_message")
-        else:
-            logger.debug(f"telegram message sent {text=}")
-            break
-    else:
-        logger.error(f"unable to send telegram message after {NETWORK_RETRY} attempts {text=}")
-        return False
-    return all_succeeded
+            server.close()
+            raise
+        self._release(server)
+    async def deliver(self, recipient: str, subject: str, text: str) -> None:
+        await asyncio.to_thread(self._send, recipient, subject, text)
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, list()
+        for server in idle:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
 
+class TelegramChannel:
+    ''' keep-alive connections to the bot api, pooled so every recipient gets one of its own '''
+    name = 'telegram'
+    def __init__(self, api_host: str = TG_API_HOST, token: str = TG_BOT_TOKEN, recipients: List[str] = None) -> None:
+        # a scheme is only expected for stand-ins of the api
+        self.api = urlsplit(api_host if '://' in api_host else f"https://{api_host}")
+        self.token = token
+        self._path = f"{self.api.path.rstrip('/')}/bot{token}/sendMessage"
+        self.recipients = recipients if recipients is not None else TG_RECIPIENT.split()
+        self._idle: List[http.client.HTTPConnection] = list()
+        self._lock = threading.Lock()
+    def _roundtrip(self, conn: http.client.HTTPConnection, body: bytes, headers: Dict[str, str]) -> http.client.HTTPResponse:
+        conn.request('POST', self._path, body=body, headers=headers)
+        resp = conn.getresponse()
+        resp.body = resp.read()
+        return resp
+    def _request(self, body: bytes, headers: Dict[str, str]) -> http.client.HTTPResponse:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is not None:
+            try:
+                resp = self._roundtrip(conn, body, headers)
+            except (http.client.HTTPException, OSError):
+                # the server closed the idle connection, that is no reason to give up an attempt
+                conn.close()
+            else:
+                self._release(conn, resp)
+                return resp
+        conn_cls = http.client.HTTPSConnection if self.api.scheme == 'https' else http.client.HTTPConnection
+        conn = conn_cls(self.api.netloc, timeout=REQUEST_TIMEOUT)
+        try:
+            resp = self._roundtrip(conn, body, headers)
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, resp)
+        return resp
+    def _release(self, conn: http.client.HTTPConnection, resp: http.client.HTTPResponse) -> None:
+        if resp.will_close:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.append(conn)
+    def _send(self, recipient: str, subject: str, text: str) -> None:
+        data = json.dumps({"chat_id": recipient, "text": f"<b>{subject}</b>\n\n<code>{text[:4000]}</code>", "parse_mode": "HTML"})
+        resp = self._request(data.encode('utf-8'), {**DEF_HTTP_HDRS, 'Content-Type': 'application/json'})
+        body = resp.body.decode('utf-8', errors='replace')
+        try:
+            content = json.loads(body)
+        except ValueError:
+            content = dict()
+        if content.get("ok"):
+            return
+        description = content.get('description') or f"http {resp.status}"
+        if 400 <= resp.status < 500 and resp.status != 429:
+            raise DeliveryRefused(description)
+        raise RuntimeError(description)
+    async def deliver(self, recipient: str, subject: str, text: str) -> None:
+        await asyncio.to_thread(self._send, recipient, subject, text)
+    def close(self) -> None:
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle.clear()
 
 class MailSender:
-    def __init__(self) -> None:
-        pass
-    def send_text_plain(elsf, text: str, subject: str = f"pacroller on {hostname}") -> bool:
-        if_failed = False
-        if SMTP_ENABLED:
-            if not send_email(text, subject, SMTP_TO.split()):
-                if_failed = True
-        if TG_ENABLED:
-            if not send_tg_message(text, subject, TG_RECIPIENT.split()):
-                if_failed = True
-        if not SMTP_ENABLED and not TG_ENABLED:
+    '''
+        sends to every recipient of every channel at once, each delivery is retried on its own
+        with exponential backoff and jitter until it succeeds, is refused or the deadline passes
+    '''
+    def __init__(self, channels: List[Union[SmtpChannel, TelegramChannel]] = None,
+                 retry: int = NETWORK_RETRY, deadline: float = NOTIFY_DEADLINE) -> None:
+        if channels is None:
+            channels = list()
+            if SMTP_ENABLED:
+                channels.append(SmtpChannel())
+            if TG_ENABLED:
+                channels.append(TelegramChannel())
+        self.channels = channels
+        self.retry = retry
+        self.deadline = deadline
+    async def _deliver(self, channel, recipient: str, subject: str, text: str, deadline: float) -> str:
+        for attempt in range(self.retry):
+            if attempt:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * uniform(0.5, 1.5)
+                if monotonic() + delay >= deadline:
+                    break
+                await asyncio.sleep(delay)
+            try:
+                await asyncio.wait_for(channel.deliver(recipient, subject, text), max(deadline - monotonic(), 0))
+            except DeliveryRefused as e:
+                logger.error(f"{channel.name} refused the notification to {recipient}: {e}")
+                return REFUSED
+            except Exception as e:
+                logger.warning(f"unable to send {channel.name} notification to {recipient} (attempt {attempt + 1}): {e!r}")
+            else:
+                logger.debug(f"{channel.name} notification sent to {recipient} {text=}")
+                return SENT
+        logger.error(f"unable to send {channel.name} notification to {recipient} {text=}")
+        return FAILED
+    async def deliver(self, text: str, subject: str, skip: Iterable[str] = ()) -> Dict[str, str]:
+        ''' {channel:recipient: SENT / REFUSED / FAILED} for every destination not in skip '''
+        deadline = monotonic() + self.deadline
+        skip = set(skip)
+        destinations = [(channel, recipient) for channel in self.channels for recipient in channel.recipients
+                        if f"{channel.name}:{recipient}" not in skip]
+        results = await asyncio.gather(*(self._deliver(channel, recipient, subject, text, deadline)
+                                         for channel, recipient in destinations))
+        return {f"{channel.name}:{recipient}": result for (channel, recipient), result in zip(destinations, results)}
+    async def send(self, text: str, subject: str = f"pacroller on {hostname}") -> Union[bool, None]:
+        if not self.channels:
             return None
-        return not if_failed
+        return all(result == SENT for result in (await self.deliver(text, subject)).values())
+    def send_text_plain(self, text: str, subject: str = f"pacroller on {hostname}") -> Union[bool, None]:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.send(text, subject))
+        # called from a coroutine that blocks the running loop, use a loop of our own
+        with ThreadPoolExecutor(1) as pool:
+            return pool.submit(asyncio.run, self.send(text, subject)).result()
+    def close(self) -> None:
+        for channel in self.channels:
+            channel.close()
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(module)s - %(funcName)s - %(levelname)s - %(message)s')
-    print(MailSender().send_text_plain("This is a test mail\nIf you see this mail, your notification config is working."))
+    _sender = MailSender()
+    print(_sender.send_text_plain("This is a test mail\nIf you see this mail, your notification config is working."))
+    _sender.close()
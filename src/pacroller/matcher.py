@@ -0,0 +1,260 @@
+import json
+import logging
+from pathlib import Path
+from re import compile, Pattern, error as re_error
+from datetime import datetime
+from time import perf_counter, time
+from typing import List, Dict, Tuple, Union, Optional, Sequence
+from pacroller.config import LIB_DIR, RULES_FILE
+from pacroller.known_output import KNOWN_HOOK_OUTPUT, KNOWN_PACKAGE_OUTPUT
+
+logger = logging.getLogger()
+
+Rule = Union[str, dict]
+
+# rules sharing the first PREFIX_LEN literal characters land in the same bucket,
+# '==> ' and 'gpg:' being the usual suspects
+PREFIX_LEN = 4
+_META = frozenset('.^$*+?{}[]()|\\')
+_INLINE_FLAGS = compile(r'\(\?([aiLmsux]+)\)')
+_BACKREF = compile(r'\\[1-9]|\(\?P=')
+
+def _literal_prefix(regex: str) -> str:
+    ''' the literal text any match of regex has to start with '''
+    if regex.startswith('(?') or '|' in regex:
+        return ''
+    prefix = list()
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            if i + 1 < len(regex) and not regex[i+1].isalnum():
+                lit, step = regex[i+1], 2
+            else:
+                break
+        elif c in _META:
+            break
+        else:
+            lit, step = c, 1
+        quantifier = regex[i+step:i+step+1]
+        if quantifier in {'*', '?', '{'}:
+            break
+        prefix.append(lit)
+        if quantifier == '+':
+            break
+        i += step
+    return ''.join(prefix)
+
+def _scoped(regex: str) -> str:
+    ''' global inline flags are only allowed at the start of the whole pattern '''
+    if _m := _INLINE_FLAGS.match(regex):
+        return f"(?{_m.groups()[0]}:{regex[_m.end():]})"
+    return regex
+
+class RuleStats:
+    '''
+        hits and matching time of every known output rule, lines, unknown lines and matching time
+        of every hook and package, persisted in LIB_DIR across runs
+    '''
+    def __init__(self, path: Path = LIB_DIR / RULES_FILE) -> None:
+        self.path = path
+        # kind: {hook or package the rule is listed under: {regex: [hits, seconds, last hit]}}
+        self.rules: Dict[str, Dict[str, Dict[str, list]]] = dict()
+        # kind: {hook or package: [lines, unmatched lines, seconds]}
+        self.scopes: Dict[str, Dict[str, list]] = dict()
+        self.runs = 0
+        self.now = self.since = int(time())
+        try:
+            state = json.loads(path.read_text())
+            self.rules, self.scopes, self.runs, self.since = state['rules'], state['scopes'], state['runs'], state['since']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'ignoring unreadable rule statistics {path}: {e}')
+    def hits(self, kind: str, source: str, regex: str) -> int:
+        return self.rules.get(kind, dict()).get(source, dict()).get(regex, [0])[0]
+    def rule(self, kind: str, source: str, regex: str) -> list:
+        return self.rules.setdefault(kind, dict()).setdefault(source, dict()).setdefault(regex, [0, 0.0, 0])
+    def scope(self, kind: str, name: str) -> list:
+        return self.scopes.setdefault(kind, dict()).setdefault(name, [0, 0, 0.0])
+    def save(self) -> None:
+        ''' once per run, with what the checker saw in it '''
+        self.runs += 1
+        try:
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps({'rules': self.rules, 'scopes': self.scopes, 'runs': self.runs, 'since': self.since}))
+            tmp.replace(self.path)
+        except OSError as e:
+            logger.warning(f'unable to save rule statistics to {self.path}: {e}')
+    def defined(self) -> List[Tuple[str, str, str, list]]:
+        ''' (kind, hook or package, regex, counters) of every rule known_output and the override have '''
+        ret = list()
+        for kind, known in (('hook', KNOWN_HOOK_OUTPUT), ('package', KNOWN_PACKAGE_OUTPUT)):
+            for source, rules in known.items():
+                for r in dict.fromkeys(r.get('regex') if isinstance(r, dict) else r for r in rules):
+                    ret.append((kind, source, r, self.rules.get(kind, dict()).get(source, dict()).get(r, [0, 0.0, 0])))
+        return ret
+    def to_dict(self, top: int = 10) -> dict:
+        defined = self.defined()
+        hit = [(kind, source, r, c) for kind, source, r, c in defined if c[0]]
+        def rules(rows: list) -> List[dict]:
+            return [{'kind': kind, 'source': source, 'regex': r, 'hits': c[0], 'seconds': c[1], 'last': c[2]}
+                    for kind, source, r, c in rows]
+        def scopes(kind: str) -> List[dict]:
+            rows = sorted(((name, c) for name, c in self.scopes.get(kind, dict()).items() if c[0]), key=lambda i: -i[1][2])[:top]
+            return [{'name': name, 'lines': lines, 'unmatched': unmatched, 'seconds': seconds}
+                    for name, (lines, unmatched, seconds) in rows]
+        return {
+            'since': self.since,
+            'runs': self.runs,
+            'rules': len(defined),
+            'dead': rules([row for row in defined if not row[3][0]]),
+            'hottest': rules(sorted(hit, key=lambda row: -row[3][0])[:top]),
+            'slowest': rules(sorted(hit, key=lambda row: -row[3][1] / row[3][0])[:top]),
+            'hooks': scopes('hook'),
+            'packages': scopes('package'),
+        }
+    def summary(self, top: int = 10) -> str:
+        d = self.to_dict(top)
+        ret = [f"{d['rules']} rules, {d['runs']} runs since {datetime.fromtimestamp(d['since']).strftime('%c')}"]
+        def where(row: dict) -> str:
+            return f"{row['kind']} {row['source'] or '*'}: {row['regex']}"
+        if d['dead']:
+            ret.append(f"Rules that never matched ({len(d['dead'])}):")
+            ret.extend(f"  {where(row)}" for row in d['dead'])
+        if d['hottest']:
+            ret.append("Most matching rules:")
+            ret.append(f"  {'hits':>8} {'last':<10} rule")
+            ret.extend(f"  {row['hits']:>8} {datetime.fromtimestamp(row['last']).strftime('%Y-%m-%d'):<10} {where(row)}"
+                       for row in d['hottest'])
+        if d['slowest']:
+            ret.append("Slowest rules to match:")
+            ret.append(f"  {'us/hit':>8} {'hits':>8} rule")
+            ret.extend(f"  {row['seconds'] / row['hits'] * 10**6:>8.1f} {row['hits']:>8} {where(row)}" for row in d['slowest'])
+        for title, kind in (("Matching time per hook", 'hooks'), ("Matching time per package", 'packages')):
+            if d[kind]:
+                ret.append(f"{title}:")
+                ret.append(f"  {'us':>8} {'lines':>8} {'unknown':>8} name")
+                ret.extend(f"  {row['seconds'] * 10**6:>8.0f} {row['lines']:>8} {row['unmatched']:>8} {row['name']}"
+                           for row in d[kind])
+        return "\n".join(ret)
+
+class RuleMatcher:
+    '''
+        matches a message against a list of rules with re.match semantics,
+        the first matching rule in list order is reported,
+        given the hits of the rules so far the list is put in their order, the most frequent first,
+        given counters for the rules and the scope they are matched in, every match is counted and timed
+    '''
+    def __init__(self, rules: Sequence[Tuple[str, Rule]], hits: Sequence[int] = None, counters: Sequence[list] = None,
+                 scope: list = None, stats: RuleStats = None) -> None:
+        if hits is not None:
+            order = sorted(range(len(rules)), key=lambda i: -hits[i])
+            rules = [rules[i] for i in order]
+            if counters is not None:
+                counters = [counters[i] for i in order]
+        self._rules = list(rules)
+        self._counters = counters
+        self._scope = scope
+        self._stats = stats
+        self._index: Dict[str, Pattern] = dict()
+        self._generic: Optional[Pattern] = None
+        self._fallback: Optional[List[Tuple[Pattern, Rule]]] = None
+        try:
+            self._build()
+        except re_error:
+            logger.debug(f'unable to combine {len(self._rules)} rules, matching one by one')
+            self._fallback = [(compile(regex), rule) for regex, rule in self._rules]
+    def _build(self) -> None:
+        if any(_BACKREF.search(regex) for regex, _ in self._rules):
+            raise re_error('backreferences cannot be combined')
+        keys = list()
+        for regex, _ in self._rules:
+            prefix = _literal_prefix(regex)
+            keys.append(prefix[:PREFIX_LEN] if len(prefix) >= PREFIX_LEN else None)
+        def combine(key: Optional[str]) -> Optional[Pattern]:
+            members = [f"(?P<_r{i}>{_scoped(regex)})" for i, (regex, _) in enumerate(self._rules) if keys[i] in {None, key}]
+            return compile('|'.join(members)) if members else None
+        self._generic = combine(None)
+        for key in set(keys) - {None}:
+            self._index[key] = combine(key)
+    def _find(self, msg: str) -> Optional[int]:
+        if self._fallback is not None:
+            for i, (pattern, _) in enumerate(self._fallback):
+                if pattern.match(msg):
+                    return i
+            return None
+        pattern = self._index.get(msg[:PREFIX_LEN], self._generic)
+        if pattern and (_m := pattern.match(msg)):
+            return int(_m.lastgroup[2:])
+        return None
+    def match(self, msg: str) -> Optional[Rule]:
+        if self._counters is None:
+            return None if (i := self._find(msg)) is None else self._rules[i][1]
+        started = perf_counter()
+        i = self._find(msg)
+        elapsed = perf_counter() - started
+        scope = self._scope
+        scope[0] += 1
+        scope[2] += elapsed
+        if i is None:
+            scope[1] += 1
+            return None
+        counter = self._counters[i]
+        counter[0] += 1
+        counter[1] += elapsed
+        counter[2] = self._stats.now
+        return self._rules[i][1]
+
+_hook_matchers: Dict[str, RuleMatcher] = dict()
+_package_matchers: Dict[Tuple[str, str], RuleMatcher] = dict()
+_rule_stats: Optional[RuleStats] = None
+_recording = False
+
+def rule_stats() -> RuleStats:
+    ''' read the first time a matcher is needed, shared by all of them '''
+    global _rule_stats
+    if _rule_stats is None:
+        _rule_stats = RuleStats()
+    return _rule_stats
+
+def record_rules(on: bool = True) -> RuleStats:
+    '''
+        matchers count into the returned stats from now on, or stop doing so,
+        only a run saves them, anything else matching output would only pay for the counting
+    '''
+    global _recording
+    if _recording != on:
+        _recording = on
+        _hook_matchers.clear()
+        _package_matchers.clear()
+    return rule_stats()
+
+def _matcher(kind: str, scope: str, rules: List[Tuple[str, str, Rule]]) -> RuleMatcher:
+    ''' rules are (listed under, regex, rule) '''
+    stats = rule_stats()
+    if not _recording:
+        return RuleMatcher([(regex, rule) for _, regex, rule in rules],
+                           [stats.hits(kind, source, regex) for source, regex, _ in rules])
+    counters = [stats.rule(kind, source, regex) for source, regex, _ in rules]
+    return RuleMatcher([(regex, rule) for _, regex, rule in rules], [c[0] for c in counters], counters,
+                       stats.scope(kind, scope), stats)
+
+def hook_matcher(hook_name: str) -> RuleMatcher:
+    if (matcher := _hook_matchers.get(hook_name)) is None:
+        rules = [(source, r, r) for source in dict.fromkeys(('', hook_name)) for r in KNOWN_HOOK_OUTPUT.get(source, [])]
+        matcher = _hook_matchers[hook_name] = _matcher('hook', hook_name, rules)
+    return matcher
+
+def package_matcher(pkg: str, action: str) -> RuleMatcher:
+    if (matcher := _package_matchers.get((pkg, action))) is None:
+        rules = list()
+        for source in dict.fromkeys(('', pkg)):
+            for r in KNOWN_PACKAGE_OUTPUT.get(source, []):
+                if isinstance(r, dict):
+                    if action in r.get('action'):
+                        rules.append((source, r.get('regex'), r))
+                else:
+                    rules.append((source, r, r))
+        matcher = _package_matchers[(pkg, action)] = _matcher('package', pkg, rules)
+    return matcher
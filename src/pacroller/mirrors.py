@@ -0,0 +1,381 @@
+import asyncio
+import json
+import logging
+import ssl
+from email.utils import formatdate, parsedate_to_datetime
+from glob import glob
+from os import O_CREAT, O_EXCL, O_WRONLY, open as os_open, close as os_close, uname, utime
+from pathlib import Path
+from time import monotonic, time
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+from shutil import copyfile
+from urllib.parse import urlsplit, urljoin, unquote
+from pacroller.config import LIB_DIR, MIRRORS_FILE, PACMAN_CONFIG, PACMAN_DB_LCK, DEF_HTTP_HDRS
+from pacroller.utils import execute_async
+
+logger = logging.getLogger()
+
+# gzip, zstd, xz, bzip2
+DB_MAGIC = (b'\x1f\x8b', b'\x28\xb5\x2f\xfd', b'\xfd7zXZ', b'BZh')
+MAX_REDIRECTS = 5
+CLOSE_TIMEOUT = 5
+EWMA = 0.3
+
+class MirrorSyncError(Exception):
+    pass
+
+class Repo:
+    def __init__(self, name: str, servers: List[str], siglevel: List[str]) -> None:
+        self.name = name
+        # templates with $repo and $arch still in place, also the key for mirror history
+        self.servers = servers
+        self.siglevel = siglevel
+    def db_siglevel(self) -> str:
+        ''' Never / Optional / Required for the database signature '''
+        level = 'Optional'
+        for token in self.siglevel:
+            if token in ('Never', 'Optional', 'Required'):
+                level = token
+            elif token.startswith('Database') and token[8:] in ('Never', 'Optional', 'Required'):
+                level = token[8:]
+        return level
+
+def parse_pacman_conf(path: str = PACMAN_CONFIG) -> Tuple[Dict[str, Union[str, List[str]]], List[Repo]]:
+    ''' the [options] and the repositories of a pacman.conf, following Include '''
+    options: Dict[str, Union[str, List[str]]] = {'SigLevel': ['Required', 'DatabaseOptional']}
+    repos: List[Repo] = list()
+    section = None
+    def read(path: str) -> None:
+        nonlocal section
+        for line in Path(path).read_text().split('\n'):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1]
+                if section != 'options':
+                    repos.append(Repo(section, list(), list(options['SigLevel'])))
+                continue
+            key, _, value = (i.strip() for i in line.partition('='))
+            if key == 'Include':
+                for included in sorted(glob(value)):
+                    read(included)
+            elif section == 'options':
+                options[key] = value.split() if key == 'SigLevel' else value
+            elif section is not None and repos:
+                if key == 'Server':
+                    repos[-1].servers.append(value)
+                elif key == 'SigLevel':
+                    repos[-1].siglevel = value.split()
+    read(path)
+    return options, repos
+
+class MirrorStats:
+    '''
+        latency and throughput history of each mirror, as exponentially weighted averages,
+        persisted in LIB_DIR
+    '''
+    def __init__(self, path: Path = LIB_DIR / MIRRORS_FILE) -> None:
+        self.path = path
+        try:
+            self.mirrors: Dict[str, dict] = json.loads(path.read_text())
+        except FileNotFoundError:
+            self.mirrors = dict()
+        except (OSError, ValueError) as e:
+            logger.warning(f'ignoring unreadable mirror history {path}: {e}')
+            self.mirrors = dict()
+    def record(self, server: str, latency: float = None, throughput: float = None, failed: bool = False) -> None:
+        entry = self.mirrors.setdefault(server, {'latency': None, 'throughput': None, 'failures': 0, 'last': 0})
+        entry['last'] = time()
+        if failed:
+            entry['failures'] += 1
+            return
+        entry['failures'] = 0
+        for key, value in (('latency', latency), ('throughput', throughput)):
+            if value is not None:
+                entry[key] = value if entry[key] is None else (1 - EWMA) * entry[key] + EWMA * value
+    def estimate(self, server: str, size: int) -> float:
+        ''' expected seconds to fetch size bytes, None if the mirror was never used '''
+        if (entry := self.mirrors.get(server)) is None or entry['latency'] is None:
+            return None
+        return entry['latency'] + (size / entry['throughput'] if entry['throughput'] else 0)
+    def rank(self, servers: List[str], size: int = 0) -> List[str]:
+        ''' mirrors that failed last go last, then the fastest, then the untried in mirrorlist order '''
+        def key(i: int) -> tuple:
+            server = servers[i]
+            failures = self.mirrors.get(server, dict()).get('failures', 0)
+            estimate = self.estimate(server, size)
+            return (failures, estimate is None, estimate or 0, i)
+        return [servers[i] for i in sorted(range(len(servers)), key=key)]
+    def save(self) -> None:
+        try:
+            tmp = self.path.with_name(f"{self.path.name}.tmp")
+            tmp.write_text(json.dumps(self.mirrors))
+            tmp.replace(self.path)
+        except OSError as e:
+            logger.warning(f'unable to save mirror history to {self.path}: {e}')
+
+class Fetched:
+    def __init__(self, server: str, url: str) -> None:
+        self.server = server
+        self.url = url
+        self.status = 0
+        self.size = 0
+        self.latency: float = None
+        self.duration: float = None
+        self.mtime: float = None
+        self.headers: Dict[str, str] = dict()
+    @property
+    def throughput(self) -> float:
+        return self.size / self.duration if self.size and self.duration else None
+
+async def fetch_url(url: str, dest: Path, headers: Dict[str, str] = None, result: Fetched = None,
+                    method: str = 'GET') -> Fetched:
+    '''
+        a plain HTTP/1.1 GET into dest, following redirects, file:// urls are copied,
+        with method HEAD only the response headers are kept and dest is not touched,
+        latency is the time to the status line, duration the total time
+    '''
+    result = result or Fetched(url, url)
+    started = monotonic()
+    if (parts := urlsplit(url)).scheme == 'file':
+        src = Path(unquote(parts.path))
+        if not src.is_file():
+            result.status = 404
+            return result
+        if method != 'HEAD':
+            await asyncio.to_thread(copyfile, src, dest)
+        st = src.stat()
+        result.status, result.size, result.mtime = 200, st.st_size, st.st_mtime
+        result.headers = {'last-modified': formatdate(st.st_mtime, usegmt=True), 'content-length': str(st.st_size)}
+        result.latency = result.duration = monotonic() - started
+        return result
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise MirrorSyncError(f'unsupported url {url}')
+        https = parts.scheme == 'https'
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or (443 if https else 80),
+            ssl=ssl.create_default_context() if https else None
+        )
+        try:
+            target = f"{parts.path or '/'}{'?' + parts.query if parts.query else ''}"
+            request = [f"{method} {target} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close", "Accept-Encoding: identity"]
+            request.extend(f"{k}: {v}" for k, v in {**DEF_HTTP_HDRS, **(headers or dict())}.items())
+            writer.write(('\r\n'.join(request) + '\r\n\r\n').encode('latin-1'))
+            await writer.drain()
+            status_line = (await reader.readline()).decode('latin-1')
+            result.latency = monotonic() - started
+            try:
+                result.status = int(status_line.split()[1])
+            except (IndexError, ValueError):
+                raise MirrorSyncError(f'bad response from {url}: {status_line!r}')
+            resp_headers = dict()
+            while (line := (await reader.readline()).decode('latin-1').strip()):
+                key, _, value = line.partition(':')
+                resp_headers[key.strip().lower()] = value.strip()
+            if result.status in (301, 302, 303, 307, 308) and 'location' in resp_headers:
+                url = urljoin(url, resp_headers['location'])
+                continue
+            result.headers = resp_headers
+            if result.status != 200:
+                return result
+            if modified := resp_headers.get('last-modified'):
+                try:
+                    result.mtime = parsedate_to_datetime(modified).timestamp()
+                except (TypeError, ValueError):
+                    pass
+            if method == 'HEAD':
+                result.duration = monotonic() - started
+                return result
+            with open(dest, 'wb') as f:
+                if 'chunked' in resp_headers.get('transfer-encoding', ''):
+                    while (size := int((await reader.readline()).split(b';')[0], 16)):
+                        f.write(await reader.readexactly(size))
+                        await reader.readline()
+                        result.size += size
+                elif (length := resp_headers.get('content-length')) is not None:
+                    remaining = int(length)
+                    while remaining:
+                        chunk = await reader.read(min(remaining, 65536))
+                        if not chunk:
+                            raise MirrorSyncError(f'{url} closed the connection {remaining} bytes early')
+                        f.write(chunk)
+                        remaining -= len(chunk)
+                    result.size = int(length)
+                else:
+                    while chunk := await reader.read(65536):
+                        f.write(chunk)
+                        result.size += len(chunk)
+            result.duration = monotonic() - started
+            return result
+        finally:
+            writer.close()
+            try:
+                # shielded so that a cancelled race loser still lets its transport and tls session go,
+                # bounded as a mirror that lost interest may never answer the shutdown
+                await asyncio.wait_for(asyncio.shield(writer.wait_closed()), CLOSE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                pass
+    raise MirrorSyncError(f'too many redirects for {result.url}')
+
+async def verify_signature(sig: Path, file: Path) -> bool:
+    p = await execute_async(['pacman-key', '--verify', str(sig), str(file)], timeout=60)
+    if p.returncode != 0:
+        logger.debug(f'signature verification of {file} failed: {p.stdout}')
+    return p.returncode == 0
+
+class MirrorSync:
+    '''
+        downloads the sync databases, racing several mirrors for the first of them,
+        the first valid and signature checked copy wins and the other downloads are cancelled,
+        the other databases come from the mirror the first one was downloaded from so they belong to the same
+        snapshot, another mirror is only tried when it fails them, they are raced as well if nothing was downloaded
+    '''
+    def __init__(self, config: str = PACMAN_CONFIG, race: int = 3, timeout: float = 300,
+                 stats: MirrorStats = None, verify: Callable[[Path, Path], Awaitable[bool]] = verify_signature,
+                 lock: str = PACMAN_DB_LCK) -> None:
+        self.options, self.repos = parse_pacman_conf(config)
+        self.race = race
+        self.timeout = timeout
+        self.stats = stats if stats is not None else MirrorStats()
+        self.verify = verify
+        self.lock = lock
+        arch = self.options.get('Architecture', 'auto').split()[0]
+        self.arch = uname().machine if arch == 'auto' else arch
+        self.sync_dir = Path(self.options.get('DBPath', '/var/lib/pacman/')) / 'sync'
+        # repo: the mirror it was downloaded from or confirmed up to date by
+        self.servers: Dict[str, str] = dict()
+    def _url(self, server: str, repo: str, file: str) -> str:
+        return f"{server.replace('$repo', repo).replace('$arch', self.arch).rstrip('/')}/{file}"
+    async def _fetch(self, repo: Repo, server: str, attempt: int) -> Tuple[Fetched, Path, Path]:
+        ''' (result, db, sig), with None instead of the paths if the local copy is up to date '''
+        db = self.sync_dir / f".{repo.name}.db.{attempt}.part"
+        sig = self.sync_dir / f".{repo.name}.db.sig.{attempt}.part"
+        local = self.sync_dir / f"{repo.name}.db"
+        headers = dict()
+        if local.exists():
+            headers['If-Modified-Since'] = formatdate(local.stat().st_mtime, usegmt=True)
+        try:
+            url = self._url(server, repo.name, f"{repo.name}.db")
+            result = await fetch_url(url, db, headers, Fetched(server, url))
+            if result.status == 304:
+                return result, None, None
+            if result.status != 200:
+                raise MirrorSyncError(f'{server} returned {result.status} for {repo.name}.db')
+            with open(db, 'rb') as f:
+                if not f.read(6).startswith(DB_MAGIC):
+                    raise MirrorSyncError(f'{server} returned something other than a database for {repo.name}')
+            if local.exists() and result.mtime:
+                if result.mtime < (local_mtime := local.stat().st_mtime):
+                    raise MirrorSyncError(f'{server} has an older {repo.name}.db than ours')
+                elif result.mtime == local_mtime:
+                    # ignored If-Modified-Since
+                    db.unlink()
+                    return result, None, None
+            if (level := repo.db_siglevel()) != 'Never':
+                sig_result = await fetch_url(self._url(server, repo.name, f"{repo.name}.db.sig"), sig)
+                if sig_result.status == 200:
+                    if not await self.verify(sig, db):
+                        raise MirrorSyncError(f'invalid signature for {repo.name}.db from {server}')
+                else:
+                    sig.unlink(missing_ok=True)
+                    if level == 'Required':
+                        raise MirrorSyncError(f'{server} has no signature for {repo.name}.db')
+            return result, db, sig
+        except BaseException:
+            db.unlink(missing_ok=True)
+            sig.unlink(missing_ok=True)
+            raise
+    async def sync_repo(self, repo: Repo, prefer: str = None) -> bool:
+        '''
+            true if the database was updated, prefer is tried alone before any other mirror,
+            a mirror saying ours is up to date does not end the race as it may just be out of sync itself
+        '''
+        local = self.sync_dir / f"{repo.name}.db"
+        servers = self.stats.rank(repo.servers, local.stat().st_size if local.exists() else 0)
+        race = self.race
+        if prefer in servers:
+            servers.remove(prefer)
+            servers.insert(0, prefer)
+            race = 1
+        elif race > 1 and (untried := [s for s in servers[race-1:] if s not in self.stats.mirrors]):
+            # one slot goes to a mirror without history, so that a faster one can still be found
+            servers.remove(untried[0])
+            servers.insert(race - 1, untried[0])
+        if not servers:
+            raise MirrorSyncError(f'no servers for {repo.name}')
+        errors = list()
+        attempt = 0
+        up_to_date = False
+        pending: Dict[asyncio.Task, str] = dict()
+        try:
+            while pending or (servers and not up_to_date):
+                while servers and not up_to_date and len(pending) < race:
+                    server = servers.pop(0)
+                    pending[asyncio.create_task(asyncio.wait_for(self._fetch(repo, server, attempt), self.timeout))] = server
+                    attempt += 1
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    server = pending.pop(task)
+                    try:
+                        result, db, sig = task.result()
+                    except (OSError, EOFError, asyncio.TimeoutError, MirrorSyncError, ValueError) as e:
+                        logger.debug(f'{repo.name} from {server} failed: {e!r}')
+                        errors.append(f'{server}: {e!r}')
+                        self.stats.record(server, failed=True)
+                        continue
+                    self.stats.record(server, result.latency, result.throughput)
+                    if db is None:
+                        logger.debug(f'{repo.name} is up to date according to {server}')
+                        self.servers.setdefault(repo.name, server)
+                        up_to_date = True
+                        continue
+                    db.replace(local)
+                    if result.mtime:
+                        utime(local, (result.mtime, result.mtime))
+                    if sig.exists():
+                        sig.replace(local.with_name(f"{local.name}.sig"))
+                    else:
+                        local.with_name(f"{local.name}.sig").unlink(missing_ok=True)
+                    logger.debug(f'{repo.name} downloaded from {server}, {result.size} bytes in {result.duration:.2f}s')
+                    self.servers[repo.name] = server
+                    return True
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                # cancelled downloads remove their partial files
+                await asyncio.wait(pending)
+        if up_to_date:
+            return False
+        raise MirrorSyncError(f'unable to download {repo.name}.db: {"; ".join(errors)}')
+    async def sync(self) -> Dict[str, bool]:
+        ''' {repo: updated}, the pacman database lock is held meanwhile '''
+        self.sync_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            fd = os_open(self.lock, O_CREAT | O_EXCL | O_WRONLY)
+        except FileExistsError:
+            # pacman would say unable to lock database, it is worth another try later
+            raise MirrorSyncError(f'unable to lock database {self.lock}') from None
+        try:
+            first, rest = self.repos[:1], self.repos[1:]
+            results = await asyncio.gather(*(self.sync_repo(repo) for repo in first), return_exceptions=True)
+            # only a mirror that had a newer database is known to be current, one saying ours is up to date
+            # may be stale itself and would keep the others from being asked
+            prefer = self.servers.get(first[0].name) if first and results[0] is True else None
+            if prefer:
+                logger.debug(f'taking the other databases from {prefer}')
+            results += await asyncio.gather(*(self.sync_repo(repo, prefer) for repo in rest), return_exceptions=True)
+        finally:
+            os_close(fd)
+            Path(self.lock).unlink(missing_ok=True)
+            self.stats.save()
+        errors = [str(r) for r in results if isinstance(r, BaseException)]
+        for r in results:
+            if isinstance(r, BaseException) and not isinstance(r, MirrorSyncError):
+                raise r
+        if errors:
+            raise MirrorSyncError('\n'.join(errors))
+        return {repo.name: updated for repo, updated in zip(self.repos, results)}
@@ -1,35 +1,115 @@
+import json
+import logging
+import urllib.error
 import urllib.request
+from pathlib import Path
+from time import monotonic
 from xml.etree import ElementTree as etree
 from typing import List
-from pacroller.config import DEF_HTTP_HDRS
+from pacroller.config import DEF_HTTP_HDRS, LIB_DIR, NEWS_FILE
 
-def get_news(old_news: str) -> List[str]:
-    ARCH_RSS_URL = 'https://archlinux.org/feeds/news/'
-    req = urllib.request.Request(ARCH_RSS_URL, data=None, headers=DEF_HTTP_HDRS)
-    rss_text = urllib.request.urlopen(req).read().decode('utf-8')
+logger = logging.getLogger()
 
-    xml_root = etree.fromstring(rss_text)
-    elements: List[etree.Element] = xml_root.findall('channel/item')
+ARCH_RSS_URL = 'https://archlinux.org/feeds/news/'
+CONNECT_TIMEOUT = 20
+READ_TIMEOUT = 60
+CHUNK_SIZE = 16384
+MAX_SEEN = 50
 
+class NewsCache:
+    '''
+        validators of the last feed download and guids of the items already reported, newest first,
+        a pre-json news file holds the formatted first item and is only compared against
+    '''
+    def __init__(self, etag: str = None, last_modified: str = None, seen: List[str] = None, legacy: str = None) -> None:
+        self.etag = etag
+        self.last_modified = last_modified
+        self.seen = seen or list()
+        self.legacy = legacy
+    @classmethod
+    def load(cls, path: Path = LIB_DIR / NEWS_FILE) -> 'NewsCache':
+        try:
+            text = path.read_text()
+        except FileNotFoundError:
+            return cls()
+        try:
+            return cls(**json.loads(text))
+        except (ValueError, TypeError):
+            return cls(legacy=text)
+    def save(self, path: Path = LIB_DIR / NEWS_FILE) -> None:
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.write_text(json.dumps({'etag': self.etag, 'last_modified': self.last_modified, 'seen': self.seen}))
+        tmp.replace(path)
+
+def _format(item: etree.Element) -> str:
+    title = item.findtext('title') or 'No title'
+    link = item.findtext('link') or ''
+    date = item.findtext('pubDate') or 'No date'
+    return f"{date} | {title} ({link})".rstrip()
+
+def get_news(cache: NewsCache, url: str = ARCH_RSS_URL, connect_timeout: float = CONNECT_TIMEOUT,
+             read_timeout: float = READ_TIMEOUT) -> List[str]:
+    '''
+        items newer than the last seen one, the feed is parsed while it downloads and
+        the connection is dropped at the first seen item, cache is updated but not saved,
+        connect_timeout bounds connecting and every single read, read_timeout the whole download
+    '''
+    headers = dict(DEF_HTTP_HDRS)
+    if cache.seen:
+        # validators are only worth something if we know which items they cover
+        if cache.etag:
+            headers['If-None-Match'] = cache.etag
+        if cache.last_modified:
+            headers['If-Modified-Since'] = cache.last_modified
+    req = urllib.request.Request(url, data=None, headers=headers)
+    try:
+        resp = urllib.request.urlopen(req, timeout=connect_timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.debug('news feed not modified')
+            return list()
+        raise
+    deadline = monotonic() + read_timeout
+    parser = etree.XMLPullParser(events=('end',))
     news: List[str] = list()
-    for elem in elements:
-        title = elem.findtext('title') or 'No title'
-        link = elem.findtext('link') or ''
-        date = elem.findtext('pubDate') or 'No date'
-        news.append(f"{date} | {title} ({link})".rstrip())
-    return news[:news.index(old_news)] if old_news in news else news
+    guids: List[str] = list()
+    with resp:
+        etag, last_modified = resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+        done = False
+        while not done and (chunk := resp.read1(CHUNK_SIZE)):
+            if monotonic() > deadline:
+                raise TimeoutError(f'news feed not downloaded within {read_timeout}s')
+            parser.feed(chunk)
+            for _, elem in parser.read_events():
+                if elem.tag != 'item':
+                    continue
+                text = _format(elem)
+                guid = elem.findtext('guid') or elem.findtext('link') or text
+                if guid in cache.seen or text == cache.legacy:
+                    logger.debug(f'news feed: reached seen item {guid}')
+                    if guid not in cache.seen:
+                        guids.append(guid)
+                    done = True
+                    break
+                news.append(text)
+                guids.append(guid)
+                elem.clear()
+        if not done:
+            # raises on a truncated feed
+            parser.close()
+    cache.etag, cache.last_modified = etag, last_modified
+    cache.seen = (guids + cache.seen)[:MAX_SEEN]
+    cache.legacy = None
+    return news
 
 if __name__ == '__main__':
-    from pathlib import Path
-    f = Path('/tmp/pacroller-news.db')
-    if f.exists():
-        old_news = f.read_text()
-    else:
-        old_news = None
-    news = get_news(old_news)
+    import sys
+    f = Path('/tmp/pacroller-news.json')
+    cache = NewsCache.load(f)
+    news = get_news(cache, *sys.argv[1:2])
+    cache.save(f)
     if news:
-        f.write_text(news[0])
         for i in news:
             print(i)
     else:
-        print(f'nothing new, {old_news=}')
+        print(f'nothing new, last seen {cache.seen[:1]}')
@@ -0,0 +1,142 @@
+import fcntl
+import json
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from time import time, time_ns
+from os import uname
+from typing import Dict, Iterator, List, Union
+from pacroller.config import LIB_DIR, OUTBOX_DIR
+
+logger = logging.getLogger()
+hostname = uname().nodename or "unknown-host"
+
+class Outbox:
+    '''
+        notifications are queued as msg-*.json and delivered later by flush,
+        which turns everything queued for a host into one digest batch-*.json and
+        remembers which recipients already got it, so an interrupted flush never sends twice,
+        the locks are kept next to the directory, pacroller-notify.path would be triggered by every lock taken in it
+    '''
+    def __init__(self, path: Path = LIB_DIR / OUTBOX_DIR) -> None:
+        self.path = path
+    @contextmanager
+    def _locked(self, name: str, blocking: bool = True) -> Iterator[bool]:
+        with open(self.path.with_name(f".{self.path.name}{name}.lock"), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+            else:
+                yield True
+    def put(self, text: str, subject: str = f"pacroller on {hostname}") -> bool:
+        ''' the same notice queued again only bumps the count of the one waiting '''
+        self.path.mkdir(parents=True, exist_ok=True)
+        with self._locked('.spool'):
+            return self._put(text, subject)
+    def _put(self, text: str, subject: str) -> bool:
+        from hashlib import sha256
+        key = sha256(f"{hostname}\0{subject}\0{text}".encode('utf-8')).hexdigest()[:16]
+        now = time()
+        for f in self.path.glob(f"msg-*-{key}.json"):
+            try:
+                msg = json.loads(f.read_text())
+            except (OSError, ValueError):
+                continue
+            msg['count'] += 1
+            msg['last'] = now
+            self._write(f, msg)
+            logger.debug(f'notification {key} queued {msg["count"]} times')
+            return True
+        self._write(self.path / f"msg-{time_ns()}-{key}.json",
+                    {'host': hostname, 'subject': subject, 'text': text, 'date': now, 'last': now, 'count': 1})
+        logger.debug(f'notification {key} queued')
+        return True
+    @staticmethod
+    def _write(path: Path, content: dict) -> None:
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(json.dumps(content))
+        tmp.replace(path)
+    def pending(self) -> int:
+        ''' notifications not delivered to everyone yet '''
+        if not self.path.is_dir():
+            return 0
+        count = sum(1 for _ in self.path.glob('msg-*.json'))
+        for f in self.path.glob('batch-*.json'):
+            try:
+                count += len(json.loads(f.read_text())['messages'])
+            except (OSError, ValueError, KeyError):
+                pass
+        return count
+    @staticmethod
+    def _digest(messages: List[dict]) -> Dict[str, str]:
+        if len(messages) == 1 and messages[0]['count'] == 1:
+            return {'subject': messages[0]['subject'], 'text': messages[0]['text']}
+        parts = list()
+        for msg in messages:
+            when = datetime.fromtimestamp(msg['date']).strftime('%c')
+            if msg['count'] > 1:
+                when += f", {msg['count']} times until {datetime.fromtimestamp(msg['last']).strftime('%c')}"
+            parts.append(f"--- {msg['subject']} ({when})\n{msg['text']}")
+        total = sum(msg['count'] for msg in messages)
+        return {'subject': f"pacroller on {messages[0]['host']}: {total} notifications", 'text': '\n\n'.join(parts)}
+    def _batch(self) -> None:
+        ''' moves queued messages into one batch per host '''
+        batched = set()
+        for f in self.path.glob('batch-*.json'):
+            try:
+                batched.update(json.loads(f.read_text())['messages'])
+            except (OSError, ValueError, KeyError):
+                logger.warning(f'ignoring unreadable notification batch {f}')
+        hosts: Dict[str, List[tuple]] = dict()
+        for f in sorted(self.path.glob('msg-*.json')):
+            if f.name in batched:
+                # interrupted right after the batch was written
+                f.unlink()
+                continue
+            try:
+                msg = json.loads(f.read_text())
+            except (OSError, ValueError) as e:
+                logger.warning(f'ignoring unreadable notification {f}: {e}')
+                continue
+            hosts.setdefault(msg['host'], list()).append((f, msg))
+        for host, queued in hosts.items():
+            self._write(self.path / f"batch-{time_ns()}.json",
+                        {'messages': [f.name for f, _ in queued], 'delivered': list(),
+                         **self._digest([msg for _, msg in queued])})
+            for f, _ in queued:
+                f.unlink()
+    async def flush(self, sender: 'MailSender') -> Union[bool, None]:
+        ''' true if nothing is left, None if there is nowhere to deliver to '''
+        # queuing and counting do not need the mail and http machinery
+        from pacroller.mailer import FAILED
+        if not sender.channels:
+            return None
+        if not self.path.is_dir():
+            return True
+        with self._locked('.flush', blocking=False) as locked:
+            if not locked:
+                logger.info('another flush is in progress')
+                return False
+            with self._locked('.spool'):
+                self._batch()
+            done = True
+            for f in sorted(self.path.glob('batch-*.json')):
+                try:
+                    batch = json.loads(f.read_text())
+                except (OSError, ValueError) as e:
+                    logger.warning(f'ignoring unreadable notification batch {f}: {e}')
+                    done = False
+                    continue
+                results = await sender.deliver(batch['text'], batch['subject'], skip=batch['delivered'])
+                # refused ones are not going to change their mind
+                batch['delivered'].extend(dest for dest, result in results.items() if result != FAILED)
+                if any(result == FAILED for result in results.values()):
+                    self._write(f, batch)
+                    done = False
+                    logger.warning(f"{len(batch['messages'])} notifications in {f.name} are waiting for another flush")
+                else:
+                    f.unlink()
+                    logger.info(f"delivered {len(batch['messages'])} notifications: {batch['subject']}")
+            return done
@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import subprocess
+from re import split, compile, Pattern
+from typing import Dict, List, Iterator, Tuple
+from pacroller.config import PACMAN_CONFIG, HOLD, QUESTION_KINDS
+from pacroller.utils import execute_async
+
+logger = logging.getLogger()
+
+# alpm_question_type_t
+Q_INSTALL_IGNOREPKG = 1 << 0
+Q_REPLACE_PKG = 1 << 1
+Q_CONFLICT_PKG = 1 << 2
+Q_CORRUPTED_PKG = 1 << 3
+Q_REMOVE_PKGS = 1 << 4
+Q_SELECT_PROVIDER = 1 << 5
+Q_IMPORT_KEY = 1 << 6
+QUESTION_TYPES = dict(zip((Q_INSTALL_IGNOREPKG, Q_REPLACE_PKG, Q_CONFLICT_PKG, Q_CORRUPTED_PKG,
+                           Q_REMOVE_PKGS, Q_SELECT_PROVIDER, Q_IMPORT_KEY), QUESTION_KINDS))
+# what pacman answers when the user just hits enter
+DEFAULT_ANSWERS = {'install_ignorepkg': True, 'replace': True, 'conflict': False, 'corrupted': True,
+                   'remove_pkgs': False, 'select_provider': True, 'import_key': True}
+# the last line of each prompt as pacman prints it
+PROMPTS = {
+    'install_ignorepkg': compile(r':: \S+ is in IgnorePkg/IgnoreGroup\. Install anyway\? \[Y/n\]'),
+    'replace': compile(r':: Replace \S+ with \S+\? \[Y/n\]'),
+    'conflict': compile(r':: .+ are in conflict.*\. Remove \S+\? \[y/N\]'),
+    'corrupted': compile(r'Do you want to delete it\? \[Y/n\]'),
+    'remove_pkgs': compile(r'Do you want to skip the above packages? for this upgrade\? \[y/N\]'),
+    'select_provider': compile(r'Enter a number \(default=1\):'),
+    'import_key': compile(r':: Import PGP key .+\? \[Y/n\]'),
+}
+
+class PlannerError(Exception):
+    def __init__(self, message: str, questions: List[Tuple[str, str]] = None) -> None:
+        super().__init__(message)
+        self.questions = questions or list()
+
+class UpgradePlan:
+    '''
+        what pacman -Su is going to do,
+        upgrades are (name, old version, new version), installs and removals (name, version)
+    '''
+    def __init__(self) -> None:
+        self.upgrades: List[Tuple[str, str, str]] = list()
+        self.installs: List[Tuple[str, str]] = list()
+        self.removals: List[Tuple[str, str]] = list()
+        self.replaces: Dict[str, str] = dict()
+        self.ignored: List[Tuple[str, str, str]] = list()
+        self.questions: List[Tuple[str, str]] = list()
+    def __bool__(self) -> bool:
+        return bool(self.upgrades or self.installs or self.removals)
+    def changes(self) -> Iterator[Tuple[str, str, str]]:
+        ''' (name, old version, new version) with an empty string for the missing side '''
+        yield from self.upgrades
+        for name, ver in self.installs:
+            yield (name, '', ver)
+        for name, ver in self.removals:
+            yield (name, ver, '')
+    def log(self) -> None:
+        for name, over, nver in self.ignored:
+            logger.debug(f"upgrade ignored: {name} {over} -> {nver}")
+        for name, over, nver in self.upgrades:
+            logger.debug(f"upgrade: {name} {over} -> {nver}")
+        for name, nver in self.installs:
+            logger.debug(f"install: {name} {nver}")
+        for name, over in self.removals:
+            if by := self.replaces.get(name):
+                logger.debug(f"replace: {name} {over} with {by}")
+            else:
+                logger.debug(f"remove: {name} {over}")
+
+def check_hold(plan: UpgradePlan) -> List[str]:
+    errors = list()
+    for pkgname, over, nver in plan.changes():
+        if (regex := HOLD.get(pkgname)) is None:
+            continue
+        if not over:
+            errors.append(f"hold package {pkgname} {nver} is going to be installed")
+        elif not nver:
+            errors.append(f"hold package {pkgname} {over} is going to be removed")
+        elif (_m_old := regex.match(over)) and (_m_new := regex.match(nver)):
+            if (o := _m_old.groups()) != (n := _m_new.groups()):
+                errors.append(f"hold package {pkgname} is going to be upgraded from {over} to {nver}")
+            if not o or not n:
+                errors.append(f"hold package {pkgname}: version regex missing matching groups {over=} {nver=} {o=} {n=}")
+        else:
+            errors.append(f"cannot match version regex for hold package {pkgname}")
+    return errors
+
+def unanswered(questions: List[Tuple[str, str]], policy: Dict[str, str]) -> List[str]:
+    return [text for kind, text in questions if policy.get(kind, 'fail') == 'fail']
+
+def prompt_answers(policy: Dict[str, str]) -> List[Tuple[Pattern, str]]:
+    ''' replies for execute_with_io to the prompts the policy has an answer for '''
+    ret = list()
+    for kind, answer in policy.items():
+        if answer == 'fail':
+            continue
+        if kind == 'select_provider':
+            # there is nothing to say no to, take the default
+            ret.append((PROMPTS[kind], '1'))
+        else:
+            ret.append((PROMPTS[kind], 'y' if answer == 'yes' else 'n'))
+    return ret
+
+def _describe(kind: str, args: tuple) -> str:
+    if not args:
+        return f"{kind.replace('_', ' ')} (pyalpm did not say for which packages)"
+    names = [getattr(a, 'name', None) or str(a) for a in args]
+    if kind == 'replace' and len(names) >= 2:
+        return f"replace {names[0]} with {names[1]}"
+    elif kind == 'conflict' and len(names) >= 2:
+        return f"{names[0]} and {names[1]} are in conflict"
+    elif kind == 'select_provider' and args and isinstance(args[0], (list, tuple)):
+        return f"choose a provider among {', '.join(getattr(p, 'name', str(p)) for p in args[0])}"
+    return f"{kind.replace('_', ' ')}: {' '.join(names)}"
+
+def _replacements(localdb, syncdbs) -> List[Tuple[str, str]]:
+    ''' the replace questions pacman -Su asks, worked out from the databases like libalpm does '''
+    ret, seen = list(), set()
+    for db in syncdbs:
+        for pkg in db.pkgcache:
+            for dep in pkg.replaces:
+                name = split(r'[<>=]', dep, 1)[0]
+                if name != pkg.name and name not in seen and localdb.get_pkg(name) and not localdb.get_pkg(pkg.name):
+                    seen.add(name)
+                    ret.append(('replace', f"replace {name} with {db.name}/{pkg.name}"))
+    return ret
+
+def plan_upgrade(config: str = PACMAN_CONFIG, policy: Dict[str, str] = None) -> UpgradePlan:
+    '''
+        resolves a system upgrade in a nolock alpm transaction, nothing is downloaded or committed,
+        the questions libalpm asks are recorded in plan.questions and answered from policy,
+        or like pacman would by default when the policy says fail.
+        pyalpm up to 0.10 registers questioncb with libalpm but never calls it, libalpm then takes no
+        for an answer, so replacements are worked out from the databases on top, other questions
+        are only seen by the prompt answers while pacman runs
+    '''
+    try:
+        import pyalpm
+        from pycman.config import init_with_config
+    except ImportError as e:
+        raise PlannerError(f'pyalpm is not available: {e}')
+    policy = policy or dict()
+    plan = UpgradePlan()
+    def on_question(qtype: int = None, *args):
+        kind = QUESTION_TYPES.get(qtype, str(qtype))
+        plan.questions.append((kind, text := _describe(kind, args)))
+        logger.debug(f"transaction question {text}")
+        if kind == 'select_provider':
+            # index of the provider, the first one is the default
+            return 0
+        if (answer := policy.get(kind, 'fail')) == 'fail':
+            return DEFAULT_ANSWERS.get(kind, False)
+        return answer == 'yes'
+    try:
+        handle = init_with_config(config)
+        handle.questioncb = on_question
+        localdb = handle.get_localdb()
+        syncdbs = handle.get_syncdbs()
+        trans = handle.init_transaction(nolock=True)
+    except pyalpm.error as e:
+        raise PlannerError(f'unable to initialize alpm: {e}')
+    try:
+        trans.sysupgrade(False)
+        trans.prepare()
+        for pkg in trans.to_add:
+            if local := localdb.get_pkg(pkg.name):
+                plan.upgrades.append((pkg.name, local.version, pkg.version))
+            else:
+                plan.installs.append((pkg.name, pkg.version))
+        for pkg in trans.to_remove:
+            plan.removals.append((pkg.name, pkg.version))
+            for new in trans.to_add:
+                if any(split(r'[<>=]', dep, 1)[0] == pkg.name for dep in new.replaces):
+                    plan.replaces[pkg.name] = new.name
+                    break
+    except pyalpm.error as e:
+        raise PlannerError(f'unable to prepare the upgrade transaction: {e}', plan.questions)
+    finally:
+        trans.release()
+    if not any(kind == 'replace' for kind, _ in plan.questions):
+        for kind, text in _replacements(localdb, syncdbs):
+            plan.questions.append((kind, text))
+            logger.debug(f"transaction question {text}")
+    ignorepkgs, ignoregrps = set(handle.ignorepkgs), set(handle.ignoregrps)
+    if ignorepkgs or ignoregrps:
+        for local in localdb.pkgcache:
+            if local.name in ignorepkgs or ignoregrps.intersection(local.groups):
+                if new := pyalpm.sync_newversion(local, syncdbs):
+                    plan.ignored.append((local.name, local.version, new.version))
+    return plan
+
+async def plan_upgrade_with_pacman(timeout: float) -> UpgradePlan:
+    ''' the same plan from pacman -Qu and pacman -Su --print-format, without replacement details '''
+    query_upgrade_cmd = ['pacman', '-Qu', '--color', 'never']
+    sync_upgrade_cmd = ['pacman', '-Su', '--print-format', '%n %v', '--color', 'never']
+    # both only read the databases, run them side by side
+    qp, sp = await asyncio.gather(
+        execute_async(query_upgrade_cmd, timeout=timeout, check=False),
+        execute_async(sync_upgrade_cmd, timeout=timeout, check=False)
+    )
+    if qp.returncode != 1:
+        qp.check_returncode()
+    try:
+        sp.check_returncode()
+    except subprocess.CalledProcessError as e:
+        logger.error(f"upgrade check failed {e.returncode=} {e.output=}")
+        raise
+    plan = UpgradePlan()
+    upgrade_pkgnames = set()
+    for line in filter(None, qp.stdout.split('\n')):
+        pkgname, over, _ar, nver, *ignored = line.split()
+        assert _ar == '->'
+        assert not ignored or (len(ignored) == 1 and ignored[0] == "[ignored]")
+        if ignored:
+            plan.ignored.append((pkgname, over, nver))
+        else:
+            plan.upgrades.append((pkgname, over, nver))
+            upgrade_pkgnames.add(pkgname)
+    for line in filter(None, sp.stdout.split('\n')):
+        pkgname, nver = line.split()
+        if pkgname not in upgrade_pkgnames:
+            plan.installs.append((pkgname, nver))
+    return plan
@@ -0,0 +1,61 @@
+import json
+import logging
+from pathlib import Path
+from time import time
+from typing import Dict, Set, Union
+from pacroller.config import LIB_DIR, PREFETCH_FILE, PACMAN_PKG_DIR
+
+logger = logging.getLogger()
+
+def cache_snapshot(pkg_dir: str = PACMAN_PKG_DIR) -> Dict[str, int]:
+    ''' {file name: size} of complete downloads in the package cache '''
+    ret = dict()
+    try:
+        for i in Path(pkg_dir).iterdir():
+            if i.is_file() and not i.name.endswith('.part'):
+                ret[i.name] = i.stat().st_size
+    except FileNotFoundError:
+        pass
+    return ret
+
+class PrefetchState:
+    '''
+        packages downloaded by pacroller prefetch for the next run,
+        the run marks the state used once it has installed them
+    '''
+    def __init__(self, date: float, duration: float, files: Dict[str, int], used: float = None) -> None:
+        self.date = date
+        self.duration = duration
+        self.files = files
+        self.used = used
+    @classmethod
+    def from_snapshots(cls, before: Dict[str, int], after: Dict[str, int], duration: float) -> 'PrefetchState':
+        files = {name: size for name, size in after.items() if before.get(name) != size}
+        return cls(time(), duration, files)
+    @property
+    def size(self) -> int:
+        return sum(self.files.values())
+    def to_dict(self) -> dict:
+        return {'date': self.date, 'duration': self.duration, 'files': self.files, 'used': self.used}
+    @classmethod
+    def load(cls, path: Path = LIB_DIR / PREFETCH_FILE) -> Union['PrefetchState', None]:
+        try:
+            return cls(**json.loads(path.read_text()))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'ignoring unreadable prefetch state {path}: {e}')
+            return None
+    def save(self, path: Path = LIB_DIR / PREFETCH_FILE) -> None:
+        tmp = path.with_name(f"{path.name}.tmp")
+        tmp.write_text(json.dumps(self.to_dict()))
+        tmp.replace(path)
+    def pending(self, max_age: float) -> bool:
+        ''' fetched within max_age hours and not installed yet '''
+        return self.used is None and time() - self.date < max_age * 3600
+    def cached(self, pkg_dir: str = PACMAN_PKG_DIR) -> bool:
+        snapshot = cache_snapshot(pkg_dir)
+        return all(snapshot.get(name) == size for name, size in self.files.items())
+    def protected(self, max_age: float) -> Set[str]:
+        ''' files clear_pkg_cache has to leave alone '''
+        return set(self.files) if self.pending(max_age) else set()
@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Iterable, Tuple
+
+logger = logging.getLogger()
+
+class StageGraph:
+    '''
+        runs coroutines as soon as the stages they come after have finished,
+        the first failure cancels everything still running and is raised
+    '''
+    def __init__(self) -> None:
+        self.stages: Dict[str, Tuple[Callable[[], Awaitable[Any]], Tuple[str, ...]]] = dict()
+        self.results: Dict[str, Any] = dict()
+        # name: (start relative to the graph, duration)
+        self.timings: Dict[str, Tuple[float, float]] = dict()
+        self.wall: float = 0
+    def add(self, name: str, func: Callable[[], Awaitable[Any]], after: Iterable[str] = ()) -> None:
+        assert name not in self.stages
+        after = tuple(after)
+        assert all(dep in self.stages for dep in after), f'{name} comes after an unknown stage'
+        self.stages[name] = (func, after)
+    async def run(self) -> Dict[str, Any]:
+        started = monotonic()
+        tasks: Dict[str, asyncio.Task] = dict()
+        async def stage(name: str) -> Any:
+            func, after = self.stages[name]
+            for dep in after:
+                await tasks[dep]
+            t = monotonic()
+            try:
+                self.results[name] = ret = await func()
+            finally:
+                self.timings[name] = (t - started, monotonic() - t)
+            return ret
+        for name in self.stages:
+            tasks[name] = asyncio.create_task(stage(name), name=name)
+        try:
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in tasks.values():
+                if task in done and task.exception():
+                    raise task.exception()
+        finally:
+            self.wall = monotonic() - started
+        return self.results
+    def log(self) -> None:
+        for name, (start, duration) in sorted(self.timings.items(), key=lambda i: i[1][0]):
+            logger.debug(f'stage {name}: started at {start:.2f}s, took {duration:.2f}s')
+        if self.timings:
+            serial = sum(duration for _, duration in self.timings.values())
+            logger.info(f'{len(self.timings)} stages took {self.wall:.2f}s, {serial - self.wall:.2f}s less than one after another')
@@ -0,0 +1,202 @@
+import logging
+from array import array
+from collections import Counter
+from time import strftime, localtime
+from typing import Dict, Iterator, List, Tuple
+from pacroller.checker import LogParser, LogRecord, LogTokenizer, LOG_LINE, checkReport
+
+logger = logging.getLogger()
+
+PERIODS = {'day': '%Y-%m-%d', 'week': '%G-W%V', 'month': '%Y-%m', 'year': '%Y'}
+
+class HistoryStats:
+    '''
+        aggregates pacman.log history one record at a time,
+        per transaction figures are kept column-wise in arrays
+    '''
+    def __init__(self) -> None:
+        self.started = array('d')
+        self.duration = array('d')
+        self.upgrades = array('L')
+        self.installs = array('L')
+        self.removals = array('L')
+        self.warnings = array('L')
+        self.errors = array('L')
+        self.upgraded = Counter()
+        self.installed = Counter()
+        self.removed = Counter()
+        self.hook_warnings = Counter()
+        self.package_warnings = Counter()
+        self.unmatched = Counter()
+        # per transaction {name: seconds}, as measured by the checker
+        self.hook_costs: List[Dict[str, float]] = list()
+        self.scriptlet_costs: List[Dict[str, float]] = list()
+        self._report: checkReport = None
+        self._parser: LogParser = None
+        self._first: LogRecord = None
+        self._last: LogRecord = None
+    def __len__(self) -> int:
+        return len(self.started)
+    def _on_unmatched(self, kind: str, name: str, msg: str) -> None:
+        (self.hook_warnings if kind == 'hook' else self.package_warnings)[name] += 1
+        self.unmatched[(kind, name, msg)] += 1
+    def feed(self, record: LogRecord) -> None:
+        if record.source == 'ALPM' and record.message == 'transaction started':
+            self._close_transaction()
+            self._report = checkReport()
+            self._parser = LogParser(self._report, on_unmatched=self._on_unmatched)
+            self._first = record
+        if self._parser is None:
+            return
+        self._parser.feed(record)
+        if record.source != 'PACMAN':
+            self._last = record
+    def _close_transaction(self) -> None:
+        if self._parser is None:
+            return
+        self._parser.close()
+        report = self._report
+        counts = {'upgrades': 0, 'installs': 0, 'removals': 0}
+        for name, old, new in report._changes:
+            if old and new:
+                self.upgraded[name] += 1
+                counts['upgrades'] += 1
+            elif old is None:
+                self.installed[name] += 1
+                counts['installs'] += 1
+            else:
+                self.removed[name] += 1
+                counts['removals'] += 1
+        self.started.append(self._first.timestamp)
+        self.duration.append(self._last.timestamp - self._first.timestamp)
+        for k, v in counts.items():
+            getattr(self, k).append(v)
+        self.warnings.append(len(report._warn))
+        self.errors.append(len(report._crit))
+        self.hook_costs.append(report.timings.get('hooks', {}))
+        self.scriptlet_costs.append(report.timings.get('scriptlets', {}))
+        self._report = self._parser = self._first = self._last = None
+    def close(self) -> None:
+        self._close_transaction()
+    def rollup(self, period: str = 'month') -> Dict[str, dict]:
+        fmt = PERIODS[period]
+        ret: Dict[str, dict] = dict()
+        for i, started in enumerate(self.started):
+            key = strftime(fmt, localtime(started))
+            if (row := ret.get(key)) is None:
+                row = ret[key] = {'transactions': 0, 'upgrades': 0, 'installs': 0, 'removals': 0,
+                                  'warnings': 0, 'errors': 0, 'duration': 0.0, 'max_duration': 0.0,
+                                  'hooks': 0.0, 'scriptlets': 0.0}
+            row['transactions'] += 1
+            for col in ('upgrades', 'installs', 'removals', 'warnings', 'errors'):
+                row[col] += getattr(self, col)[i]
+            row['duration'] += self.duration[i]
+            row['max_duration'] = max(row['max_duration'], self.duration[i])
+            row['hooks'] += sum(self.hook_costs[i].values())
+            row['scriptlets'] += sum(self.scriptlet_costs[i].values())
+        return ret
+    def _costs(self, kind: str) -> List[Dict[str, float]]:
+        return self.hook_costs if kind == 'hooks' else self.scriptlet_costs
+    def costs(self, kind: str = 'hooks', top: int = 10) -> List[dict]:
+        ''' the hooks or scriptlets that took the most time altogether, slowest first '''
+        total, runs, longest = Counter(), Counter(), dict()
+        for costs in self._costs(kind):
+            for name, seconds in costs.items():
+                total[name] += seconds
+                runs[name] += 1
+                longest[name] = max(longest.get(name, 0.0), seconds)
+        return [{'name': name, 'total': seconds, 'runs': runs[name], 'avg': seconds / runs[name], 'max': longest[name]}
+                for name, seconds in total.most_common(top)]
+    def cost_trend(self, kind: str = 'hooks', period: str = 'month', top: int = 10) -> Dict[str, Dict[str, float]]:
+        ''' average time per run of the slowest hooks or scriptlets in each period '''
+        names = {row['name'] for row in self.costs(kind, top)}
+        fmt = PERIODS[period]
+        total: Dict[str, Counter] = dict()
+        runs: Dict[str, Counter] = dict()
+        for started, costs in zip(self.started, self._costs(kind)):
+            key = strftime(fmt, localtime(started))
+            for name, seconds in costs.items():
+                if name in names:
+                    total.setdefault(key, Counter())[name] += seconds
+                    runs.setdefault(key, Counter())[name] += 1
+        return {key: {name: seconds / runs[key][name] for name, seconds in row.items()} for key, row in total.items()}
+    def to_dict(self, period: str = 'month', top: int = 10) -> dict:
+        return {
+            'transactions': len(self),
+            'upgrades': sum(self.upgrades),
+            'installs': sum(self.installs),
+            'removals': sum(self.removals),
+            'by_period': self.rollup(period),
+            'upgraded': dict(self.upgraded.most_common(top)),
+            'installed': dict(self.installed.most_common(top)),
+            'removed': dict(self.removed.most_common(top)),
+            'hook_warnings': dict(self.hook_warnings.most_common(top)),
+            'package_warnings': dict(self.package_warnings.most_common(top)),
+            'unmatched': [{'kind': k, 'name': n, 'message': m, 'count': c}
+                          for (k, n, m), c in self.unmatched.most_common(top)],
+            'hook_time': self.costs('hooks', top),
+            'scriptlet_time': self.costs('scriptlets', top),
+            'hook_time_by_period': self.cost_trend('hooks', period, top),
+            'scriptlet_time_by_period': self.cost_trend('scriptlets', period, top),
+        }
+    def summary(self, period: str = 'month', top: int = 10) -> str:
+        ret = [f"{len(self)} transactions: {sum(self.upgrades)} upgrades, "
+               f"{sum(self.installs)} installs, {sum(self.removals)} removals"]
+        if rows := self.rollup(period):
+            ret.append(f"Per {period}:")
+            ret.append(f"  {period:<10} {'trans':>6} {'upgr':>6} {'inst':>6} {'rem':>6} {'warn':>6} {'err':>6} {'avg s':>8} {'max s':>8}"
+                       f" {'hooks s':>8} {'script s':>8}")
+            for key, row in rows.items():
+                ret.append(f"  {key:<10} {row['transactions']:>6} {row['upgrades']:>6} {row['installs']:>6} "
+                           f"{row['removals']:>6} {row['warnings']:>6} {row['errors']:>6} "
+                           f"{row['duration'] / row['transactions']:>8.1f} {row['max_duration']:>8.0f}"
+                           f" {row['hooks']:>8.0f} {row['scriptlets']:>8.0f}")
+        for title, counter in (("Most upgraded packages", self.upgraded),
+                               ("Most installed packages", self.installed),
+                               ("Most removed packages", self.removed),
+                               ("Warnings per hook", self.hook_warnings),
+                               ("Warnings per package", self.package_warnings)):
+            if counter:
+                ret.append(f"{title}:")
+                ret.extend(f"  {c:>6} {name}" for name, c in counter.most_common(top))
+        for title, kind in (("Time per hook", 'hooks'), ("Time per package scriptlet", 'scriptlets')):
+            if costs := self.costs(kind, top):
+                ret.append(f"{title}:")
+                ret.append(f"  {'total s':>8} {'runs':>6} {'avg s':>8} {'max s':>8} name")
+                ret.extend(f"  {row['total']:>8.0f} {row['runs']:>6} {row['avg']:>8.1f} {row['max']:>8.0f} {row['name']}"
+                           for row in costs)
+        if self.unmatched:
+            ret.append("Most frequent unmatched scriptlet lines:")
+            ret.extend(f"  {c:>6} {kind} {name}: {msg}" for (kind, name, msg), c in self.unmatched.most_common(top))
+        return "\n".join(ret)
+
+def read_records(log_file: str, start: int = 0, end: int = None) -> Iterator[LogRecord]:
+    ''' streams records from byte range [start, end) of a pacman.log '''
+    tokenizer = LogTokenizer()
+    with open(log_file, 'rb') as f:
+        f.seek(start)
+        pos = start
+        started = False
+        for bline in f:
+            if end is not None and pos >= end:
+                break
+            pos += len(bline)
+            line = bline.decode('utf-8', errors='replace').removesuffix('\n')
+            if not started:
+                if not LOG_LINE.match(line):
+                    logger.debug(f'skipping {line=} before the first log entry')
+                    continue
+                started = True
+            if (record := tokenizer.feed(line)) is not None:
+                yield record
+    if (record := tokenizer.flush()) is not None:
+        yield record
+
+def collect(log_file: str, start: int = 0, end: int = None, spans: List[Tuple[int, int]] = None) -> HistoryStats:
+    ''' statistics of [start, end), or of every byte range in spans '''
+    stats = HistoryStats()
+    for span in spans or [(start, end)]:
+        for record in read_records(log_file, *span):
+            stats.feed(record)
+    stats.close()
+    return stats
@@ -0,0 +1,120 @@
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from time import monotonic, time
+from typing import Dict, Iterator, Union
+
+logger = logging.getLogger()
+
+class PhaseTimer:
+    '''
+        seconds spent in each phase of a run, a phase entered more than once adds up,
+        counters hold the retries and bytes of output that go with them,
+        saved the seconds a phase did not take because they were spent ahead of the run
+    '''
+    def __init__(self) -> None:
+        self.phases: Dict[str, float] = dict()
+        self.counters: Dict[str, int] = dict()
+        self.saved: Dict[str, float] = dict()
+        self._current: Union[str, None] = None
+        self._since = 0.0
+    def add(self, name: str, seconds: float) -> None:
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+    def save(self, name: str, seconds: float) -> None:
+        self.saved[name] = self.saved.get(name, 0.0) + seconds
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, monotonic() - started)
+    def switch(self, name: Union[str, None]) -> None:
+        ''' ends the phase the previous switch started and starts name, None only ends it '''
+        now = monotonic()
+        if self._current is not None:
+            self.add(self._current, now - self._since)
+        self._current, self._since = name, now
+    def to_dict(self) -> dict:
+        ret = {'phases': {name: round(seconds, 3) for name, seconds in self.phases.items()}, 'counters': dict(self.counters)}
+        if self.saved:
+            ret['saved'] = {name: round(seconds, 3) for name, seconds in self.saved.items()}
+        return ret
+
+# shared by everything that runs as part of one pacroller invocation
+timer = PhaseTimer()
+
+# counters are named <phase><suffix>
+COUNTER_METRICS = {
+    '_retries': ('pacroller_retries', 'Attempts of a phase that had to be repeated in the last run.'),
+    '_output_bytes': ('pacroller_output_bytes', 'Bytes of command output captured in a phase of the last run.'),
+    '_saved_bytes': ('pacroller_saved_bytes', 'Bytes a phase of the last run did not download because pacroller prefetch did it ahead.'),
+}
+
+# pacman.log has a resolution of one second
+COST_METRICS = {
+    'hooks': ('pacroller_hook_duration_seconds', 'hook', 'Time spent in a pacman hook in the last run.'),
+    'scriptlets': ('pacroller_scriptlet_duration_seconds', 'package', 'Time spent in the install scriptlet of a package in the last run.'),
+}
+
+def summary(timings: dict, indent: int = 2) -> list:
+    ret = list()
+    for name, seconds in timings.get('phases', {}).items():
+        ret.append(f"{' ' * indent}{name}: {seconds:.2f}s")
+    for name, value in timings.get('counters', {}).items():
+        ret.append(f"{' ' * indent}{name}: {value}")
+    for name, seconds in timings.get('saved', {}).items():
+        ret.append(f"{' ' * indent}{name} saved: {seconds:.2f}s")
+    for kind in COST_METRICS:
+        for name, seconds in sorted(timings.get(kind, {}).items(), key=lambda i: -i[1]):
+            ret.append(f"{' ' * indent}{kind[:-1]} {name}: {seconds:.0f}s")
+    return ret
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def write_textfile(path: Path, timings: dict, success: bool, date: float = None) -> None:
+    '''
+        OpenMetrics text for the node_exporter textfile collector, replaced atomically
+        so the collector never reads half a file
+    '''
+    date = time() if date is None else date
+    lines = [
+        '# HELP pacroller_phase_duration_seconds Time spent in a phase of the last run.',
+        '# TYPE pacroller_phase_duration_seconds gauge',
+        *(f'pacroller_phase_duration_seconds{{phase="{_escape(name)}"}} {seconds}'
+          for name, seconds in timings.get('phases', {}).items()),
+    ]
+    counters = timings.get('counters', {})
+    for suffix, (metric, help_text) in COUNTER_METRICS.items():
+        lines.extend((f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge'))
+        lines.extend(f'{metric}{{phase="{_escape(name.removesuffix(suffix))}"}} {value}'
+                     for name, value in counters.items() if name.endswith(suffix))
+    lines.extend((
+        '# HELP pacroller_saved_seconds Time a phase of the last run did not take because pacroller prefetch did it ahead.',
+        '# TYPE pacroller_saved_seconds gauge',
+        *(f'pacroller_saved_seconds{{phase="{_escape(name)}"}} {seconds}' for name, seconds in timings.get('saved', {}).items()),
+    ))
+    for kind, (metric, label, help_text) in COST_METRICS.items():
+        lines.extend((f'# HELP {metric} {help_text}', f'# TYPE {metric} gauge'))
+        lines.extend(f'{metric}{{{label}="{_escape(name)}"}} {seconds}' for name, seconds in timings.get(kind, {}).items())
+    lines.extend((
+        '# HELP pacroller_last_run_success Whether the last run ended without an error.',
+        '# TYPE pacroller_last_run_success gauge',
+        f'pacroller_last_run_success {int(success)}',
+        '# HELP pacroller_last_run_timestamp_seconds When the last run ended.',
+        '# TYPE pacroller_last_run_timestamp_seconds gauge',
+        f'pacroller_last_run_timestamp_seconds {date:.3f}',
+        '# EOF',
+    ))
+    tmp = path.with_name(f".{path.name}.tmp")
+    try:
+        tmp.write_text('\n'.join(lines) + '\n')
+        tmp.chmod(0o644)
+        tmp.replace(path)
+    except OSError as e:
+        logger.warning(f'unable to write metrics to {path}: {e}')
+    else:
+        logger.debug(f'metrics written to {path}')
@@ -0,0 +1,288 @@
+from pathlib import Path
+import asyncio
+import subprocess
+import logging
+import logging.handlers
+from datetime import datetime
+from time import monotonic, time
+from typing import List, Iterable, Callable, Tuple
+from pacroller.utils import execute_async, execute_with_io_async, ask_interactive_question
+from pacroller.checker import log_checker, sync_err_is_net, upgrade_err_is_net, checkReport, StreamChecker, REGEX
+from pacroller.config import (LIB_DIR, PACMAN_LOG, TIMEOUT, UPGRADE_TIMEOUT, NETWORK_RETRY, CUSTOM_SYNC, SYNC_SH, SHELL,
+                              PACMAN_DB_LCK, SAVE_STDOUT, LOG_DIR, QUESTION_POLICY, PREFETCH_FILE, PREFETCH_RETRY,
+                              PREFETCH_MAX_AGE, RETRY_BACKOFF, SYNC_MIRRORS, FAST_PATH)
+from pacroller.mirrors import MirrorSync, MirrorSyncError
+from pacroller.fastpath import FastPath
+from pacroller.matcher import record_rules
+from pacroller.prefetch import PrefetchState, cache_snapshot
+from pacroller.timings import timer
+from pacroller.planner import UpgradePlan, PlannerError, plan_upgrade, plan_upgrade_with_pacman, check_hold, unanswered, prompt_answers
+
+logger = logging.getLogger()
+
+class NonFatal(Exception):
+    pass
+class SyncRetry(NonFatal):
+    pass
+class MaxRetryReached(NonFatal):
+    pass
+class PackageHold(Exception):
+    pass
+class UnansweredQuestion(Exception):
+    pass
+class CheckFailed(Exception):
+    pass
+class NeedrestartFailed(Exception):
+    pass
+class NewsUnread(Exception):
+    pass
+
+async def sync() -> None:
+    logger.info('sync start')
+    if SYNC_MIRRORS and not CUSTOM_SYNC:
+        try:
+            updated = await MirrorSync(race=SYNC_MIRRORS, timeout=TIMEOUT).sync()
+        except MirrorSyncError as e:
+            logger.warning(f'unable to download databases: {e}')
+            raise SyncRetry()
+        logger.debug(f'sync {updated=}')
+        logger.info('sync end')
+        return
+    if CUSTOM_SYNC:
+        sync_cmd = [SHELL, SYNC_SH.resolve()]
+    else:
+        sync_cmd = ['pacman', '-Sy', '--noprogressbar', '--color', 'never']
+    try:
+        p = await execute_async(sync_cmd, timeout=TIMEOUT, check=True)
+    except subprocess.CalledProcessError as e:
+        if sync_err_is_net(e.output):
+            logger.warning('unable to download databases')
+            raise SyncRetry()
+        else:
+            logger.exception(f'sync failed with {e.returncode=} {e.output=}')
+            raise
+    except subprocess.TimeoutExpired as e:
+        logger.warning(f'database download timeout {e.timeout=} {e.output=}')
+        if Path(PACMAN_DB_LCK).exists():
+            logger.warning(f'automatically removing {PACMAN_DB_LCK}')
+            Path(PACMAN_DB_LCK).unlink()
+        raise SyncRetry()
+    else:
+        timer.count('sync_output_bytes', len(p.stdout.encode('utf-8')))
+        logger.debug(f'sync {p.stdout=}')
+        logger.info('sync end')
+
+async def backoff(attempt: int) -> None:
+    ''' doubles the wait after each failed attempt, nothing before the first one '''
+    if attempt and (delay := RETRY_BACKOFF * 2 ** (attempt - 1)):
+        logger.info(f'retrying in {delay:.0f}s')
+        await asyncio.sleep(delay)
+
+async def sync_with_retry(retry: int) -> None:
+    for attempt in range(retry):
+        if attempt:
+            timer.count('sync_retries')
+        await backoff(attempt)
+        try:
+            await sync()
+        except SyncRetry:
+            pass
+        else:
+            break
+    else:
+        raise MaxRetryReached(f'sync failed {retry} times')
+
+async def get_plan(preflight: Callable[[List[Tuple[str, str]]], None] = lambda _: None) -> UpgradePlan:
+    ''' preflight is given the questions pacman is going to ask before falling back to pacman for the plan '''
+    try:
+        plan = plan_upgrade(policy=QUESTION_POLICY)
+    except PlannerError as e:
+        # a declined conflict fails the simulation, the questions up to there are still worth failing on
+        preflight(e.questions)
+        logger.warning(f'{e}, asking pacman instead')
+        plan = await plan_upgrade_with_pacman(TIMEOUT)
+    else:
+        preflight(plan.questions)
+    plan.log()
+    return plan
+
+def preflight(interactive: bool = False) -> Callable[[List[Tuple[str, str]]], None]:
+    ''' for get_plan, fails on the questions the policy has no answer for unless someone is there to answer them '''
+    def check(questions: List[Tuple[str, str]]) -> None:
+        if not (pending := unanswered(questions, QUESTION_POLICY)):
+            return
+        for q in pending:
+            logger.warning(f"pacman is going to ask: {q}")
+        if not interactive:
+            raise UnansweredQuestion(pending)
+    return check
+
+async def upgrade(interactive=False, on_line: Callable[[str], None] = None, on_poll: Callable[[], None] = None) -> Iterable[str]:
+    logger.info('upgrade start')
+    with timer.phase('plan'):
+        plan = await get_plan(preflight(interactive))
+    if not plan:
+        logger.info('upgrade end, nothing to do')
+        if FAST_PATH:
+            await FastPath().record()
+        exit(0)
+    try:
+        if errors := check_hold(plan):
+            raise PackageHold(errors)
+    except PackageHold as e:
+        if interactive:
+            user_input = ask_interactive_question(f"{e}, continue? ")
+            if user_input and user_input.lower().startswith('y'):
+                logger.warning("user determined to continue")
+            else:
+                raise
+        else:
+            raise
+    def on_pacman_line(line: str) -> None:
+        timer.count('upgrade_output_bytes', len(line.encode('utf-8')) + 1)
+        if REGEX['s_process_pkg_changes'].match(line):
+            timer.switch('install')
+        elif REGEX['s_post-transaction'].match(line):
+            timer.switch('hooks')
+        if on_line:
+            with timer.phase('check'):
+                on_line(line)
+    # everything before pacman starts changing packages, downloading and verifying them
+    timer.switch('download')
+    try:
+        pacman_output = await execute_with_io_async(['pacman', '-Su', '--noprogressbar', '--color', 'never'], UPGRADE_TIMEOUT,
+                                        interactive=interactive, on_line=on_pacman_line, on_poll=on_poll,
+                                        answers=prompt_answers(QUESTION_POLICY))
+    finally:
+        timer.switch(None)
+    logger.info('upgrade end')
+    return pacman_output
+
+async def prefetch() -> None:
+    await sync_with_retry(PREFETCH_RETRY)
+    if not (plan := await get_plan(preflight())):
+        logger.info('prefetch end, nothing to do')
+        (LIB_DIR / PREFETCH_FILE).unlink(missing_ok=True)
+        return
+    logger.info('prefetch start')
+    before = cache_snapshot()
+    started = monotonic()
+    for attempt in range(PREFETCH_RETRY):
+        await backoff(attempt)
+        try:
+            # the same answers the upgrade is going to give, --noconfirm would take pacman's defaults
+            p = await execute_with_io_async(['pacman', '-Suw', '--noprogressbar', '--color', 'never'], UPGRADE_TIMEOUT,
+                                            answers=prompt_answers(QUESTION_POLICY))
+        except subprocess.CalledProcessError as e:
+            if upgrade_err_is_net(e.output):
+                logger.warning('prefetch download failed')
+            else:
+                logger.error(f'prefetch failed with {e.returncode=} {e.output=}')
+                raise
+        else:
+            logger.debug(f'prefetch stdout={str(p)!r}')
+            break
+    else:
+        raise MaxRetryReached(f'prefetch failed {PREFETCH_RETRY} times')
+    state = PrefetchState.from_snapshots(before, cache_snapshot(), monotonic() - started)
+    state.save()
+    logger.info(f'prefetch end, {len(state.files)} files ({state.size / 1024**2:.1f}MiB) in {state.duration:.0f}s')
+
+async def sync_unless_prefetched() -> PrefetchState:
+    ''' the pending prefetch if its downloads are still cached, otherwise syncs and returns None '''
+    prefetched = PrefetchState.load()
+    if prefetched and prefetched.pending(PREFETCH_MAX_AGE) and prefetched.cached():
+        # the databases are as the prefetch synced them, syncing again could invalidate its downloads
+        logger.info(f'using packages prefetched at {datetime.fromtimestamp(prefetched.date)}, skipping sync')
+        return prefetched
+    await sync_with_retry(NETWORK_RETRY)
+    return None
+
+async def do_system_upgrade(debug=False, interactive=False, prefetched: PrefetchState = None) -> checkReport:
+    stdout_handler = None
+    if SAVE_STDOUT:
+        try:
+            LOG_DIR.mkdir(parents=True, exist_ok=True)
+            _formatter = logging.Formatter(fmt='%(asctime)s - %(message)s')
+            stdout_handler = logging.handlers.RotatingFileHandler(LOG_DIR / "stdout.log", mode='a',
+                            maxBytes=10*1024**2, backupCount=2)
+            stdout_handler.setFormatter(_formatter)
+            stdout_handler.setLevel(logging.DEBUG+1)
+        except Exception:
+            logging.exception(f"unable to save stdout to {LOG_DIR}")
+            stdout_handler = None
+    if stdout_handler:
+        logger.addHandler(stdout_handler)
+
+    record_rules()
+    for attempt in range(NETWORK_RETRY):
+        if attempt:
+            timer.count('upgrade_retries')
+        await backoff(attempt)
+        checker = None
+        try:
+            with open(PACMAN_LOG, 'r') as pacman_log:
+                log_anchor = pacman_log.seek(0, 2)
+            checker = StreamChecker(PACMAN_LOG, log_anchor, on_crit=lambda text: logger.error(f'checker: {text}'))
+            def poll_log() -> None:
+                with timer.phase('check'):
+                    checker.poll_log()
+            stdout = await upgrade(interactive=interactive, on_line=checker.feed_stdout, on_poll=poll_log)
+        except subprocess.CalledProcessError as e:
+            checker.finish()
+            if upgrade_err_is_net(e.output):
+                logger.warning('upgrade download failed')
+            else:
+                raise
+        except BaseException:
+            # held packages, questions, timeouts and nothing to do
+            if checker:
+                checker.close()
+            raise
+        else:
+            break
+    else:
+        raise MaxRetryReached(f'upgrade failed {NETWORK_RETRY} times')
+
+    if prefetched:
+        prefetched.used = time()
+        prefetched.save()
+        logger.info(f'prefetch saved {prefetched.duration:.0f}s downloading {prefetched.size / 1024**2:.1f}MiB')
+        timer.save('download', prefetched.duration)
+        timer.count('download_saved_bytes', prefetched.size)
+
+    if stdout_handler:
+        logger.removeHandler(stdout_handler)
+
+    with timer.phase('check'):
+        report = checker.finish()
+        # checking the log again would count every line twice
+        rule_stats = record_rules(False)
+        if debug or checker.error:
+            # the streaming checker does not keep the log, check it again as a whole
+            with open(PACMAN_LOG, 'r') as pacman_log:
+                pacman_log.seek(log_anchor)
+                log = pacman_log.read().split('\n')
+            try:
+                report = log_checker(stdout, log, debug=debug)
+            except Exception:
+                logger.exception('checker has crashed, here is the debug info')
+                logger.setLevel(logging.DEBUG)
+                _report = log_checker(stdout, log, debug=True)
+                raise
+    rule_stats.save()
+
+    logger.info(report.summary(verbose=True, show_package=False))
+    return report
+
+async def is_system_failed() -> str:
+    try:
+        p = await execute_async(["systemctl", "is-system-running"], timeout=20, stderr=subprocess.DEVNULL)
+    except Exception:
+        ret = "exec fail"
+    else:
+        ret = p.stdout.strip()
+    if ret == 'running':
+        return None
+    else:
+        return ret
@@ -1,22 +1,26 @@
 import subprocess
-from threading import Thread
 import logging
-from typing import List, BinaryIO, Iterator, Union, Callable
+from typing import List, BinaryIO, Iterator, Union, Callable, TextIO, Sequence, Tuple
 from io import DEFAULT_BUFFER_SIZE
 from time import mktime
 from datetime import datetime
-from signal import SIGINT, SIGTERM, Signals
+from signal import SIGINT, SIGTERM, SIGKILL, Signals
 from select import select
 from sys import stdin
-from os import set_blocking, close as os_close
+from os import set_blocking, close as os_close, read as os_read, write as os_write, fstat, killpg
+from mmap import mmap, ACCESS_READ
 from pty import openpty
-from re import compile
+from re import compile, Pattern
+from codecs import getincrementaldecoder
+# asyncio and tempfile are imported where they are needed, status and friends never pay for them
 logger = logging.getLogger()
 
 ANSI_ESCAPE = compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
 # https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
 # 0a, 0d and 1b need special process
 GENERAL_NON_PRINTABLE = {b'\x07', b'\x08', b'\x09', b'\x0b', b'\x0c', b'\x7f'}
+_DELETE_NON_PRINTABLE = b''.join(GENERAL_NON_PRINTABLE)
+SHOW_CURSOR, HIDE_CURSOR = '\x1b[?25h', '\x1b[?25l'
 
 class UnknownQuestionError(subprocess.SubprocessError):
     def __init__(self, question, output=None):
@@ -25,111 +29,241 @@ class UnknownQuestionError(subprocess.SubprocessError):
     def __str__(self):
         return f"Pacman returned an unknown question {self.question}"
 
-def execute_with_io(command: List[str], timeout: int = 3600, interactive: bool = False) -> List[str]:
+class OutputCapture:
     '''
-        captures stdout and stderr and
-        automatically handles [y/n] questions of pacman
+        assembles raw pty output into ANSI-stripped lines incrementally,
+        once more than spill_size bytes of lines are kept they are moved to a temporary file
+        iterating yields every complete line followed by the trailing partial line
     '''
-    def terminate(p: subprocess.Popen, timeout: int = 30, signal: Signals = SIGTERM) -> None:
-        p.send_signal(signal)
+    def __init__(self, on_line: Callable[[str], None] = None, spill_size: int = 16 * 1024**2) -> None:
+        self._on_line = on_line
+        self._spill_size = spill_size
+        self._decoder = getincrementaldecoder('utf-8')(errors='replace')
+        self._lines: List[str] = list()
+        self._size = 0
+        self._spill: TextIO = None
+        self.partial = ''
+        self.bytes = 0
+        self.closed = False
+    def feed(self, raw: bytes) -> None:
+        self.bytes += len(raw)
+        text = self._decoder.decode(raw.translate(None, _DELETE_NON_PRINTABLE))
+        if '\n' not in text:
+            self.partial += text
+            return
+        first, *lines = text.split('\n')
+        self._add(self.partial + first)
+        self.partial = lines.pop()
+        for line in lines:
+            self._add(line)
+    def _add(self, line: str) -> None:
+        line = ANSI_ESCAPE.sub('', line.removesuffix('\r'))
+        logger.log(logging.DEBUG+1, 'STDOUT: %s', line)
+        if self._on_line:
+            self._on_line(line)
+        if self._spill:
+            self._spill.write(f"{line}\n")
+            return
+        self._lines.append(line)
+        self._size += len(line) + 1
+        if self._size > self._spill_size:
+            logger.debug(f'output exceeds {self._spill_size} bytes, spilling to a temporary file')
+            from tempfile import TemporaryFile
+            # only \n ends a line, a \r of progress output stays within it like in memory
+            self._spill = TemporaryFile('w+', encoding='utf-8', errors='replace', newline='\n')
+            self._spill.write('\n'.join(self._lines))
+            self._spill.write('\n')
+            self._lines = list()
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.partial = ANSI_ESCAPE.sub('', self.partial + self._decoder.decode(b'', final=True))
+        if self._on_line and self.partial:
+            self._on_line(self.partial)
+    def __iter__(self) -> Iterator[str]:
+        if self._spill:
+            self._spill.flush()
+            self._spill.seek(0)
+            for line in self._spill:
+                yield line[:-1]
+            self._spill.seek(0, 2)
+        else:
+            yield from self._lines
+        yield self.partial
+    def __str__(self) -> str:
+        return '\n'.join(self)
+
+ESCALATION = (SIGINT, SIGTERM, SIGKILL)
+def _decode(data: bytes) -> str:
+    return data.decode('utf-8', errors='replace') if data is not None else None
+
+async def terminate(proc: 'asyncio.subprocess.Process', signal: Signals = SIGTERM, grace: float = 30, group: bool = False) -> None:
+    '''
+        sends signal and escalates along SIGINT -> SIGTERM -> SIGKILL every grace seconds until proc exits,
+        with group the whole process group led by proc is signaled
+    '''
+    import asyncio
+    for sig in ESCALATION[ESCALATION.index(signal):]:
+        if proc.returncode is not None:
+            return
+        if sig == SIGKILL:
+            logger.critical(f'unable to terminate {proc.pid}, killing')
         try:
-            p.wait(timeout=30)
-        except subprocess.TimeoutExpired:
-            logger.critical(f'unable to terminate {p}, killing')
-            p.kill()
-    def set_timeout(p: subprocess.Popen, timeout: int, callback: Callable = lambda: None) -> None:
+            if group:
+                killpg(proc.pid, sig)
+            else:
+                proc.send_signal(sig)
+        except ProcessLookupError:
+            return
         try:
-            p.wait(timeout=timeout)
-        except subprocess.TimeoutExpired:
-            logger.exception(f'{timeout=} expired for {p}, terminating')
-            terminate(p)
-        else:
-            logger.debug('set_timeout exit')
-        finally:
-            callback()
+            await asyncio.wait_for(proc.wait(), grace)
+        except asyncio.TimeoutError:
+            continue
+        return
+
+async def execute_async(command: List[str], timeout: float = None, check: bool = False,
+                        stdout: int = subprocess.PIPE, stderr: int = subprocess.STDOUT) -> subprocess.CompletedProcess:
+    '''
+        asyncio counterpart of subprocess.run with stdin from /dev/null and utf-8 output,
+        raises subprocess.TimeoutExpired after terminating the command once timeout is reached,
+        the command runs in its own session so that nothing it spawned outlives it
+    '''
+    import asyncio
+    logger.debug(f"running {command}")
+    proc = await asyncio.create_subprocess_exec(*command, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr,
+                                                start_new_session=True)
+    communicate = asyncio.ensure_future(proc.communicate())
+    try:
+        async with asyncio.timeout(timeout):
+            out, err = await asyncio.shield(communicate)
+    except TimeoutError:
+        logger.debug(f'{timeout=} expired for {command}, terminating')
+        await terminate(proc, group=True)
+        out, err = await communicate
+        raise subprocess.TimeoutExpired(command, timeout, output=_decode(out), stderr=_decode(err)) from None
+    except BaseException:
+        await terminate(proc, SIGINT, group=True)
+        raise
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command, _decode(out), _decode(err))
+    return subprocess.CompletedProcess(command, proc.returncode, _decode(out), _decode(err))
+
+def execute(command: List[str], timeout: float = None, check: bool = False,
+            stdout: int = subprocess.PIPE, stderr: int = subprocess.STDOUT) -> subprocess.CompletedProcess:
+    import asyncio
+    return asyncio.run(execute_async(command, timeout, check, stdout, stderr))
+
+async def execute_with_io_async(command: List[str], timeout: float = 3600, interactive: bool = False,
+                                on_line: Callable[[str], None] = None, on_poll: Callable[[], None] = None,
+                                poll_interval: float = 1, answers: Sequence[Tuple[Pattern, str]] = ()) -> OutputCapture:
+    '''
+        runs command in a pty, captures stdout and stderr and
+        automatically handles [y/n] questions of pacman
+        on_line is called with every complete line of output,
+        on_poll every poll_interval seconds while the command is running,
+        a prompt fully matching a regex in answers is replied with its answer
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
     ptymaster, ptyslave = openpty()
     set_blocking(ptymaster, False)
-    stdout = open(ptymaster, "rb", buffering=0)
-    stdin = open(ptymaster, "w")
-    p = subprocess.Popen(
-            command,
-            stdin=ptyslave,
-            stdout=ptyslave,
-            stderr=ptyslave,
-    )
-    logger.log(logging.DEBUG+1, f"running {command}")
     try:
-        def cleanup():
-            actions = (
-                (stdin, "close"),
-                (stdout, "close"),
-                (ptymaster, os_close),
-                (ptyslave, os_close),
-            )
-            for obj, action in actions:
-                try:
-                    if isinstance(action, str):
-                        getattr(obj, action)()
-                    else:
-                        action(obj)
-                except OSError:
-                    pass
-        Thread(target=set_timeout, args=(p, timeout, cleanup), daemon=True).start()
-        output = ''
-        SHOW_CURSOR, HIDE_CURSOR = '\x1b[?25h', '\x1b[?25l'
-        while p.poll() is None:
+        proc = await asyncio.create_subprocess_exec(*command, stdin=ptyslave, stdout=ptyslave, stderr=ptyslave)
+    except BaseException:
+        os_close(ptymaster)
+        raise
+    finally:
+        # the master reads EIO once the child and everything it spawned closed the slave
+        os_close(ptyslave)
+    logger.log(logging.DEBUG+1, f"running {command}")
+    output = OutputCapture(on_line=on_line)
+    chunks: asyncio.Queue[Union[bytes, None]] = asyncio.Queue()
+    reading = True
+    def read(drain: bool = False) -> None:
+        nonlocal reading
+        while reading:
             try:
-                select([ptymaster], list(), list())
-                _raw = stdout.read()
-            except (OSError, ValueError):
-                # should be cleanup routine closed the fd, lets check the process return code
-                continue
-            if not _raw:
-                logger.debug('read void from stdout')
-                continue
-            logger.debug(f"raw stdout: {_raw}")
-            for b in GENERAL_NON_PRINTABLE:
-                _raw = _raw.replace(b, b'')
-            raw = _raw.decode('utf-8', errors='replace')
-            raw = raw.replace('\r\n', '\n').replace(HIDE_CURSOR, '')
-            rawl = raw.split('\n')
-            if output and output[-1] != '\n':
-                rawl[0] = output[output.rfind('\n')+1:] + rawl[0]
-            output += raw
-            for l in rawl[:-1]:
-                l = ANSI_ESCAPE.sub('', l)
-                logger.log(logging.DEBUG+1, 'STDOUT: %s', l)
-            rstrip1 = lambda x: x[:-1] if x.endswith(' ') else x
-            rstrip_cursor = lambda s: rstrip1(s[:-len(SHOW_CURSOR)]) if s.endswith(SHOW_CURSOR) else f"{s}<no show cursor>"
-            for l in rawl:
-                line = rstrip_cursor(l)
-                if line == ':: Proceed with installation? [Y/n]':
-                    need_attention = False
-                    stdin.write('y\n')
-                    stdin.flush()
-                elif line.lower().endswith('[y/n]') or line == 'Enter a number (default=1):':
-                    need_attention = False
-                    if interactive:
-                        choice = ask_interactive_question(line, info=output)
-                        if choice is None:
-                            terminate(p, signal=SIGINT)
-                            raise UnknownQuestionError(line, output)
-                        elif choice:
-                            stdin.write(f"{choice}\n")
-                            stdin.flush()
-                    else:
-                        terminate(p, signal=SIGINT)
-                        raise UnknownQuestionError(line, output)
-    except (KeyboardInterrupt, UnknownQuestionError):
-        terminate(p, signal=SIGINT)
+                data = os_read(ptymaster, 65536)
+            except BlockingIOError:
+                if not drain:
+                    return
+                data = b''
+            except OSError:
+                data = b''
+            if not data:
+                reading = False
+                loop.remove_reader(ptymaster)
+                chunks.put_nowait(None)
+                return
+            chunks.put_nowait(data)
+            if not drain:
+                return
+    async def reap() -> None:
+        await proc.wait()
+        # descendants may keep the slave open, take what is buffered and stop there
+        read(drain=True)
+    async def poll() -> None:
+        while True:
+            await asyncio.sleep(poll_interval)
+            on_poll()
+    async def answer(line: str) -> None:
+        if line in (':: Proceed with installation? [Y/n]', ':: Proceed with download? [Y/n]'):
+            os_write(ptymaster, b'y\n')
+        elif reply := next((reply for regex, reply in answers if regex.fullmatch(line)), None):
+            logger.info(f'answering {reply!r} to {line!r}')
+            os_write(ptymaster, f"{reply}\n".encode('utf-8'))
+        elif line.lower().endswith('[y/n]') or line == 'Enter a number (default=1):':
+            if not interactive:
+                raise UnknownQuestionError(line, str(output))
+            choice = await asyncio.to_thread(ask_interactive_question, line, info=str(output))
+            if choice is None:
+                raise UnknownQuestionError(line, str(output))
+            elif choice:
+                os_write(ptymaster, f"{choice}\n".encode('utf-8'))
+    loop.add_reader(ptymaster, read)
+    helpers = [asyncio.create_task(reap())]
+    if on_poll:
+        helpers.append(asyncio.create_task(poll()))
+    try:
+        async with asyncio.timeout(timeout):
+            checked = ''
+            while (raw := await chunks.get()) is not None:
+                logger.debug('raw stdout: %r', raw)
+                output.feed(raw)
+                # only a partial line can be a question waiting for an answer
+                if not output.partial.endswith(SHOW_CURSOR) or output.partial is checked:
+                    continue
+                checked = output.partial
+                await answer(checked[:-len(SHOW_CURSOR)].replace(HIDE_CURSOR, '').removesuffix(' '))
+            ret = await proc.wait()
+    except TimeoutError:
+        logger.error(f'{timeout=} expired for {command}, terminating')
+        await terminate(proc)
+        raise subprocess.TimeoutExpired(command, timeout, output=str(output)) from None
+    except (asyncio.CancelledError, UnknownQuestionError):
+        await terminate(proc, SIGINT)
         raise
-    except Exception:
-        terminate(p)
+    except BaseException:
+        await terminate(proc)
         raise
-    if (ret := p.wait()) != 0:
-        raise subprocess.CalledProcessError(ret, command, output)
-    output = ANSI_ESCAPE.sub('', output)
-    return output.split('\n')
+    finally:
+        for task in helpers:
+            task.cancel()
+        if reading:
+            reading = False
+            loop.remove_reader(ptymaster)
+        os_close(ptymaster)
+    output.close()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, command, str(output))
+    return output
+
+def execute_with_io(command: List[str], timeout: float = 3600, interactive: bool = False,
+                    on_line: Callable[[str], None] = None, on_poll: Callable[[], None] = None,
+                    poll_interval: float = 1, answers: Sequence[Tuple[Pattern, str]] = ()) -> OutputCapture:
+    import asyncio
+    return asyncio.run(execute_with_io_async(command, timeout, interactive, on_line, on_poll, poll_interval, answers))
 
 def pacman_time_to_timestamp(stime: str) -> int:
     ''' the format pacman is using seems to be not iso compatible '''
@@ -137,22 +271,51 @@ def pacman_time_to_timestamp(stime: str) -> int:
     return mktime(dt.astimezone().timetuple())
 pacman_time_to_timestamp('2024-01-01T00:00:00+0000')
 
-def back_readline(fp: BinaryIO) -> Iterator[str]:
-    pos = fp.seek(0, 2)
-    if pos == 0:
+def back_readline_bytes(fp: BinaryIO, offset: int = None, block_size: int = DEFAULT_BUFFER_SIZE) -> Iterator[bytes]:
+    ''' lines of fp before offset (default: end of file) from last to first, without newlines '''
+    end = fstat(fp.fileno()).st_size
+    if offset is not None:
+        end = min(offset, end)
+    if end <= 0:
         return
-    previous = b''
-    while pos > 0:
-        next = max(pos - DEFAULT_BUFFER_SIZE, 0)
-        fp.seek(next)
-        got = fp.read(pos - next)
-        got = got + previous
-        blines = got.split(b'\n')
-        while len(blines) > 1:
-            yield blines.pop(-1).decode('utf-8')
-        previous = blines[0]
-        pos = next
-    yield blines.pop(-1).decode('utf-8')
+    with mmap(fp.fileno(), 0, access=ACCESS_READ) as mm:
+        pos = end
+        while True:
+            start = max(pos - block_size, 0)
+            if start > 0:
+                # begin the block at a line boundary, a line may be longer than the block
+                if (nl := mm.find(b'\n', start, pos)) < 0:
+                    nl = mm.rfind(b'\n', 0, start)
+                start = nl + 1
+            yield from reversed(mm[start:pos].split(b'\n'))
+            if start == 0:
+                return
+            pos = start - 1
+            # the further back a reader goes, the more it is likely to read
+            block_size = min(block_size * 2, 1024**2 * 4)
+
+def back_readline(fp: BinaryIO, offset: int = None) -> Iterator[str]:
+    for line in back_readline_bytes(fp, offset):
+        yield line.decode('utf-8')
+
+class LogTail:
+    ''' follows a growing text file from offset, handing out complete lines only '''
+    def __init__(self, path: str, offset: int = 0) -> None:
+        self._fp = open(path, 'rb')
+        self._fp.seek(offset)
+        self._partial = b''
+    def read_lines(self, final: bool = False) -> List[str]:
+        ''' with final, a trailing line without newline is returned as well '''
+        lines = list()
+        while got := self._fp.read(DEFAULT_BUFFER_SIZE * 16):
+            *blines, self._partial = (self._partial + got).split(b'\n')
+            lines.extend(l.decode('utf-8', errors='replace') for l in blines)
+        if final and self._partial:
+            lines.append(self._partial.decode('utf-8', errors='replace'))
+            self._partial = b''
+        return lines
+    def close(self) -> None:
+        self._fp.close()
 
 def ask_interactive_question(question: str = "", timeout: int = 60, info: str = "") -> Union[str, None]:
     ''' on timeout, returns None '''
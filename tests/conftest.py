@@ -0,0 +1,13 @@
+import pytest
+from pacroller import matcher
+
+@pytest.fixture(autouse=True)
+def rule_stats(tmp_path, monkeypatch):
+    ''' rule statistics of the test alone, not the ones in LIB_DIR '''
+    monkeypatch.setattr(matcher, '_rule_stats', matcher.RuleStats(tmp_path / 'rules.json'))
+    monkeypatch.setattr(matcher, '_recording', False)
+    matcher._hook_matchers.clear()
+    matcher._package_matchers.clear()
+    yield matcher._rule_stats
+    matcher._hook_matchers.clear()
+    matcher._package_matchers.clear()
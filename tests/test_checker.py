@@ -0,0 +1,64 @@
+# the reports in data/*.json are what the checker made of data/*.log and data/*.stdout
+# before it was rewritten around LogTokenizer and LogParser, nothing it reports may change
+import json
+from pathlib import Path
+import pytest
+from pacroller.checker import (LogParser, LogTokenizer, StdoutParser, checkReport, _log_parser, _stdout_parser,
+                               log_checker, tokenize_log)
+
+DATA = Path(__file__).parent / 'data'
+CASES = sorted(p.stem for p in DATA.glob('*.log'))
+
+def load(name: str):
+    log = (DATA / f'{name}.log').read_text().rstrip('\n').split('\n')
+    stdout = (DATA / f'{name}.stdout').read_text().split('\n')
+    return log, stdout, json.loads((DATA / f'{name}.json').read_text())
+
+def reported(report: checkReport) -> dict:
+    ''' the fields the old checker had, as they are stored '''
+    ret = json.loads(json.dumps(report.to_dict()))
+    return {k: ret[k] for k in ('info', 'warn', 'crit', 'changes')}
+
+@pytest.mark.parametrize('name', CASES)
+def test_parsers_match_baseline(name):
+    log, stdout, expected = load(name)
+    report = checkReport()
+    _stdout_parser(stdout, report)
+    _log_parser(log, report)
+    assert reported(report) == expected
+
+@pytest.mark.parametrize('name', CASES)
+def test_log_checker_matches_baseline(name):
+    log, stdout, expected = load(name)
+    assert reported(log_checker(stdout, log)) == expected
+
+@pytest.mark.parametrize('name', CASES)
+def test_streaming_matches_baseline(name):
+    ''' line by line as StreamChecker feeds them, stdout and the log interleaved '''
+    log, stdout, expected = load(name)
+    report = checkReport()
+    stdout_parser, log_parser, tokenizer = StdoutParser(report), LogParser(report), LogTokenizer()
+    for n in range(max(len(log), len(stdout))):
+        if n < len(stdout):
+            stdout_parser.feed(stdout[n])
+        if n < len(log) and (record := tokenizer.feed(log[n])):
+            log_parser.feed(record)
+    if record := tokenizer.flush():
+        log_parser.feed(record)
+    stdout_parser.close()
+    log_parser.close()
+    assert reported(report) == expected
+
+def test_tokenizer_joins_continuation_lines():
+    log = [
+        '[2024-05-02T09:13:00+0200] [ALPM] upgraded chatty (1.0-1 -> 1.1-1)',
+        '[2024-05-02T09:13:00+0200] [ALPM-SCRIPTLET] spanning',
+        '  two lines',
+        '[2024-05-02T09:13:01+0200] [ALPM] transaction completed',
+    ]
+    records = list(tokenize_log(log))
+    assert [(r.offset, r.timestamp, r.source, r.message) for r in records] == [
+        (0, 1714633980, 'ALPM', 'upgraded chatty (1.0-1 -> 1.1-1)'),
+        (1, 1714633980, 'ALPM-SCRIPTLET', 'spanning   two lines'),
+        (3, 1714633981, 'ALPM', 'transaction completed'),
+    ]
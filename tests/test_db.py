@@ -0,0 +1,96 @@
+import json
+import logging
+import os
+import sqlite3
+from time import time
+import pytest
+from pacroller.db import StatusDB
+
+NOW = int(time())
+DAY = 86400
+
+def report(date: int, **kwargs) -> dict:
+    return {'info': [], 'warn': [], 'crit': [], 'changes': [], 'date': date, **kwargs}
+
+def rows(db: StatusDB) -> list:
+    return list(db._conn.execute('SELECT date, error, has_report FROM entries ORDER BY id'))
+
+@pytest.fixture
+def legacy(tmp_path):
+    ''' a json-lines db as older versions wrote it, last modified a minute ago '''
+    path = tmp_path / 'db'
+    lines = [
+        {'error': 'e0', 'report': None},
+        {'error': None, 'report': report(NOW - 100 * DAY, info=['old'])},
+        {'error': 'e1', 'report': None},
+        {'error': None, 'report': report(NOW - DAY, warn=['pacnew'])},
+        {'error': 'e2', 'report': None},
+    ]
+    path.write_text(''.join(f"{json.dumps(line)}\n" for line in lines))
+    os.utime(path, (NOW - 60, NOW - 60))
+    return path
+
+def test_migrate(tmp_path, legacy):
+    db = StatusDB(tmp_path / 'status.sqlite', legacy)
+    # error-only lines have no date, only the last one can take the file's
+    assert rows(db) == [(None, 'e0', 0), (NOW - 100 * DAY, None, 1), (None, 'e1', 0), (NOW - DAY, None, 1),
+                        (NOW - 60, 'e2', 0)]
+    assert not legacy.exists() and legacy.with_name('db.migrated').exists()
+    assert db.last_error() == 'e2'
+    entries = list(db.entries(reports_only=True))
+    assert [e['report']['date'] for e in entries] == [NOW - DAY, NOW - 100 * DAY]
+    assert entries[0]['report']['warn'] == ['pacnew']
+    # once is enough
+    assert rows(StatusDB(tmp_path / 'status.sqlite', legacy)) == rows(db)
+
+def test_compact_takes_undated_entries_along(tmp_path, legacy):
+    db = StatusDB(tmp_path / 'status.sqlite', legacy)
+    db.compact(30)
+    assert [error for _, error, _ in rows(db)] == ['e1', None, 'e2']
+    db.compact(0)
+    assert len(rows(db)) == 3
+
+def test_compact_keeps_the_latest(tmp_path):
+    db = StatusDB(tmp_path / 'status.sqlite', tmp_path / 'db')
+    db.write(None, report(NOW - 100 * DAY))
+    db.write(None, report(NOW - 90 * DAY))
+    db.compact(30)
+    assert rows(db) == [(NOW - 90 * DAY, None, 1)]
+
+def test_compact_vacuums_only_a_mostly_free_file(tmp_path, caplog):
+    db = StatusDB(tmp_path / 'status.sqlite', tmp_path / 'db')
+    for n in range(200):
+        db.write(None, report(NOW - (300 - n) * DAY, info=['x' * 2000]))
+    db.write(None, report(NOW))
+    caplog.set_level(logging.DEBUG)
+    db.compact(250)
+    assert 140 < len(rows(db)) < 160 and 'vacuuming' not in caplog.text
+    pages = db._conn.execute('PRAGMA page_count').fetchone()[0]
+    db.compact(30)
+    assert len(rows(db)) == 1 and 'vacuuming' in caplog.text
+    assert db._conn.execute('PRAGMA page_count').fetchone()[0] < pages / 10
+
+def test_upgrade_from_version_2(tmp_path):
+    path = tmp_path / 'status.sqlite'
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE entries (id INTEGER PRIMARY KEY AUTOINCREMENT, date INTEGER NOT NULL, error TEXT,
+            failed INTEGER NOT NULL, has_report INTEGER NOT NULL, info TEXT, warn TEXT, crit TEXT, changes TEXT,
+            timings TEXT);
+        CREATE INDEX entries_error ON entries (error) WHERE error IS NOT NULL;
+        INSERT INTO entries (date, error, failed, has_report) VALUES (1, 'boom', 1, 0);
+        PRAGMA user_version = 2;
+    ''')
+    conn.close()
+    db = StatusDB(path, tmp_path / 'db')
+    assert 'failed' not in [row[1] for row in db._conn.execute('PRAGMA table_info(entries)')]
+    assert 'entries_error' not in [row[1] for row in db._conn.execute('PRAGMA index_list(entries)')]
+    assert db.last_error() == 'boom'
+    db.write(None, report(NOW, timings={'phases': {'run': 1.0}}))
+    assert next(db.entries())['report']['timings'] == {'phases': {'run': 1.0}}
+
+def test_write_without_a_database(tmp_path):
+    db = StatusDB(tmp_path / 'missing' / 'status.sqlite', tmp_path / 'db')
+    assert db._conn is None
+    with pytest.raises(sqlite3.OperationalError, match='could not be opened for writing'):
+        db.write('boom', None)
@@ -0,0 +1,109 @@
+import json
+import pytest
+from pacroller.logindex import TransactionIndex
+from pacroller.utils import pacman_time_to_timestamp
+
+def transaction(stime: str, package: str) -> str:
+    return (f"[{stime}] [PACMAN] Running 'pacman -Syu'\n"
+            f"[{stime}] [ALPM] transaction started\n"
+            f"[{stime}] [ALPM] upgraded {package} (1-1 -> 2-1)\n"
+            f"[{stime}] [ALPM] transaction completed\n")
+
+T1, T2, T3 = '2024-01-01T10:00:00+0000', '2024-02-01T10:00:00+0000', '2024-03-01T10:00:00+0000'
+
+@pytest.fixture
+def log(tmp_path):
+    path = tmp_path / 'pacman.log'
+    path.write_text(f"[{T1}] [PACMAN] synchronizing package lists\n" + transaction(T1, 'a') + transaction(T2, 'b'))
+    return path
+
+def index(log, tmp_path) -> TransactionIndex:
+    idx = TransactionIndex(str(log), tmp_path / 'index.json')
+    idx.update()
+    return idx
+
+def upgraded(idx: TransactionIndex, i: int) -> str:
+    return next(line for line in idx.read(i) if 'upgraded' in line).split()[3]
+
+def test_index(log, tmp_path):
+    idx = index(log, tmp_path)
+    assert len(idx) == 2 and idx.ordered
+    assert idx.times == [pacman_time_to_timestamp(T1), pacman_time_to_timestamp(T2)]
+    assert [upgraded(idx, i) for i in range(2)] == ['a', 'b']
+    # what comes before the first transaction is left for the caller
+    assert idx.offsets[0] == log.read_text().index(f"[{T1}] [ALPM] transaction started")
+    assert idx.span(1)[1] == log.stat().st_size
+
+def test_extended_from_saved_index(log, tmp_path, monkeypatch):
+    end = index(log, tmp_path).end
+    with open(log, 'a') as f:
+        f.write(transaction(T3, 'c'))
+        # not ended yet, indexed by the next update
+        f.write(f"[{T3}] [ALPM] transaction started")
+    idx = TransactionIndex(str(log), tmp_path / 'index.json')
+    scanned = list()
+    scan = TransactionIndex._scan
+    monkeypatch.setattr(TransactionIndex, '_scan', lambda self, f: scanned.append(self.end) or scan(self, f))
+    idx.update()
+    assert scanned == [end]
+    assert [upgraded(idx, i) for i in range(3)] == ['a', 'b', 'c']
+    assert idx.end < log.stat().st_size
+    saved = json.loads((tmp_path / 'index.json').read_text())[idx.log_file]
+    assert saved['offsets'] == idx.offsets and saved['end'] == idx.end
+
+def test_final_line_completed(log, tmp_path):
+    with open(log, 'a') as f:
+        f.write(f"[{T3}] [ALPM] transaction started")
+    idx = index(log, tmp_path)
+    assert len(idx) == 2
+    with open(log, 'a') as f:
+        f.write("\n")
+    idx = index(log, tmp_path)
+    assert len(idx) == 3 and idx.end == log.stat().st_size
+
+@pytest.mark.parametrize('rotate', ['replace', 'truncate', 'rewrite'])
+def test_rebuilt_after_rotation(log, tmp_path, rotate):
+    index(log, tmp_path)
+    content = transaction(T3, 'c')
+    if rotate == 'replace':
+        log.rename(log.with_name('pacman.log.1'))
+        log.write_text(content)
+    elif rotate == 'truncate':
+        with open(log, 'w') as f:
+            f.write(content)
+    else:
+        # same inode and at least as long, only the head tells
+        size = log.stat().st_size
+        content = (content * (size // len(content) + 1))
+        with open(log, 'r+') as f:
+            f.write(content)
+    idx = index(log, tmp_path)
+    assert idx.offsets[0] == content.index(f"[{T3}] [ALPM] transaction started")
+    assert len(idx) == content.count('transaction started') and all(upgraded(idx, i) == 'c' for i in range(len(idx)))
+    assert idx.end == log.stat().st_size
+
+def test_unordered_times(log, tmp_path):
+    with open(log, 'a') as f:
+        # the clock went back
+        f.write(transaction('2023-12-01T10:00:00+0000', 'c'))
+        f.write(transaction(T3, 'd'))
+    idx = index(log, tmp_path)
+    assert not idx.ordered
+    t = pacman_time_to_timestamp
+    assert list(idx.between(t('2024-01-15T00:00:00+0000'))) == [1, 3]
+    assert list(idx.between(until=t(T1))) == [0, 2]
+    assert list(idx.between(t('2023-11-01T00:00:00+0000'), t('2023-12-31T00:00:00+0000'))) == [2]
+    assert list(idx.between()) == [0, 1, 2, 3]
+
+def test_ordered_bisection(log, tmp_path):
+    idx = index(log, tmp_path)
+    t = pacman_time_to_timestamp
+    assert idx.between(t(T2), t(T3)) == range(1, 2)
+    assert idx.between(until=t(T1)) == range(0, 1)
+    assert not idx.between(t(T3))
+
+def test_bad_time_keeps_order(log, tmp_path):
+    with open(log, 'a') as f:
+        f.write(transaction('not a time', 'c'))
+    idx = index(log, tmp_path)
+    assert idx.ordered and idx.times[2] == idx.times[1]
@@ -0,0 +1,20 @@
+import subprocess
+import sys
+
+STATUS = '''
+import sys
+import pacroller.main
+sys.argv = ['pacroller', 'status']
+try:
+    pacroller.main.main()
+except SystemExit:
+    pass
+print(' '.join(sorted(sys.modules)), file=sys.stderr)
+'''
+
+def test_status_does_not_load_the_rules():
+    ''' known_output runs known_output_override.py, status has no output to check '''
+    p = subprocess.run([sys.executable, '-c', STATUS], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    modules = set(p.stderr.split('\n')[-2].split())
+    assert 'pacroller.main' in modules
+    assert not modules & {'pacroller.known_output', 'pacroller.matcher', 'asyncio'}
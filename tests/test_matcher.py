@@ -0,0 +1,99 @@
+import re
+import pytest
+from pacroller import matcher
+from pacroller.matcher import RuleMatcher, RuleStats, hook_matcher, record_rules
+
+RULES = [
+    r'==> Building image from preset: .*',
+    r'==> .*',
+    r'(?i)warning: .+',
+    r'gpg: .* trustdb',
+    r'[0-9]+ files? updated',
+    r'.*done\.?',
+    r'Generating locales\.\.\.',
+]
+MESSAGES = [
+    "==> Building image from preset: /etc/mkinitcpio.d/linux.preset: 'default'",
+    '==> Image generation successful',
+    'WARNING: something',
+    'warning: something',
+    'gpg: checking the trustdb',
+    'gpg: no ultimately trusted keys found',
+    '12 files updated',
+    '1 file updated',
+    '  en_US.UTF-8... done',
+    'Generating locales...',
+    'nothing knows this',
+    '',
+]
+
+def first_match(rules, msg):
+    ''' what matching one rule after the other in list order gives '''
+    return next((rule for regex, rule in rules if re.match(regex, msg)), None)
+
+@pytest.mark.parametrize('msg', MESSAGES)
+def test_first_rule_in_list_order(msg):
+    rules = [(r, r) for r in RULES]
+    assert RuleMatcher(rules).match(msg) == first_match(rules, msg)
+
+def test_overlapping_rules_report_the_first():
+    rules = [(r'==> .*', 'generic'), (r'==> Building .*', 'specific')]
+    assert RuleMatcher(rules).match('==> Building image') == 'generic'
+
+def test_rules_without_prefix_keep_their_place():
+    rules = [(r'.*done', 'suffix'), (r'==> .*', 'prefixed')]
+    m = RuleMatcher(rules)
+    assert m.match('==> done') == 'suffix'
+    assert m.match('==> started') == 'prefixed'
+
+def test_hits_put_frequent_rules_first():
+    rules = [(r'==> .*', 'generic'), (r'==> Building .*', 'specific')]
+    m = RuleMatcher(rules, hits=[1, 5])
+    assert m.match('==> Building image') == 'specific'
+    assert m.match('==> Image generation successful') == 'generic'
+
+def test_ties_keep_list_order():
+    rules = [(r'a.*', 'first'), (r'ab.*', 'second'), (r'abc', 'third')]
+    assert RuleMatcher(rules, hits=[0, 0, 0]).match('abc') == 'first'
+
+@pytest.mark.parametrize('rules', [
+    # backreferences cannot be renumbered into one pattern
+    [(r'(\w+) and \1', 'backref'), (r'.*', 'any')],
+    # neither can two rules defining the same group name
+    [(r'(?P<x>a+)b', 'named'), (r'(?P<x>a+)c', 'named too'), (r'.*', 'any')],
+])
+def test_fallback_matches_one_by_one(rules):
+    m = RuleMatcher(rules)
+    assert m._fallback is not None
+    for msg in ('this and this', 'this and that', 'aab', 'aac', 'b'):
+        assert m.match(msg) == first_match(rules, msg)
+
+def test_fallback_keeps_hit_order():
+    rules = [(r'(\w+) and \1', 'backref'), (r'.* and .*', 'any')]
+    m = RuleMatcher(rules, hits=[0, 3])
+    assert m._fallback is not None
+    assert m.match('this and this') == 'any'
+
+def test_counting(tmp_path):
+    stats = RuleStats(tmp_path / 'rules.json')
+    counters, scope = [[0, 0.0, 0], [0, 0.0, 0]], [0, 0, 0.0]
+    m = RuleMatcher([(r'a.*', 'a'), (r'b.*', 'b')], counters=counters, scope=scope, stats=stats)
+    for msg in ('apple', 'banana', 'avocado', 'cherry'):
+        m.match(msg)
+    assert [c[0] for c in counters] == [2, 1]
+    assert counters[0][2] == stats.now
+    assert scope[:2] == [4, 1]
+
+def test_only_recording_counts(rule_stats):
+    hook = next(iter(h for h in matcher.KNOWN_HOOK_OUTPUT if h))
+    regex = matcher.KNOWN_HOOK_OUTPUT[hook][0]
+    line = 'no rule knows this line'
+    hook_matcher(hook).match(line)
+    assert rule_stats.scopes == dict()
+    record_rules()
+    hook_matcher(hook).match(line)
+    assert rule_stats.scope('hook', hook)[:2] == [1, 1]
+    record_rules(False)
+    hook_matcher(hook).match(line)
+    assert rule_stats.scope('hook', hook)[:2] == [1, 1]
+    assert rule_stats.hits('hook', hook, regex) == 0
@@ -0,0 +1,123 @@
+import asyncio
+import gzip
+import os
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep, time
+import pytest
+from pacroller.mirrors import MirrorStats, MirrorSync, MirrorSyncError
+
+REPOS = ('core', 'extra')
+MTIME = time() - 3600
+
+def make_handler(behaviour: str, dbs: dict):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def log_message(self, *_) -> None:
+            pass
+        def do_GET(self) -> None:
+            name = self.path.rsplit('/', 1)[-1]
+            body = dbs[name.split('.', 1)[0]]
+            if name.endswith('.sig'):
+                body = b'sig:' + body[:16]
+            elif behaviour == 'stale' or ((since := self.headers.get('If-Modified-Since'))
+                                          and parsedate_to_datetime(since).timestamp() >= int(MTIME)):
+                # a stale mirror says whatever we have is fine, and says it first
+                if behaviour != 'stale':
+                    sleep(0.2)
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.close_connection = True
+                return
+            self.send_response(200)
+            self.send_header('Last-Modified', formatdate(MTIME, usegmt=True))
+            self.send_header('Connection', 'close')
+            if behaviour == 'chunked':
+                # the last chunk is cut short and the terminating chunk never comes
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                half = len(body) // 2
+                self.wfile.write(f"{half:x}\r\n".encode() + body[:half] + b'\r\n')
+                self.wfile.write(f"{len(body) - half:x}\r\n".encode() + body[half:-10])
+            elif behaviour == 'short':
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body[:len(body) // 2])
+            else:
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            self.wfile.flush()
+            self.close_connection = True
+    return Handler
+
+async def verify(sig, db) -> bool:
+    return sig.read_bytes() == b'sig:' + db.read_bytes()[:16]
+
+@pytest.fixture
+def mirrors(tmp_path):
+    ''' (pacman.conf writer, databases every good mirror serves) '''
+    dbs = {repo: gzip.compress(repo.encode() * 50000) for repo in REPOS}
+    servers = dict()
+    def start(behaviour: str) -> str:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(behaviour, dbs))
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        servers[behaviour] = server
+        return f"http://127.0.0.1:{server.server_port}/$repo/os/$arch"
+    def conf(*behaviours: str) -> str:
+        mirrorlist = '\n'.join(f"Server = {start(b)}" for b in behaviours)
+        (tmp_path / 'mirrorlist').write_text(mirrorlist)
+        text = [f"[options]\nDBPath = {tmp_path / 'db'}\nArchitecture = x86_64\nSigLevel = Required DatabaseRequired"]
+        text.extend(f"[{repo}]\nInclude = {tmp_path / 'mirrorlist'}" for repo in REPOS)
+        (tmp_path / 'pacman.conf').write_text('\n'.join(text))
+        return str(tmp_path / 'pacman.conf')
+    yield conf, dbs
+    for server in servers.values():
+        server.shutdown()
+        server.server_close()
+
+def engine(tmp_path, conf: str, race: int) -> MirrorSync:
+    return MirrorSync(conf, race=race, timeout=10, stats=MirrorStats(tmp_path / 'mirrors.json'),
+                      verify=verify, lock=str(tmp_path / 'db.lck'))
+
+@pytest.mark.parametrize('truncated', ['short', 'chunked'])
+@pytest.mark.parametrize('race', [1, 3])
+def test_failover_on_truncated_body(tmp_path, mirrors, truncated, race):
+    conf, dbs = mirrors
+    sync = engine(tmp_path, conf(truncated, 'good'), race)
+    assert asyncio.run(sync.sync()) == {repo: True for repo in REPOS}
+    for repo in REPOS:
+        assert (tmp_path / 'db' / 'sync' / f'{repo}.db').read_bytes() == dbs[repo]
+    assert not list((tmp_path / 'db' / 'sync').glob('.*.part'))
+    good = next(s for s in sync.stats.mirrors if sync.stats.mirrors[s]['failures'] == 0)
+    assert set(sync.servers.values()) == {good}
+    assert sync.stats.rank(list(sync.stats.mirrors))[0] == good
+
+def test_stale_mirror_is_not_preferred(tmp_path, mirrors):
+    ''' core is up to date, the stale mirror says so first and would otherwise be the only one asked for extra '''
+    conf, dbs = mirrors
+    sync = engine(tmp_path, conf('stale', 'good'), 2)
+    sync_dir = tmp_path / 'db' / 'sync'
+    sync_dir.mkdir(parents=True)
+    for repo, mtime in (('core', MTIME), ('extra', MTIME - 86400)):
+        (sync_dir / f'{repo}.db').write_bytes(dbs[repo] if repo == 'core' else b'old')
+        os.utime(sync_dir / f'{repo}.db', (mtime, mtime))
+    assert asyncio.run(sync.sync()) == {'core': False, 'extra': True}
+    assert (sync_dir / 'extra.db').read_bytes() == dbs['extra']
+
+def test_every_mirror_truncated(tmp_path, mirrors):
+    conf, _ = mirrors
+    sync = engine(tmp_path, conf('short', 'chunked'), 2)
+    with pytest.raises(MirrorSyncError, match='unable to download'):
+        asyncio.run(sync.sync())
+    assert not (tmp_path / 'db' / 'sync' / 'core.db').exists()
+    assert not (tmp_path / 'db.lck').exists()
+
+def test_held_lock(tmp_path, mirrors):
+    conf, _ = mirrors
+    (tmp_path / 'db.lck').touch()
+    with pytest.raises(MirrorSyncError, match='unable to lock database'):
+        asyncio.run(engine(tmp_path, conf('good'), 1).sync())
+    assert (tmp_path / 'db.lck').exists()
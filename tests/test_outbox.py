@@ -0,0 +1,96 @@
+import asyncio
+import json
+import pytest
+from pacroller.mailer import SENT, REFUSED, FAILED
+from pacroller.outbox import Outbox
+
+class FakeSender:
+    ''' MailSender answering from a table, failing a destination as many times as asked '''
+    def __init__(self, destinations: dict) -> None:
+        self.channels = [object()]
+        self.destinations = destinations
+        self.sent = list()
+    async def deliver(self, text: str, subject: str, skip=()) -> dict:
+        results = dict()
+        for dest in self.destinations:
+            if dest in skip:
+                continue
+            results[dest] = self.destinations[dest].pop(0) if self.destinations[dest] else SENT
+            if results[dest] == SENT:
+                self.sent.append((dest, subject, text))
+        return results
+
+@pytest.fixture
+def outbox(tmp_path):
+    return Outbox(tmp_path / 'outbox')
+
+def flush(outbox: Outbox, sender: FakeSender):
+    return asyncio.run(outbox.flush(sender))
+
+def test_repeated_notice_is_counted(outbox):
+    outbox.put('upgrade failed', 'subject')
+    outbox.put('upgrade failed', 'subject')
+    outbox.put('something else', 'subject')
+    assert outbox.pending() == 2
+    counts = sorted(json.loads(f.read_text())['count'] for f in outbox.path.glob('msg-*.json'))
+    assert counts == [1, 2]
+
+def test_single_notice_is_sent_as_is(outbox):
+    outbox.put('hello', 'subject')
+    sender = FakeSender({'mail:root': []})
+    assert flush(outbox, sender) is True
+    assert sender.sent == [('mail:root', 'subject', 'hello')]
+    assert outbox.pending() == 0
+
+def test_notices_are_batched(outbox):
+    outbox.put('first', 'one')
+    outbox.put('second', 'two')
+    outbox.put('second', 'two')
+    sender = FakeSender({'mail:root': [], 'telegram:1': []})
+    assert flush(outbox, sender) is True
+    assert len(sender.sent) == 2
+    _, subject, text = sender.sent[0]
+    assert subject.endswith(': 3 notifications')
+    assert text.index('first') < text.index('second')
+    assert '2 times until' in text
+    assert outbox.pending() == 0
+    assert not list(outbox.path.iterdir())
+
+def test_partial_delivery_is_not_repeated(outbox):
+    outbox.put('hello', 'subject')
+    sender = FakeSender({'mail:root': [], 'telegram:1': [FAILED], 'telegram:2': [REFUSED]})
+    assert flush(outbox, sender) is False
+    assert outbox.pending() == 1
+    batch, = outbox.path.glob('batch-*.json')
+    assert sorted(json.loads(batch.read_text())['delivered']) == ['mail:root', 'telegram:2']
+    # queued in the meantime, goes into a batch of its own
+    outbox.put('later', 'subject')
+    assert flush(outbox, sender) is True
+    assert [(dest, text) for dest, _, text in sender.sent] == \
+        [('mail:root', 'hello'), ('telegram:1', 'hello'), ('mail:root', 'later'), ('telegram:1', 'later'), ('telegram:2', 'later')]
+    assert outbox.pending() == 0
+
+def test_interrupted_batching_does_not_resend(outbox):
+    outbox.put('hello', 'subject')
+    msg, = outbox.path.glob('msg-*.json')
+    kept = msg.read_text()
+    outbox._batch()
+    # as if flush was killed before the message was removed
+    msg.write_text(kept)
+    sender = FakeSender({'mail:root': []})
+    assert flush(outbox, sender) is True
+    assert len(sender.sent) == 1
+    assert not list(outbox.path.iterdir())
+
+def test_nowhere_to_deliver(outbox):
+    outbox.put('hello', 'subject')
+    sender = FakeSender({})
+    sender.channels = []
+    assert flush(outbox, sender) is None
+    assert outbox.pending() == 1
+
+def test_concurrent_flush_is_skipped(outbox):
+    outbox.put('hello', 'subject')
+    with outbox._locked('.flush'):
+        assert flush(outbox, FakeSender({'mail:root': []})) is False
+    assert outbox.pending() == 1
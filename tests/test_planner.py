@@ -0,0 +1,74 @@
+import pytest
+from pacroller.config import QUESTION_KINDS
+from pacroller.planner import (DEFAULT_ANSWERS, PROMPTS, QUESTION_TYPES, Q_CONFLICT_PKG, Q_IMPORT_KEY, Q_REPLACE_PKG,
+                               Q_SELECT_PROVIDER, _describe, _replacements, prompt_answers, unanswered)
+
+# the last line of each question as pacman 6 prints it
+PACMAN_PROMPTS = {
+    'install_ignorepkg': ':: linux is in IgnorePkg/IgnoreGroup. Install anyway? [Y/n]',
+    'replace': ':: Replace foo with extra/bar? [Y/n]',
+    'conflict': ':: foo-git and foo are in conflict. Remove foo? [y/N]',
+    'corrupted': 'Do you want to delete it? [Y/n]',
+    'remove_pkgs': 'Do you want to skip the above package for this upgrade? [y/N]',
+    'select_provider': 'Enter a number (default=1):',
+    'import_key': ':: Import PGP key 0123456789ABCDEF, "Someone <someone@example.org>"? [Y/n]',
+}
+
+class Pkg:
+    def __init__(self, name: str, replaces=()) -> None:
+        self.name = name
+        self.replaces = list(replaces)
+
+class DB:
+    def __init__(self, name: str, pkgs) -> None:
+        self.name = name
+        self.pkgcache = pkgs
+    def get_pkg(self, name: str):
+        return next((p for p in self.pkgcache if p.name == name), None)
+
+def test_question_types():
+    assert set(QUESTION_TYPES.values()) == set(QUESTION_KINDS) == set(DEFAULT_ANSWERS) == set(PROMPTS)
+    assert QUESTION_TYPES[Q_REPLACE_PKG] == 'replace'
+    assert QUESTION_TYPES[Q_CONFLICT_PKG] == 'conflict'
+    assert QUESTION_TYPES[Q_SELECT_PROVIDER] == 'select_provider'
+    assert QUESTION_TYPES[Q_IMPORT_KEY] == 'import_key'
+
+@pytest.mark.parametrize('kind', sorted(PACMAN_PROMPTS))
+def test_prompts_match_pacman(kind):
+    line = PACMAN_PROMPTS[kind]
+    assert [k for k, regex in PROMPTS.items() if regex.fullmatch(line)] == [kind]
+
+def test_prompt_answers():
+    policy = {'replace': 'yes', 'conflict': 'no', 'import_key': 'fail', 'select_provider': 'yes'}
+    answers = {regex.pattern: reply for regex, reply in prompt_answers(policy)}
+    assert answers == {PROMPTS['replace'].pattern: 'y', PROMPTS['conflict'].pattern: 'n',
+                       PROMPTS['select_provider'].pattern: '1'}
+    assert prompt_answers(dict()) == []
+
+def test_unanswered():
+    questions = [('replace', 'replace foo with bar'), ('conflict', 'foo and baz are in conflict'),
+                 ('import_key', 'import key 0123')]
+    policy = {'replace': 'yes', 'conflict': 'fail'}
+    assert unanswered(questions, policy) == ['foo and baz are in conflict', 'import key 0123']
+    assert unanswered(questions, {kind: 'no' for kind in QUESTION_KINDS}) == []
+    assert unanswered([], dict()) == []
+
+def test_describe():
+    assert _describe('replace', (Pkg('foo'), Pkg('bar'))) == 'replace foo with bar'
+    assert _describe('conflict', (Pkg('foo'), Pkg('bar'))) == 'foo and bar are in conflict'
+    assert _describe('select_provider', ([Pkg('jre-openjdk'), Pkg('jre17-openjdk')], 'java-runtime')) == \
+        'choose a provider among jre-openjdk, jre17-openjdk'
+    assert _describe('import_key', ('0123456789ABCDEF',)) == 'import key: 0123456789ABCDEF'
+
+@pytest.mark.parametrize('kind', QUESTION_KINDS)
+def test_describe_without_arguments(kind):
+    assert _describe(kind, ()) == f"{kind.replace('_', ' ')} (pyalpm did not say for which packages)"
+
+def test_replacements():
+    local = DB('local', [Pkg('foo'), Pkg('bar'), Pkg('already')])
+    syncdbs = [
+        DB('core', [Pkg('foo-ng', ['foo>=1']), Pkg('unrelated', ['nothere']), Pkg('self', ['self'])]),
+        DB('extra', [Pkg('foo-other', ['foo']), Pkg('bar2', ['bar']), Pkg('already', ['bar'])]),
+    ]
+    assert _replacements(local, syncdbs) == [('replace', 'replace foo with core/foo-ng'),
+                                             ('replace', 'replace bar with extra/bar2')]
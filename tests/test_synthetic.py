@@ -0,0 +1,37 @@
+# the benchmarks are only worth comparing as long as the generator keeps producing the same input the checker understands
+import sys
+from pathlib import Path
+from pacroller.checker import checkReport, _log_parser, _stdout_parser
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'benchmarks'))
+from synthetic import Generator, Profile, write_log  # noqa: E402
+
+def test_same_seed_same_output(tmp_path):
+    for seed in (0, 1):
+        write_log(tmp_path / f'a{seed}', 64 * 1024, Profile(seed=seed))
+        write_log(tmp_path / f'b{seed}', 64 * 1024, Profile(seed=seed))
+        assert (tmp_path / f'a{seed}').read_bytes() == (tmp_path / f'b{seed}').read_bytes()
+    assert (tmp_path / 'a0').read_bytes() != (tmp_path / 'a1').read_bytes()
+
+def test_transaction_parses():
+    generator = Generator(Profile(packages=20, continuation_rate=0.3, seed=3))
+    for _ in range(5):
+        generator.pause()
+        log, stdout = generator.transaction()
+        report = checkReport()
+        _stdout_parser(stdout, report)
+        _log_parser(log, report)
+        assert [name for name, _, _ in report._changes] == [name for _, name, _, _ in generator.changes]
+        assert not any('unknown source' in msg for msg in report._crit)
+
+def test_unmatched_output_is_reported():
+    ''' without made up output every line is known to a rule '''
+    for profile, quiet in ((Profile(scriptlet_rate=0, unmatched_rate=0, seed=5), True), (Profile(seed=5), False)):
+        generator = Generator(profile)
+        generator.pause()
+        log, stdout = generator.transaction()
+        report = checkReport()
+        _stdout_parser(stdout, report)
+        _log_parser(log, report)
+        assert not report._crit
+        assert (not report._warn) == quiet
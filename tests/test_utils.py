@@ -0,0 +1,48 @@
+import pytest
+from pacroller.utils import OutputCapture
+
+CHUNKS = [
+    b':: Running post-transaction hooks...\r\n',
+    b'(1/2) Install DKMS modules\n==> dkms install --no-depmod zfs/2.2.2 -k 6.8.9-arch1-1\n',
+    b'progress 10%\rprogress 100%\r\ndone\n',
+    b'\x1b[1;32mcolored\x1b[0m line\n',
+    b'multi\xe2\x82',
+    b'\xacbyte \xff\n',
+    b'form\x0cfeed and \x0bvertical tab and \xe2\x80\xa8separator\n',
+    b'no newline at the end',
+]
+
+def capture(spill_size: int, chunks=CHUNKS):
+    lines = list()
+    output = OutputCapture(on_line=lines.append, spill_size=spill_size)
+    for chunk in chunks:
+        output.feed(chunk)
+    output.close()
+    return output, lines
+
+@pytest.mark.parametrize('spill_size', [0, 10, 100])
+def test_spilled_output_is_unchanged(spill_size):
+    kept, kept_lines = capture(16 * 1024**2)
+    spilled, spilled_lines = capture(spill_size)
+    assert spilled._spill is not None and kept._spill is None
+    assert list(spilled) == list(kept)
+    assert str(spilled) == str(kept)
+    assert spilled_lines == kept_lines
+
+def test_lines():
+    output, lines = capture(16 * 1024**2)
+    assert list(output)[:6] == [
+        ':: Running post-transaction hooks...',
+        '(1/2) Install DKMS modules',
+        '==> dkms install --no-depmod zfs/2.2.2 -k 6.8.9-arch1-1',
+        'progress 10%\rprogress 100%',
+        'done',
+        'colored line',
+    ]
+    assert output.partial == 'no newline at the end'
+    assert lines[-1] == 'no newline at the end'
+    assert output.bytes == sum(map(len, CHUNKS))
+
+def test_spilled_output_can_be_read_twice():
+    output, _ = capture(0)
+    assert str(output) == str(output)